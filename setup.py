@@ -13,4 +13,5 @@ setup(
     description='Tests is a simple Django app to conduct Web-based multiple-answer tests.',
     long_description=open('README.txt').read(),
     install_requires=['Django>=1.5'],
+    extras_require={'rescore': ['numpy']},
 )
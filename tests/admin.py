@@ -1,26 +1,141 @@
+from django import forms
+from django.conf.urls import patterns, url
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.html import format_html
 
-from models import Test, Page, Question, Answer, Result
+from models import Test, Page, Question, Answer, Result, set_answer_scores
+from blueprints import cache as blueprint_cache
+from routers import database_for_test
 
 
 class AnswerInline(admin.TabularInline):
     model = Answer
+    extra = 1
 
 
 class QuestionAdmin(admin.ModelAdmin):
     inlines = [AnswerInline]
+    list_display = ('name', 'page', 'position')
+    # Pages are shown along with their test
+    list_select_related = True
+    list_per_page = 50
+    list_filter = ('test',)
+    search_fields = ('name',)
+    raw_id_fields = ('page',)
 admin.site.register(Question, QuestionAdmin)
 
 
 class ResultInline(admin.TabularInline):
     model = Result
+    extra = 1
 
 
-class PageInline(admin.TabularInline):
-    model = Page
+class PageAdmin(admin.ModelAdmin):
+    """Lists pages of large tests, a page of pages at a time"""
+
+    list_display = ('name', 'test', 'position')
+    list_select_related = True
+    list_per_page = 50
+    list_filter = ('test',)
+    search_fields = ('name',)
+    raw_id_fields = ('test',)
+admin.site.register(Page, PageAdmin)
 
 
 class TestAdmin(admin.ModelAdmin):
-    inlines = [PageInline, ResultInline]
+    # Pages of large tests are listed by PageAdmin, rather than inline
+    inlines = [ResultInline]
+    readonly_fields = ('page_list',)
+    list_per_page = 50
+    search_fields = ('name',)
+    actions = ['edit_scores']
+
+    def page_list(self, test):
+        """Links to the pages of a test, listed by PageAdmin"""
+
+        if test.pk is None:
+            return '-'
+
+        count = Page.objects.using(database_for_test(test.pk)) \
+                            .filter(test=test).count()
+        return format_html('<a href="{url}?test__id__exact={test}">'
+                           '{count} pages</a>',
+                           url=reverse('admin:tests_page_changelist'),
+                           test=test.pk, count=count)
+    page_list.short_description = 'Pages'
+
+    def get_urls(self):
+        return patterns('',
+            url(r'^(\d+)/scores/$',
+                self.admin_site.admin_view(self.scores_view),
+                name='tests_test_scores'),
+        ) + super(TestAdmin, self).get_urls()
+
+    def edit_scores(self, request, queryset):
+        """Edits answer scores of the selected test, one test at a time"""
+
+        tests = list(queryset.order_by('pk')[:2])
+        if len(tests) > 1:
+            self.message_user(request, 'Answer scores are edited one test '
+                                       'at a time; select a single test.')
+            return None
+
+        return redirect('admin:tests_test_scores', tests[0].pk)
+    edit_scores.short_description = 'Edit answer scores of selected test'
+
+    def scores_view(self, request, test_id):
+        """
+        Edits scores of all answers of a test on a single form, applying
+        changed scores with as few UPDATEs as the database allows
+        """
+
+        test = get_object_or_404(Test, pk=test_id)
+        if not self.has_change_permission(request, test):
+            raise PermissionDenied
+
+        answers = list(Answer.objects.using(database_for_test(test.pk))
+                                     .filter(test=test)
+                                     .select_related('question')
+                                     .order_by('question__page__position',
+                                               'question__position', 'pk'))
+
+        fields = dict(('answer_{id}'.format(id=answer.pk),
+                       forms.IntegerField(label=answer.name,
+                                          initial=answer.score))
+                      for answer in answers)
+        form = type('ScoresForm', (forms.Form,), fields)(request.POST or None)
+
+        if form.is_valid():
+            changed = {}
+            for answer in answers:
+                score = form.cleaned_data['answer_{id}'.format(id=answer.pk)]
+                if score != answer.score:
+                    changed[answer.pk] = score
+
+            updated = set_answer_scores(test.pk, changed)
+            blueprint_cache.invalidate(test.pk)
+
+            messages.success(request, '{count} answer scores changed.'
+                                      .format(count=updated))
+            return redirect('admin:tests_test_change', test.pk)
+
+        # Group fields by question
+        questions = []
+        for answer in answers:
+            if not questions or questions[-1][0] != answer.question:
+                questions.append((answer.question, []))
+            questions[-1][1].append(
+                form['answer_{id}'.format(id=answer.pk)])
+
+        return render(request, 'admin/tests/test/scores.html', {
+            'title': 'Edit answer scores of {test}'.format(test=test.name),
+            'test': test,
+            'form': form,
+            'questions': questions,
+            'opts': self.model._meta,
+            'app_label': self.model._meta.app_label,
+        })
 admin.site.register(Test, TestAdmin)
@@ -0,0 +1,128 @@
+"""
+Analytics of finished attempts.
+
+Counters are kept per test as attempts are finished: the number of
+attempts finished with each score (the score histogram), with each result,
+and in which each answer was picked. Counters are incremented in the
+database (count = count + 1), one UPDATE per kind of counter, so that
+concurrent attempts don't overwrite each other's counts; missing counters
+are created on first use. Reading the analytics of a test takes one query
+per kind of counter, however many attempts have been finished.
+
+Counts are taken as attempts are finished; attempts rescored later on are
+not counted again.
+"""
+
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+from models import ScoreCount, AnswerCount, ResultCount
+from routers import database_for_test
+
+
+def add_counts(model, field, test_id, values, using=None):
+    """
+    Adds one to the counters of a test for given (distinct) values of
+    field, creating missing counters
+    """
+
+    counters = model.objects.using(using).filter(
+        test=test_id, **{field + '__in': values})
+
+    existing = set(counters.values_list(field, flat=True))
+    if existing:
+        counters.filter(**{field + '__in': existing}) \
+                .update(count=F('count') + 1)
+
+    missing = [value for value in values if value not in existing]
+    if not missing:
+        return
+
+    attname = model._meta.get_field(field).attname
+    sid = transaction.savepoint(using=using)
+    try:
+        model.objects.using(using).bulk_create([
+            model(test_id=test_id, count=1, **{attname: value})
+            for value in missing])
+    except IntegrityError:
+        # Counters have been created meanwhile, by another attempt
+        transaction.savepoint_rollback(sid, using=using)
+        add_counts(model, field, test_id, missing, using)
+    else:
+        transaction.savepoint_commit(sid, using=using)
+
+
+def count_attempt(attempt, blueprint, positions):
+    """
+    Counts a finished attempt in the analytics of its test, given positions
+    of all its checked answers
+    """
+
+    using = attempt._state.db
+
+    add_counts(ScoreCount, 'score', attempt.test_id, [attempt.score], using)
+    if attempt.result_id is not None:
+        add_counts(ResultCount, 'result', attempt.test_id,
+                   [attempt.result_id], using)
+    if positions:
+        add_counts(AnswerCount, 'answer', attempt.test_id,
+                   sorted(set(blueprint.answer_ids[position]
+                              for position in positions)), using)
+
+
+def test_analytics(blueprint):
+    """
+    Describes the analytics of a test: number of attempts finished, score
+    histogram, and counts of results and picked answers (along with their
+    rate among finished attempts)
+    """
+
+    using = database_for_test(blueprint.test_id)
+
+    scores = list(ScoreCount.objects.using(using)
+                                    .filter(test=blueprint.test_id)
+                                    .order_by('score')
+                                    .values_list('score', 'count'))
+    attempts = sum(count for score, count in scores)
+
+    def rate(count):
+        return float(count) / attempts if attempts else 0.0
+
+    results = dict(ResultCount.objects.using(using)
+                                      .filter(test=blueprint.test_id)
+                                      .values_list('result', 'count'))
+    answers = dict(AnswerCount.objects.using(using)
+                                      .filter(test=blueprint.test_id)
+                                      .values_list('answer', 'count'))
+
+    # Attempts scored below all limits have no result
+    bands = [{'id': None, 'text': blueprint.result_at(None).text,
+              'count': attempts - sum(results.values())}]
+    bands.extend({'id': result_id, 'text': text,
+                  'count': results.get(result_id, 0)}
+                 for result_id, text in zip(blueprint.result_ids,
+                                            blueprint.result_texts))
+    for band in bands:
+        band['rate'] = rate(band['count'])
+
+    questions = []
+    for question in range(len(blueprint.question_ids)):
+        picks = []
+        for answer in range(blueprint.question_answers[question],
+                            blueprint.question_answers[question + 1]):
+            count = answers.get(blueprint.answer_ids[answer], 0)
+            picks.append({'id': blueprint.answer_ids[answer],
+                          'name': blueprint.answer_names[answer],
+                          'count': count, 'rate': rate(count)})
+        questions.append({'id': blueprint.question_ids[question],
+                          'name': blueprint.question_names[question],
+                          'answers': picks})
+
+    return {
+        'test': blueprint.test_id,
+        'attempts': attempts,
+        'scores': [{'score': score, 'count': count}
+                   for score, count in scores],
+        'results': bands,
+        'questions': questions,
+    }
@@ -0,0 +1,219 @@
+"""
+Store of attempts in progress.
+
+The state of active attempts (page number, checked answers and the
+answers not written to the database yet) is kept in the cache set by
+TESTS_ATTEMPT_CACHE, so that moving through the pages of a test doesn't
+write to the database. State is written behind to the database once the
+attempt is finished or given up, and every TESTS_ATTEMPT_WRITE_BEHIND
+pages (3 by default; 0 writes active attempts only when their state is
+missing from the cache, at the cost of the pages submitted since).
+
+The database holds attempts as last written: when the state of an attempt
+is missing from the cache (evicted, or lost on restart), the attempt is
+recovered from the database, and pages submitted since it was last written
+are taken again. Finished and given up attempts are only kept in the
+database.
+
+The cache must be shared by all processes serving takers (e.g. memcached),
+as they would otherwise recover attempts from the database, and could
+handle the same page twice. Caches local to a process are refused, unless
+TESTS_ATTEMPT_CACHE_LOCAL is set (it defaults to DEBUG, for the
+development server).
+"""
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from models import Attempt, AttemptAnswer
+from analytics import count_attempt
+import codec
+
+
+# Attempt fields kept in the cache
+fields = ['test_id', 'status', 'page_number', 'checked', 'checked_version',
+          'score', 'result_id']
+
+
+def get_attempt_cache():
+    """
+    Returns the cache holding active attempts, set by TESTS_ATTEMPT_CACHE.
+    Raises ImproperlyConfigured if it is local to this process.
+    """
+
+    name = getattr(settings, 'TESTS_ATTEMPT_CACHE', 'default')
+    cache = get_cache(name)
+
+    if isinstance(cache, (LocMemCache, DummyCache)) and \
+       not getattr(settings, 'TESTS_ATTEMPT_CACHE_LOCAL', settings.DEBUG):
+        raise ImproperlyConfigured(
+            'TESTS_ATTEMPT_CACHE ({name}) must be shared by all processes; '
+            'set TESTS_ATTEMPT_CACHE_LOCAL to use a local cache.'.format(
+                name=name))
+
+    return cache
+
+
+def state_key(attempt_id):
+    return 'tests:attempt:{attempt}'.format(attempt=attempt_id)
+
+
+def lock_key(attempt_id):
+    return 'tests:attempt:{attempt}:lock'.format(attempt=attempt_id)
+
+
+def cache_attempt(attempt):
+    """Keeps the state of an active attempt in the cache"""
+
+    state = dict((field, getattr(attempt, field)) for field in fields)
+    state['unsaved_answers'] = list(unsaved_answers(attempt))
+    state['saved_page'] = saved_page(attempt)
+
+    get_attempt_cache().set(
+        state_key(attempt.pk), state,
+        getattr(settings, 'TESTS_ATTEMPT_TIMEOUT', 24 * 3600))
+
+
+def unsaved_answers(attempt):
+    """Returns ids of checked answers not written to the database yet"""
+
+    return getattr(attempt, 'unsaved_answers', [])
+
+
+def saved_page(attempt):
+    """Returns the page number last written to the database"""
+
+    return getattr(attempt, 'saved_page', attempt.page_number)
+
+
+def load_attempt(attempt_id, using=None):
+    """
+    Returns the attempt with given id, from the cache if it is active, or
+    from the database, if it exists
+    """
+
+    state = get_attempt_cache().get(state_key(attempt_id))
+
+    if state is None:
+        try:
+            attempt = Attempt.objects.using(using).get(pk=attempt_id)
+        except Attempt.DoesNotExist:
+            return None
+        if attempt.status == Attempt.ACTIVE:
+            cache_attempt(attempt)
+        return attempt
+
+    attempt = Attempt(pk=attempt_id, **dict((field, state[field])
+                                            for field in fields))
+    attempt.unsaved_answers = state['unsaved_answers']
+    attempt.saved_page = state['saved_page']
+    attempt._state.adding = False
+    attempt._state.db = using or router.db_for_read(Attempt,
+                                                    instance=attempt)
+
+    return attempt
+
+
+def save_attempt(attempt):
+    """
+    Writes an attempt to the database, along with its unsaved answers;
+    only active attempts are kept in the cache afterwards
+    """
+
+    using = attempt._state.db
+
+    Attempt.objects.using(using).filter(pk=attempt.pk).update(
+        status=attempt.status, page_number=attempt.page_number,
+        checked=attempt.checked, checked_version=attempt.checked_version,
+        score=attempt.score, result=attempt.result_id,
+        scoring_version=attempt.scoring_version)
+    AttemptAnswer.objects.using(using).bulk_create([
+        AttemptAnswer(attempt_id=attempt.pk, answer_id=answer_id)
+        for answer_id in unsaved_answers(attempt)])
+
+    attempt.unsaved_answers = []
+    attempt.saved_page = attempt.page_number
+
+    if attempt.status == Attempt.ACTIVE:
+        cache_attempt(attempt)
+    else:
+        get_attempt_cache().delete(state_key(attempt.pk))
+
+
+def finish_attempt(attempt, blueprint, positions):
+    """
+    Marks an attempt as finished, computing its score and result from
+    given positions of all its checked answers, and counts it in the
+    analytics of its test
+    """
+
+    attempt.status = Attempt.FINISHED
+    attempt.score = blueprint.score(positions)
+    attempt.result_id = blueprint.result(attempt.score).pk
+    attempt.scoring_version = blueprint.scoring_version
+    save_attempt(attempt)
+
+    count_attempt(attempt, blueprint, positions)
+
+
+def advance_attempt(attempt, blueprint, page_number, positions, checked):
+    """
+    Moves an attempt past given page, on which answers at given positions
+    have been checked (checked holding all its checked answers, encoded),
+    finishing it past the last page. Returns False if the page has already
+    been submitted, e.g. by a concurrent request.
+    """
+
+    cache = get_attempt_cache()
+
+    # Only one submission of an attempt's page is handled at a time
+    if not cache.add(lock_key(attempt.pk), True, 10):
+        return False
+
+    try:
+        current = load_attempt(attempt.pk, attempt._state.db)
+        if current is None or current.status != Attempt.ACTIVE or \
+           current.page_number != page_number:
+            return False
+
+        attempt.page_number = page_number + 1
+        attempt.checked = checked
+        attempt.checked_version = blueprint.version
+        attempt.unsaved_answers = unsaved_answers(current) + [
+            blueprint.answer_ids[position] for position in positions]
+        attempt.saved_page = saved_page(current)
+
+        pages = getattr(settings, 'TESTS_ATTEMPT_WRITE_BEHIND', 3)
+        if attempt.page_number > blueprint.page_count:
+            # Finished while locked, so that no request sees the attempt
+            # active past its last page
+            with transaction.commit_on_success(using=attempt._state.db):
+                finish_attempt(attempt, blueprint,
+                               codec.decode(blueprint, checked))
+        elif pages and attempt.page_number - attempt.saved_page >= pages:
+            with transaction.commit_on_success(using=attempt._state.db):
+                save_attempt(attempt)
+        else:
+            cache_attempt(attempt)
+
+        return True
+    finally:
+        cache.delete(lock_key(attempt.pk))
+
+
+@receiver(post_save, sender=Attempt)
+def drop_attempt(sender, instance, created, **kwargs):
+    """
+    Drops the state cached for an attempt saved outside the store, once it
+    is no longer active, or once it is created (state may be left over
+    from a previous attempt with the same id, e.g. on a restored database)
+    """
+
+    if created or instance.status != Attempt.ACTIVE:
+        get_attempt_cache().delete(state_key(instance.pk))
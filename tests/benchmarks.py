@@ -0,0 +1,315 @@
+"""
+Benchmarks of the tests app.
+
+Each benchmark is a function returning a list of rows (ordered dicts),
+printed as a table by the benchmark management command. Rows can be saved
+as a baseline, which later runs are compared against: timings (columns
+ending in _us or _ms) may not grow beyond a tolerance, and query counts
+and sizes (queries and columns ending in _bytes) may not grow at all.
+"""
+
+import json
+import math
+import random
+import timeit
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.db import connections, reset_queries
+from django.test.client import Client
+from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+
+import codec
+from blueprints import Blueprint, get_blueprint
+from generator import generate_test
+
+
+def synthetic_blueprint(questions, answers):
+    """
+    Returns the blueprint of a test with given number of questions (one
+    per page) and answers per question, without touching the database
+    """
+
+    answer_count = questions * answers
+
+    return Blueprint(
+        test_id=1, name='Synthetic test', description='',
+        page_ids=array('l', range(1, questions + 1)),
+        page_names=('Page',) * questions,
+        page_questions=array('l', range(questions + 1)),
+        question_ids=array('l', range(1, questions + 1)),
+        question_names=('Question',) * questions,
+        question_pages=array('l', range(questions)),
+        question_answers=array('l', range(0, answer_count + 1, answers)),
+        answer_ids=array('l', range(1, answer_count + 1)),
+        answer_names=('Answer',) * answer_count,
+        answer_scores=array('l', [i % answers for i in range(answer_count)]),
+        answer_questions=array('l', [i // answers
+                                     for i in range(answer_count)]),
+        result_ids=array('l'), result_texts=(), result_limits=array('l'),
+        answer_positions=dict((i + 1, i) for i in range(answer_count)),
+        version='synthetic', scoring_version='synthetic')
+
+
+def codec_benchmark(question_counts=(10, 100, 1000), answers=4, number=100):
+    """
+    Compares the size and (de)serialization time of checked answers stored
+    as page form data in JSON (e.g. {'question_1': ['1', '3']}, as the
+    session used to hold them) and encoded by the codec, with two answers
+    checked on each question
+    """
+
+    rows = []
+
+    for questions in question_counts:
+        blueprint = synthetic_blueprint(questions, answers)
+        positions = [position for position in range(questions * answers)
+                     if position % answers < 2]
+        data = dict(('question_{id}'.format(id=question + 1),
+                     [str(position + 1) for position in positions
+                      if position // answers == question])
+                     for question in range(questions))
+
+        serialized = json.dumps(data)
+        encoded = codec.encode(blueprint, positions)
+
+        def measure(function):
+            """Returns the average run time of function, in microseconds"""
+
+            return timeit.timeit(function, number=number) / number * 1e6
+
+        rows.append(OrderedDict([
+            ('questions', questions),
+            ('json_bytes', len(serialized)),
+            ('codec_bytes', len(encoded)),
+            ('json_dump_us', measure(lambda: json.dumps(data))),
+            ('json_load_us', measure(lambda: json.loads(serialized))),
+            ('codec_encode_us', measure(
+                lambda: codec.encode(blueprint, positions))),
+            ('codec_decode_us', measure(
+                lambda: codec.decode(blueprint, encoded))),
+        ]))
+
+    return rows
+
+
+def percentile(values, percent):
+    """Returns the given percentile of values (nearest rank)"""
+
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+
+    return values[max(rank, 1) - 1]
+
+
+def max_rss():
+    """Returns the peak memory used by this process so far, in kilobytes"""
+
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def test_databases():
+    """Runs the enclosed code against fresh test databases"""
+
+    setup_test_environment()
+    runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+    try:
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+
+@contextmanager
+def nothing():
+    yield
+
+
+@contextmanager
+def counted_queries():
+    """
+    Counts queries run on all databases within the enclosed code, including
+    queries of requests made with the test client; yields a function
+    returning the count so far
+    """
+
+    debug_cursors = dict((connection.alias, connection.use_debug_cursor)
+                         for connection in connections.all())
+    for connection in connections.all():
+        connection.use_debug_cursor = True
+    request_started.disconnect(reset_queries)
+    reset_queries()
+
+    try:
+        yield lambda: sum(len(connection.queries)
+                          for connection in connections.all())
+    finally:
+        request_started.connect(reset_queries)
+        for connection in connections.all():
+            connection.use_debug_cursor = debug_cursors[connection.alias]
+
+
+def flow_benchmark(sizes=((3, 5), (10, 20)), answers=4, takes=10,
+                   isolated=True):
+    """
+    Times each step of taking tests of given sizes (pages, questions per
+    page) through the test client: the index, page views, page submissions
+    and the result. Each test is taken several times, checking one random
+    answer per question. Runs against fresh test databases, unless
+    isolated is False.
+    """
+
+    def take(client, blueprint, rng, measure):
+        """Takes a test once, measuring each request"""
+
+        url = reverse('tests:view', args=(blueprint.test_id,))
+
+        measure('index', lambda: client.get(reverse('tests:index')))
+        for page in range(blueprint.page_count):
+            data = dict(('question_{id}'.format(id=question_id),
+                         [str(rng.choice(choices)[0])])
+                        for question_id, name, choices
+                        in blueprint.questions(page))
+            measure('view', lambda: client.get(url))
+            measure('submit', lambda: client.post(url, data))
+        measure('result', lambda: client.get(
+            reverse('tests:result', args=(blueprint.test_id,))))
+        client.get(reverse('tests:give_up'))
+
+    steps = ['index', 'view', 'submit', 'result']
+    rows = []
+
+    with test_databases() if isolated else nothing():
+        for pages, questions in sizes:
+            blueprint = get_blueprint(generate_test(pages, questions,
+                                                    answers, 5, seed=0).pk)
+            rng = random.Random(0)
+
+            timings = dict((step, []) for step in steps)
+            queries = dict((step, []) for step in steps)
+            memory = dict((step, []) for step in steps)
+
+            with counted_queries() as count:
+                def measure(step, request):
+                    start_queries = count()
+                    start_rss = max_rss()
+                    start = timeit.default_timer()
+                    response = request()
+                    timings[step].append(
+                        (timeit.default_timer() - start) * 1e3)
+                    queries[step].append(count() - start_queries)
+                    if start_rss is not None:
+                        memory[step].append(max_rss() - start_rss)
+
+                    if response.status_code not in (200, 302):
+                        raise RuntimeError('{step} failed with status '
+                                             '{status}'.format(
+                                                 step=step,
+                                                 status=response.status_code))
+
+                for i in range(takes):
+                    take(Client(), blueprint, rng, measure)
+
+            for step in steps:
+                rows.append(OrderedDict([
+                    ('questions', pages * questions),
+                    ('step', step),
+                    ('requests', len(timings[step])),
+                    ('p50_ms', percentile(timings[step], 50)),
+                    ('p90_ms', percentile(timings[step], 90)),
+                    ('p99_ms', percentile(timings[step], 99)),
+                    ('queries', max(queries[step])),
+                    # Growth of the process's peak memory over the step's
+                    # requests, and the peak once the flow is done
+                    ('rss_growth_kb', sum(memory[step])
+                                      if resource is not None else None),
+                    ('process_peak_kb', max_rss()),
+                ]))
+
+    return rows
+
+
+benchmarks = {
+    'codec': codec_benchmark,
+    'flow': flow_benchmark,
+}
+
+
+def is_timing(column):
+    return column.endswith('_us') or column.endswith('_ms')
+
+
+def is_count(column):
+    return column == 'queries' or column.endswith('_bytes')
+
+
+def is_key(column):
+    """Checks whether a column identifies rows, rather than measures them"""
+
+    return not is_timing(column) and not is_count(column) and \
+        not column.endswith('_kb') and column != 'requests'
+
+
+def row_key(row):
+    """Describes the columns identifying a row"""
+
+    return ', '.join('{column}={value}'.format(column=column,
+                                               value=row[column])
+                     for column in sorted(row) if is_key(column))
+
+
+def regressions(baseline, results, tolerance=0.25):
+    """
+    Compares benchmark results against a baseline (both mapping benchmark
+    names to rows), and returns a description of each regression: timings
+    grown by more than tolerance (a fraction), or counts grown at all
+    """
+
+    messages = []
+
+    for name, rows in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        base_rows = dict((row_key(base), base) for base in baseline[name])
+
+        for row in rows:
+            key = row_key(row)
+            base = base_rows.get(key)
+            if base is None:
+                continue
+
+            for column, value in row.items():
+                if column not in base or value is None or \
+                   base[column] is None:
+                    continue
+
+                if is_timing(column):
+                    limit = base[column] * (1 + tolerance)
+                elif is_count(column):
+                    limit = base[column]
+                else:
+                    continue
+
+                if value > limit:
+                    messages.append('{name} ({key}): {column} is {value:.1f}, '
+                                    'baseline {base:.1f}'.format(
+                                        name=name, key=key, column=column,
+                                        value=value, base=base[column]))
+
+    return messages
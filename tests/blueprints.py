@@ -0,0 +1,373 @@
+"""
+Compiled test blueprints.
+
+A blueprint is an immutable and compact snapshot of a test's content: its
+ordered pages, questions and answers kept in flat arrays, and its results
+sorted by limit. Blueprints are built once per process and kept in a LRU
+cache, from which they are dropped whenever any object of their test is
+saved or deleted.
+
+Processes share a stamp of each test in the cache set by
+TESTS_BLUEPRINT_CACHE ('default'), changed whenever the test is edited;
+blueprints built under another stamp are rebuilt, so that edits made in
+one process reach the others. The stamp cache must be shared by all
+processes (e.g. memcached) for this to hold.
+"""
+
+import hashlib
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from models import Test, Page, Question, Answer, Result
+from routers import database_for_test
+
+
+class Blueprint(namedtuple('Blueprint', [
+        'test_id', 'name', 'description',
+        # Pages, with offsets of each page's questions
+        'page_ids', 'page_names', 'page_questions',
+        # Questions, with offsets of each question's answers
+        'question_ids', 'question_names', 'question_pages',
+        'question_answers',
+        # Answers, with the question each one belongs to
+        'answer_ids', 'answer_names', 'answer_scores', 'answer_questions',
+        # Results, sorted by limit
+        'result_ids', 'result_texts', 'result_limits',
+        # Maps answer ids to their position in answer arrays
+        'answer_positions',
+        # Digest of the content, changing whenever the test is edited
+        'version',
+        # Digest of what scores depend on (answer ids and scores, result
+        # limits), changing only when scoring changes
+        'scoring_version'])):
+    """Immutable snapshot of a test's content"""
+
+    __slots__ = ()
+
+    @property
+    def test(self):
+        """Returns the (unsaved) test described by this blueprint"""
+
+        return Test(pk=self.test_id, name=self.name,
+                    description=self.description)
+
+    @property
+    def page_count(self):
+        return len(self.page_ids)
+
+    def questions(self, page):
+        """
+        Returns the questions on the page with given index, as
+        (id, name, [(answer_id, answer_name), ...]) tuples.
+        """
+
+        questions = []
+        for question in range(self.page_questions[page],
+                              self.page_questions[page+1]):
+            answers = range(self.question_answers[question],
+                            self.question_answers[question+1])
+            questions.append((
+                self.question_ids[question],
+                self.question_names[question],
+                [(self.answer_ids[answer], self.answer_names[answer])
+                 for answer in answers]))
+
+        return questions
+
+    def positions(self, answer_ids):
+        """
+        Returns positions of given answer ids in answer arrays, skipping
+        answers that are not part of the test
+        """
+
+        positions = []
+        for answer_id in answer_ids:
+            position = self.answer_positions.get(int(answer_id))
+            if position is not None:
+                positions.append(position)
+
+        return positions
+
+    def score(self, positions):
+        """Returns the summed up score of answers at given positions"""
+
+        return sum(self.answer_scores[position] for position in positions)
+
+    def result(self, score):
+        """Returns test result based on given score"""
+
+        index = bisect_right(self.result_limits, score) - 1
+        if index < 0:
+            return self.result_at(None)
+
+        return self.result_at(index)
+
+    def result_by_id(self, result_id):
+        """Returns the (unsaved) result with given id, which may be None"""
+
+        if result_id is None:
+            return self.result_at(None)
+
+        return self.result_at(list(self.result_ids).index(result_id))
+
+    def result_at(self, index):
+        """
+        Returns the (unsaved) result at given index, or the result of
+        scores below all limits for None
+        """
+
+        if index is None:
+            return Result(text='Your result is too low!', limit=-999)
+
+        return Result(pk=self.result_ids[index], test_id=self.test_id,
+                      text=self.result_texts[index],
+                      limit=self.result_limits[index])
+
+    def next_result(self, limit):
+        """Returns the first result with a limit above given one, or None"""
+
+        index = bisect_right(self.result_limits, limit)
+        if index == len(self.result_limits):
+            return None
+
+        return self.result_at(index)
+
+
+def build(test_id):
+    """Builds the blueprint of the test with given id from the database"""
+
+    test = Test.objects.get(pk=test_id)
+    using = database_for_test(test.pk)
+
+    pages = list(Page.objects.using(using)
+                             .filter(test=test)
+                             .order_by('position')
+                             .values_list('id', 'name'))
+
+    # Fetch questions along with their answers in a single query, one row
+    # per answer (or one row with no answer for questions without answers)
+    questions = []
+    answers = []
+    for row in Question.objects.using(using) \
+                               .filter(test=test) \
+                               .order_by('page__position', 'position',
+                                         'answers__pk') \
+                               .values_list('id', 'name', 'page',
+                                            'answers__id', 'answers__name',
+                                            'answers__score'):
+        if not questions or questions[-1][0] != row[0]:
+            questions.append(row[:3])
+        if row[3] is not None:
+            answers.append(row[3:] + row[:1])
+
+    results = list(Result.objects.using(using)
+                                 .filter(test=test)
+                                 .order_by('limit', 'pk')
+                                 .values_list('id', 'text', 'limit'))
+
+    def offsets(parents, children):
+        """
+        Returns offsets of children of each parent, given children's
+        parent indexes (sorted)
+        """
+
+        counts = [0] * len(parents)
+        for parent in children:
+            counts[parent] += 1
+
+        offsets = array('l', [0])
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+
+        return offsets
+
+    page_indexes = dict((page[0], i) for i, page in enumerate(pages))
+    question_pages = array('l', [page_indexes[question[2]]
+                                 for question in questions])
+
+    question_indexes = dict((question[0], i)
+                            for i, question in enumerate(questions))
+    answer_questions = array('l', [question_indexes[answer[3]]
+                                   for answer in answers])
+
+    content = (test.name, test.description, pages, questions, answers,
+               results)
+    scoring = ([answer[0] for answer in answers],
+               [answer[2] for answer in answers],
+               [result[2] for result in results])
+
+    return Blueprint(
+        test_id=test.pk,
+        name=test.name,
+        description=test.description,
+        page_ids=array('l', [page[0] for page in pages]),
+        page_names=tuple(page[1] for page in pages),
+        page_questions=offsets(pages, question_pages),
+        question_ids=array('l', [question[0] for question in questions]),
+        question_names=tuple(question[1] for question in questions),
+        question_pages=question_pages,
+        question_answers=offsets(questions, answer_questions),
+        answer_ids=array('l', [answer[0] for answer in answers]),
+        answer_names=tuple(answer[1] for answer in answers),
+        answer_scores=array('l', [answer[2] for answer in answers]),
+        answer_questions=answer_questions,
+        result_ids=array('l', [result[0] for result in results]),
+        result_texts=tuple(result[1] for result in results),
+        result_limits=array('l', [result[2] for result in results]),
+        answer_positions=dict((answer[0], i)
+                              for i, answer in enumerate(answers)),
+        version=hashlib.md5(repr(content)).hexdigest(),
+        scoring_version=hashlib.md5(repr(scoring)).hexdigest())
+
+
+class BlueprintCache(object):
+    """
+    LRU cache of blueprints, keyed by test id, along with the stamp they
+    were built under
+    """
+
+    def __init__(self):
+        self.blueprints = OrderedDict()
+        self.lock = Lock()
+
+    @property
+    def size(self):
+        return getattr(settings, 'TESTS_BLUEPRINT_CACHE_SIZE', 100)
+
+    @property
+    def stamps(self):
+        """Returns the cache holding stamps, shared by processes"""
+
+        return get_cache(getattr(settings, 'TESTS_BLUEPRINT_CACHE',
+                                 'default'))
+
+    def stamp_keys(self, test_id):
+        # Stamps of all tests, and of given test
+        return ['tests:blueprints',
+                'tests:blueprint:{test}'.format(test=test_id)]
+
+    def stamp(self, test_id):
+        """
+        Returns the current stamp of the test with given id, setting one
+        if it is missing
+        """
+
+        keys = self.stamp_keys(test_id)
+        stamps = self.stamps.get_many(keys)
+        for key in keys:
+            if key not in stamps:
+                # Stamps that expire only cause blueprints to be rebuilt
+                self.stamps.add(key, uuid.uuid4().hex, 24 * 3600)
+                stamps[key] = self.stamps.get(key)
+
+        return tuple(stamps[key] for key in keys)
+
+    def get(self, test_id):
+        """
+        Returns the blueprint of the test with given id, building it if
+        needed. Raises Test.DoesNotExist if there is no such test.
+        """
+
+        test_id = int(test_id)
+        stamp = self.stamp(test_id)
+
+        with self.lock:
+            cached = self.blueprints.pop(test_id, None)
+            if cached is not None and cached[0] == stamp:
+                self.blueprints[test_id] = cached
+                return cached[1]
+
+        # Blueprints built while their test changes are kept under the
+        # stamp read beforehand, so they are rebuilt on next use
+        blueprint = build(test_id)
+
+        with self.lock:
+            self.blueprints[test_id] = (stamp, blueprint)
+            while len(self.blueprints) > self.size:
+                self.blueprints.popitem(last=False)
+
+        return blueprint
+
+    def invalidate(self, test_id=None):
+        """Drops the blueprint of given test, or all blueprints"""
+
+        if test_id is None:
+            key = self.stamp_keys(None)[0]
+        else:
+            key = self.stamp_keys(int(test_id))[1]
+        self.stamps.set(key, uuid.uuid4().hex, 24 * 3600)
+
+        with self.lock:
+            if test_id is None:
+                self.blueprints.clear()
+            else:
+                self.blueprints.pop(int(test_id), None)
+
+    def clear(self):
+        self.invalidate()
+
+
+cache = BlueprintCache()
+
+
+def get_blueprint(test_id):
+    """Returns the blueprint of the test with given id"""
+
+    return cache.get(test_id)
+
+
+def test_id_of(instance):
+    """Returns the id of the test given object belongs to"""
+
+    if isinstance(instance, Test):
+        return instance.pk
+
+    return instance.test_id
+
+
+@receiver(post_init, sender=Page)
+@receiver(post_init, sender=Question)
+@receiver(post_init, sender=Answer)
+@receiver(post_init, sender=Result)
+def remember_test(sender, instance, **kwargs):
+    """
+    Remembers the test an object was loaded with, so that the blueprints
+    of both tests are dropped once it is moved to another test
+    """
+
+    # Deferred test ids are not loaded
+    instance._blueprint_test_id = instance.__dict__.get('test_id')
+
+
+@receiver(post_save, sender=Test)
+@receiver(post_save, sender=Page)
+@receiver(post_save, sender=Question)
+@receiver(post_save, sender=Answer)
+@receiver(post_save, sender=Result)
+@receiver(post_delete, sender=Test)
+@receiver(post_delete, sender=Page)
+@receiver(post_delete, sender=Question)
+@receiver(post_delete, sender=Answer)
+@receiver(post_delete, sender=Result)
+def invalidate_blueprint(sender, instance, **kwargs):
+    """
+    Drops the blueprint of the test a changed object belongs to, and of
+    the test it belonged to when loaded, if it has been moved
+    """
+
+    test_id = test_id_of(instance)
+    cache.invalidate(test_id)
+
+    previous = getattr(instance, '_blueprint_test_id', None)
+    if previous is not None and previous != test_id:
+        cache.invalidate(previous)
+    if sender is not Test:
+        instance._blueprint_test_id = test_id
@@ -0,0 +1,127 @@
+"""
+Test catalog shown by the index view.
+
+The catalog is paginated by test id (keyset pagination), so that any page
+is fetched with a single indexed query, however many tests there are.
+Rendered pages are cached by catalog version, which is bumped whenever a
+test is saved or deleted.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+
+from models import Test
+
+
+VERSION_KEY = 'tests:catalog:version'
+
+
+def catalog_timeout():
+    """
+    Returns how long rendered pages are cached (TESTS_CATALOG_CACHE_TIMEOUT,
+    in seconds); the version is kept as long
+    """
+
+    return getattr(settings, 'TESTS_CATALOG_CACHE_TIMEOUT', 3600)
+
+
+def new_version():
+    """
+    Returns a version to start from, once the version has expired from the
+    cache; based on time, so that versions of expired pages are not reused
+    """
+
+    return int(time.time() * 1000)
+
+
+def catalog_version():
+    """Returns the current version of the catalog"""
+
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = new_version()
+        if not cache.add(VERSION_KEY, version, catalog_timeout()):
+            version = cache.get(VERSION_KEY, version)
+
+    return version
+
+
+@receiver(post_save, sender=Test)
+@receiver(post_delete, sender=Test)
+def bump_catalog_version(sender, instance, **kwargs):
+    """Drops rendered catalog pages, as a test has changed"""
+
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, new_version(), catalog_timeout())
+
+
+class CatalogPage(object):
+    """
+    A page of the catalog, holding the tests following the test with id
+    after, or those preceding the test with id before. Tests are fetched on
+    first use, so pages rendered from cache don't query the database.
+    """
+
+    def __init__(self, after=None, before=None, size=None):
+        self.after = after
+        self.before = before
+        self.size = size or getattr(settings, 'TESTS_CATALOG_PAGE_SIZE', 20)
+
+    @cached_property
+    def fetched(self):
+        """
+        Returns tests of the page, along with whether there are more tests
+        beyond it (in the direction of pagination)
+        """
+
+        tests = Test.objects.only('id', 'name', 'description')
+
+        if self.before is not None:
+            tests = list(tests.filter(pk__lt=self.before)
+                              .order_by('-pk')[:self.size + 1])
+            more = len(tests) > self.size
+            return tests[:self.size][::-1], more
+
+        if self.after is not None:
+            tests = tests.filter(pk__gt=self.after)
+        tests = list(tests.order_by('pk')[:self.size + 1])
+
+        return tests[:self.size], len(tests) > self.size
+
+    @property
+    def tests(self):
+        return self.fetched[0]
+
+    @property
+    def next_after(self):
+        """Returns the cursor of the next page, if any"""
+
+        tests, more = self.fetched
+        if tests and (more or self.before is not None):
+            return tests[-1].pk
+
+        return None
+
+    @property
+    def previous_before(self):
+        """Returns the cursor of the previous page, if any"""
+
+        tests, more = self.fetched
+        if tests and (more if self.before is not None
+                      else self.after is not None):
+            return tests[0].pk
+
+        return None
+
+    def __iter__(self):
+        return iter(self.tests)
+
+    def __len__(self):
+        return len(self.tests)
@@ -1,25 +1,122 @@
+from threading import Lock
+
 from django import forms
+from django.utils.safestring import mark_safe
 
 
 class PageForm(forms.Form):
     """Form that handles pages within a test"""
 
-    def __init__(self, *args, **kwargs):
-        page = kwargs.pop('page', None)
 
-        super(PageForm, self).__init__(*args, **kwargs)
+# Form classes of test pages, keyed by test id and page index, along with
+# the test version they have been built for
+form_classes = {}
+form_classes_lock = Lock()
+
+# Markup of the unbound forms of test pages, keyed and versioned like form
+# classes
+page_markups = {}
+
+
+def page_form_class(blueprint, page):
+    """
+    Returns the form class of the page with given index from a test
+    blueprint. Classes are built once per page and test version.
+    """
+
+    key = (blueprint.test_id, page)
+
+    with form_classes_lock:
+        version, form_class = form_classes.get(key, (None, None))
+    if version == blueprint.version:
+        return form_class
+
+    fields = {}
+
+    # Fetch page related questions from the test blueprint, each with
+    # its related answers as list of 2-tuples
+    # e.g.: [(1, 'answer1'), (2, 'answers'), ...]
+    questions = blueprint.questions(page)
+
+    for question_id, name, answers in questions:
+        # Add radio fields representing each question's answers
+        fields['question_{index}'.format(index=question_id)] = \
+            forms.MultipleChoiceField(label=name,
+                                      required=True,
+                                      choices=answers,
+                                      widget=forms.CheckboxSelectMultiple)
+
+    form_class = type('PageForm', (PageForm,), fields)
+
+    with form_classes_lock:
+        form_classes[key] = (blueprint.version, form_class)
+
+    return form_class
+
+
+def page_markup(blueprint, page):
+    """
+    Returns the markup of the unbound form of the page with given index
+    from a test blueprint, rendered once per page and test version. It
+    holds the page's questions only, and no per-session data.
+    """
+
+    key = (blueprint.test_id, page)
+
+    with form_classes_lock:
+        version, markup = page_markups.get(key, (None, None))
+    if version == blueprint.version:
+        return markup
+
+    markup = mark_safe(page_form_class(blueprint, page)().as_p())
+
+    with form_classes_lock:
+        page_markups[key] = (blueprint.version, markup)
+
+    return markup
+
+
+def clean_answers(blueprint, answers):
+    """
+    Validates answers to all questions of a test, as page forms do for the
+    questions of a page, given as answer ids keyed by question id
+    e.g.: {'1': [1, 3], '2': [5]}
+    Returns positions of the checked answers, along with error messages
+    keyed by question id.
+    """
+
+    if not isinstance(answers, dict):
+        return [], {'answers': 'Enter answer ids keyed by question id.'}
+
+    positions = set()
+    errors = {}
+
+    questions = dict((str(question_id), question) for question, question_id
+                     in enumerate(blueprint.question_ids))
+    for key in answers:
+        if key not in questions:
+            errors[key] = 'Unknown question.'
 
-        # Fetch page related questions
-        questions = page.questions.all()
+    for key, question in questions.iteritems():
+        answer_ids = answers.get(key)
+        if not answer_ids:
+            errors[key] = 'This field is required.'
+            continue
+        if not isinstance(answer_ids, list):
+            errors[key] = 'Enter a list of values.'
+            continue
 
-        for question in questions:
-            # Returns related answers as list of 2-tuples
-            # e.g.: [(1, 'answer1'), (2, 'answers'), ...]
-            answers = question.answers.values_list('id', 'name')
+        for answer_id in answer_ids:
+            try:
+                position = blueprint.answer_positions.get(int(answer_id))
+            except (TypeError, ValueError):
+                position = None
+            if position is None or \
+               blueprint.answer_questions[position] != question:
+                errors[key] = ('Select a valid choice. {answer} is not one '
+                               'of the available choices.'.format(
+                                   answer=answer_id))
+                break
+            positions.add(position)
 
-            # Add radio fields representing each question's answers
-            self.fields['question_{index}'.format(index=question.id)] = \
-                forms.MultipleChoiceField(label=question.name,
-                                          required=True,
-                                          choices=answers,
-                                          widget=forms.CheckboxSelectMultiple)
+    return sorted(positions), errors
@@ -0,0 +1,68 @@
+"""
+Synthetic tests, for benchmarks and load testing.
+
+Tests are generated with given numbers of pages, questions per page,
+answers per question and results; answer scores are random, and result
+limits are spread evenly up to the best score of the test.
+"""
+
+import random
+
+from django.db import transaction
+
+from models import Test, Page, Question, Answer, Result
+from routers import database_for_test
+
+
+def generate_test(pages, questions, answers, results, name='Synthetic test',
+                  seed=None):
+    """
+    Creates a test with given number of pages, questions per page, answers
+    per question and results, and returns it. Answers are scored from -1
+    to 3, at random (given seed makes tests reproducible).
+    """
+
+    rng = random.Random(seed)
+
+    test = Test.objects.create(name=name, description='{pages} pages, '
+                               '{questions} questions per page'.format(
+                                   pages=pages, questions=questions))
+    using = database_for_test(test.pk)
+
+    with transaction.commit_on_success(using=using):
+        Page.objects.using(using).bulk_create([
+            Page(name='Page {page}'.format(page=page), test=test,
+                 position=page)
+            for page in range(1, pages + 1)])
+        page_ids = Page.objects.using(using).filter(test=test) \
+                                            .order_by('position') \
+                                            .values_list('pk', flat=True)
+
+        Question.objects.using(using).bulk_create([
+            Question(name='Question {question}'.format(question=question),
+                     page_id=page_id, test=test, position=question)
+            for page_id in page_ids
+            for question in range(1, questions + 1)])
+        question_ids = Question.objects.using(using) \
+                                       .filter(test=test) \
+                                       .order_by('page__position',
+                                                 'position') \
+                                       .values_list('pk', flat=True)
+
+        best = 0
+        objects = []
+        for question_id in question_ids:
+            scores = [rng.randint(-1, 3) for answer in range(answers)]
+            best += sum(score for score in scores if score > 0)
+            objects.extend(
+                Answer(name='Answer {answer}'.format(answer=answer),
+                       score=score, question_id=question_id, test=test)
+                for answer, score in enumerate(scores, 1))
+        Answer.objects.using(using).bulk_create(objects)
+
+        Result.objects.using(using).bulk_create([
+            Result(text='Result {result}'.format(result=result),
+                   limit=best * result // results, test=test)
+            for result in range(results)])
+
+    return test
@@ -0,0 +1,225 @@
+"""
+Background computation of suggestions.
+
+Suggestions are computed by a bounded pool of worker processes and stored
+in the suggestions cache, so the result view can show the score right
+away and let the page fetch suggestions once they are found. The search
+is pure Python and CPU bound, so it runs in other processes to leave this
+one (and its GIL) to serving other takers; blueprints are sent to workers
+pickled, and found suggestions are cached back in this process. When too
+many computations are pending, suggestions are computed inline instead.
+
+The pool is started by start_pool() before serving requests, as forking
+from a process already serving from several threads may leave locks held
+in the workers. Workers drop the database connections they inherit, and
+the pool is stopped when the process exits.
+"""
+
+import atexit
+import logging
+import os
+import time
+from functools import partial
+from multiprocessing import Pool, TimeoutError
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections
+
+from suggestions import similar_results, cache_key, \
+                        cache_similar_results, get_cached_similar_results, \
+                        get_suggestions_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Pool computing suggestions, along with the process it was started in
+pool = None
+pool_pid = None
+pool_lock = Lock()
+
+# Pending computations, keyed by cache key, along with the time they were
+# submitted at
+pending = {}
+lock = Lock()
+
+
+def expire_pending():
+    """
+    Drops computations pending for more than TESTS_SUGGESTIONS_STALE (60)
+    seconds, whose results may never come (e.g. their worker died); called
+    with lock held
+    """
+
+    expired = time.time() - getattr(settings, 'TESTS_SUGGESTIONS_STALE', 60)
+    for key, (job, submitted) in pending.items():
+        if submitted < expired:
+            del pending[key]
+
+
+def init_worker():
+    """
+    Drops the database connections a worker process inherits, without
+    closing them, as they are still used by the process serving requests
+    """
+
+    for connection in connections.all():
+        connection.connection = None
+
+
+def start_pool():
+    """
+    Starts the pool of processes computing suggestions
+    (TESTS_SUGGESTIONS_WORKERS) in this process, unless it is started
+    """
+
+    global pool, pool_pid
+
+    with pool_lock:
+        # Pools inherited from a parent process have no threads handling
+        # their results
+        if pool is None or pool_pid != os.getpid():
+            pool = Pool(getattr(settings, 'TESTS_SUGGESTIONS_WORKERS', 2),
+                        init_worker)
+            pool_pid = os.getpid()
+
+    return pool
+
+
+def get_pool():
+    """
+    Returns the pool of processes computing suggestions, starting it if
+    start_pool() has not been called
+    """
+
+    if pool is None or pool_pid != os.getpid():
+        return start_pool()
+
+    return pool
+
+
+@atexit.register
+def stop_pool():
+    """Stops the pool of this process, dropping pending computations"""
+
+    global pool
+
+    if pool is not None and pool_pid == os.getpid():
+        pool.terminate()
+        pool.join()
+        pool = None
+
+
+def search(blueprint, checked):
+    """
+    Returns similar results of given checked answers, or None if the
+    search fails; run by worker processes
+    """
+
+    try:
+        return similar_results(blueprint, checked)
+    except Exception:
+        logger.exception('Suggestions for test %s failed',
+                         blueprint.test_id)
+        return None
+
+
+def searched(blueprint, checked, key, suggestions):
+    """Caches similar results found by a worker process, in this process"""
+
+    # Errors are logged, as they would stop the pool from handling results
+    try:
+        if suggestions is not None:
+            cache_similar_results(blueprint, checked, suggestions)
+    except Exception:
+        logger.exception('Suggestions for test %s not cached',
+                         blueprint.test_id)
+    finally:
+        with lock:
+            pending.pop(key, None)
+
+
+def compute(blueprint, checked, key):
+    """Computes and caches similar results of given checked answers"""
+
+    try:
+        suggestions = similar_results(blueprint, checked)
+        cache_similar_results(blueprint, checked, suggestions)
+        return suggestions
+    finally:
+        with lock:
+            pending.pop(key, None)
+
+
+def submit(blueprint, checked):
+    """
+    Submits the computation of similar results of given checked answers,
+    unless it is already pending. Returns False if the pool is saturated,
+    i.e. TESTS_SUGGESTIONS_PENDING computations are already pending.
+    """
+
+    key = cache_key(blueprint, checked)
+
+    with lock:
+        expire_pending()
+        if key in pending:
+            return True
+        if len(pending) >= getattr(settings, 'TESTS_SUGGESTIONS_PENDING', 20):
+            return False
+        pending[key] = (get_pool().apply_async(
+            search, (blueprint, checked),
+            callback=partial(searched, blueprint, checked, key)), time.time())
+
+    return True
+
+
+def start(blueprint, checked):
+    """
+    Returns cached similar results of given checked answers, or submits
+    their computation and returns None. They are computed inline if the
+    pool is saturated.
+    """
+
+    suggestions = get_cached_similar_results(blueprint, checked)
+
+    if suggestions is None and not submit(blueprint, checked):
+        suggestions = compute(blueprint, checked,
+                              cache_key(blueprint, checked))
+
+    return suggestions
+
+
+def fetch(blueprint, checked, timeout=None):
+    """
+    Returns similar results of given checked answers, waiting at most
+    timeout seconds (TESTS_SUGGESTIONS_TIMEOUT) for them to be computed in
+    the background, or None if they are still pending (or their search
+    failed). They are computed inline if the pool is saturated.
+    """
+
+    if timeout is None:
+        timeout = getattr(settings, 'TESTS_SUGGESTIONS_TIMEOUT', 1.0)
+
+    suggestions = get_cached_similar_results(blueprint, checked)
+    if suggestions is not None:
+        return suggestions
+
+    key = cache_key(blueprint, checked)
+
+    with lock:
+        expire_pending()
+        job, submitted = pending.get(key, (None, None))
+
+    if job is None:
+        if not submit(blueprint, checked):
+            return compute(blueprint, checked, key)
+        with lock:
+            job, submitted = pending.get(key, (None, None))
+        if job is None:
+            # Computed in the meantime
+            return get_suggestions_cache().get(key)
+
+    try:
+        return job.get(timeout)
+    except TimeoutError:
+        return None
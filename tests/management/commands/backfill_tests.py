@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tests.models import Test, Page, Question, Answer
+from tests.routers import database_for_test
+
+
+class Command(BaseCommand):
+    help = ('Fills in page and question positions and the test of questions '
+            'and answers, for tests created before these fields existed. '
+            'Existing positions are kept in their current order.')
+
+    def handle(self, *args, **options):
+        for test in Test.objects.order_by('pk').iterator():
+            using = database_for_test(test.pk)
+            with transaction.commit_on_success(using=using):
+                Question.objects.using(using).filter(page__test=test) \
+                                .update(test=test)
+                Answer.objects.using(using) \
+                              .filter(question__page__test=test) \
+                              .update(test=test)
+
+                pages = list(Page.objects.using(using)
+                                         .filter(test=test)
+                                         .order_by('position', 'pk'))
+                self.renumber(Page, pages)
+
+                for page in pages:
+                    self.renumber(Question,
+                                  page.questions.order_by('position', 'pk'))
+
+            self.stdout.write('Test {test}: {count} pages backfilled'.format(
+                test=test.pk, count=len(pages)))
+
+    def renumber(self, model, objects):
+        """Numbers given objects 1, 2, ... in their current order"""
+
+        objects = list(objects)
+        manager = model.objects.db_manager(
+            objects[0]._state.db if objects else None)
+
+        # Move objects out of the way first, so unique positions don't clash
+        offset = max([o.position or 0 for o in objects] + [len(objects)])
+        for i, o in enumerate(objects, 1):
+            manager.filter(pk=o.pk).update(position=offset + i)
+        for i, o in enumerate(objects, 1):
+            manager.filter(pk=o.pk).update(position=i)
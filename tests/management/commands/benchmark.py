@@ -0,0 +1,73 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tests.benchmarks import benchmarks, regressions
+
+
+class Command(BaseCommand):
+    args = '<benchmark benchmark ...>'
+    help = ('Runs benchmarks of the tests app and prints their results. '
+            'Available benchmarks: {names}. Fails if results regress from '
+            'a baseline.'.format(names=', '.join(sorted(benchmarks))))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--json', action='store_true', dest='json',
+                    default=False,
+                    help='Print results as JSON.'),
+        make_option('--save-baseline', dest='save_baseline', default=None,
+                    help='Save results to given file, as a baseline.'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='Compare results to the baseline in given file.'),
+        make_option('--tolerance', dest='tolerance', type='float',
+                    default=0.25,
+                    help='Fraction by which timings may exceed the '
+                         'baseline (0.25 by default).'),
+    )
+
+    def handle(self, *names, **options):
+        names = names or sorted(benchmarks)
+
+        for name in names:
+            if name not in benchmarks:
+                raise CommandError('Unknown benchmark "%s".' % name)
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CommandError('Cannot read baseline: %s' % e)
+
+        results = dict((name, benchmarks[name]()) for name in names)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.print_tables(names, results)
+
+        if baseline is not None:
+            messages = regressions(baseline, results, options['tolerance'])
+            if messages:
+                raise CommandError('Benchmarks regressed from the '
+                                   'baseline:\n' + '\n'.join(messages))
+
+    def print_tables(self, names, results):
+        for name in names:
+            rows = results[name]
+            self.stdout.write(name)
+            if not rows:
+                continue
+
+            columns = rows[0].keys()
+            self.stdout.write('  '.join('%16s' % column for column in columns))
+            for row in rows:
+                self.stdout.write('  '.join(
+                    '%16.1f' % row[column] if isinstance(row[column], float)
+                    else '%16s' % row[column] for column in columns))
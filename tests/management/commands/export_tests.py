@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tests.models import Test
+from tests.transfer import export_tests
+
+
+class Command(BaseCommand):
+    args = '[test_id test_id ...]'
+    help = ('Exports tests (all of them by default) along with their pages, '
+            'questions, answers and results, as JSON lines, one object per '
+            'line. Objects are streamed, so tests of any size are exported '
+            'in bounded memory.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', '-o', dest='output', default=None,
+                    help='Write to given file, instead of standard output.'),
+    )
+
+    def handle(self, *test_ids, **options):
+        if test_ids:
+            try:
+                test_ids = [int(test_id) for test_id in test_ids]
+            except ValueError:
+                raise CommandError('Test ids must be numbers.')
+            missing = set(test_ids) - set(Test.objects.filter(pk__in=test_ids)
+                                                      .values_list('pk',
+                                                                   flat=True))
+            if missing:
+                raise CommandError('Unknown tests: {tests}.'.format(
+                    tests=', '.join(str(pk) for pk in sorted(missing))))
+        else:
+            test_ids = Test.objects.order_by('pk') \
+                                   .values_list('pk', flat=True).iterator()
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                count = export_tests(test_ids, stream)
+            self.stdout.write('{count} objects exported'.format(count=count))
+        else:
+            export_tests(test_ids, self.stdout)
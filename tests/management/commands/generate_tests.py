@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tests.generator import generate_test
+
+
+class Command(BaseCommand):
+    help = ('Creates synthetic tests, with random answer scores, for '
+            'benchmarks and load testing.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', dest='count', type='int', default=1,
+                    help='Number of tests created.'),
+        make_option('--pages', dest='pages', type='int', default=3,
+                    help='Number of pages of each test.'),
+        make_option('--questions', dest='questions', type='int', default=5,
+                    help='Number of questions on each page.'),
+        make_option('--answers', dest='answers', type='int', default=4,
+                    help='Number of answers of each question.'),
+        make_option('--results', dest='results', type='int', default=3,
+                    help='Number of results of each test.'),
+        make_option('--seed', dest='seed', type='int', default=None,
+                    help='Seed of answer scores, to reproduce tests.'),
+    )
+
+    def handle(self, *args, **options):
+        for option in ('count', 'pages', 'questions', 'answers', 'results'):
+            if options[option] < 1:
+                raise CommandError('%s must be a positive number.' %
+                                   option.capitalize())
+
+        for i in range(options['count']):
+            seed = options['seed'] + i if options['seed'] is not None \
+                else None
+            test = generate_test(options['pages'], options['questions'],
+                                 options['answers'], options['results'],
+                                 seed=seed)
+
+            self.stdout.write('Test {test}: {pages} pages, {questions} '
+                              'questions, {answers} answers'.format(
+                                  test=test.pk, pages=options['pages'],
+                                  questions=options['pages'] *
+                                  options['questions'],
+                                  answers=options['pages'] *
+                                  options['questions'] * options['answers']))
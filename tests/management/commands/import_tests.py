@@ -0,0 +1,52 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from tests.models import Page, Question, Answer, Result
+from tests.transfer import import_tests
+
+
+class Command(BaseCommand):
+    args = '<file file ...>'
+    help = ('Imports tests exported by export_tests, as new tests, from '
+            'given files ("-" for standard input). Objects are created in '
+            'chunks, a test at a time within a transaction, so tests of '
+            'any size are imported in bounded memory.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=500,
+                    help='Number of objects created at once.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('Give files to import tests from.')
+
+        if options['chunk_size'] < 1:
+            raise CommandError('Chunk size must be a positive number.')
+
+        for path in paths:
+            try:
+                stream = sys.stdin if path == '-' else open(path)
+            except IOError as e:
+                raise CommandError('Cannot read {path}: {error}'.format(
+                    path=path, error=e))
+
+            try:
+                for test, counts in import_tests(stream,
+                                                 options['chunk_size']):
+                    self.stdout.write(
+                        'Test {test}: {pages} pages, {questions} questions, '
+                        '{answers} answers, {results} results'.format(
+                            test=test.pk, pages=counts[Page],
+                            questions=counts[Question],
+                            answers=counts[Answer], results=counts[Result]))
+            except (ValueError, DatabaseError) as e:
+                raise CommandError('Cannot import {path}: {error}'.format(
+                    path=path, error=e))
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tests.models import Test
+from tests.blueprints import get_blueprint
+from tests.ranking import compute_distribution, save_distribution
+from tests.routers import database_for_test
+
+
+class Command(BaseCommand):
+    args = '[test_id test_id ...]'
+    help = ('Computes the score distribution of finished attempts of tests, '
+            'used to rank scores on result pages, for the current scoring '
+            'of each test. Run it periodically, and after answer scores '
+            'have changed.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=900,
+                    help='Number of attempts rescored at once (900).'),
+    )
+
+    def handle(self, *test_ids, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('Chunk size must be a positive number.')
+
+        if not test_ids:
+            test_ids = Test.objects.order_by('pk') \
+                                   .values_list('pk', flat=True)
+
+        for test_id in test_ids:
+            try:
+                blueprint = get_blueprint(test_id)
+            except (Test.DoesNotExist, ValueError):
+                raise CommandError('Test "%s" does not exist.' % test_id)
+
+            distribution = compute_distribution(blueprint,
+                                                options['chunk_size'])
+            with transaction.commit_on_success(
+                    using=database_for_test(blueprint.test_id)):
+                save_distribution(distribution)
+
+            self.stdout.write('Test {test}: {attempts} attempts, {scores} '
+                              'distinct scores'.format(
+                                  test=blueprint.test_id,
+                                  attempts=distribution.total,
+                                  scores=len(distribution.scores)))
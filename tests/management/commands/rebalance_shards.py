@@ -0,0 +1,216 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction, IntegrityError
+
+from tests.models import Test, Page, Question, Answer, Result, Attempt, \
+                         AttemptAnswer, ScoreCount, AnswerCount, \
+                         ResultCount, ScoreDistribution
+from tests.attempts import get_attempt_cache, state_key, load_attempt, \
+                           save_attempt
+from tests.routers import primary_database, database_for_test
+
+
+class Command(BaseCommand):
+    args = '[test_id test_id ...]'
+    help = ('Moves tests to the shard they are mapped to, after shards in '
+            'TESTS_SHARD_DATABASES have changed. Tests are moved along with '
+            'their content and attempts, which get new ids on their new '
+            'shard (tests keep theirs); the command is safe to run again '
+            'if interrupted.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=1000,
+                    help='Number of objects copied at once.'),
+        make_option('--drain', action='append', dest='drain', default=[],
+                    help='Also move tests off given database, removed '
+                         'from the shards (may be repeated).'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only list the tests that would be moved.'),
+    )
+
+    # Objects of a test, in the order they are copied, along with the
+    # lookup of their test
+    owned = [
+        (Test, 'pk'),
+        (Page, 'test'),
+        (Question, 'test'),
+        (Answer, 'test'),
+        (Result, 'test'),
+        (Attempt, 'test'),
+        (AttemptAnswer, 'attempt__test'),
+        (ScoreCount, 'test'),
+        (AnswerCount, 'test'),
+        (ResultCount, 'test'),
+        (ScoreDistribution, 'test'),
+    ]
+
+    # Foreign keys of copied objects, to objects copied before them
+    references = {
+        Question: [('page', Page)],
+        Answer: [('question', Question)],
+        Attempt: [('result', Result)],
+        AttemptAnswer: [('attempt', Attempt), ('answer', Answer)],
+        AnswerCount: [('answer', Answer)],
+        ResultCount: [('result', Result)],
+    }
+
+    # Objects referred to by others, inserted one at a time to learn their
+    # new ids (bulk_create doesn't return them)
+    referenced = [Page, Question, Answer, Result, Attempt]
+
+    def handle(self, *test_ids, **options):
+        shards = getattr(settings, 'TESTS_SHARD_DATABASES', ())
+        if not shards:
+            raise CommandError('Tests are not sharded, '
+                               'TESTS_SHARD_DATABASES is empty.')
+
+        if options['chunk_size'] < 1:
+            raise CommandError('Chunk size must be a positive number.')
+
+        if not test_ids:
+            test_ids = Test.objects.order_by('pk') \
+                                   .values_list('pk', flat=True)
+
+        for test_id in test_ids:
+            target = database_for_test(test_id)
+
+            for source in list(shards) + options['drain']:
+                if source == target or not self.holds(test_id, source):
+                    continue
+
+                if options['dry_run']:
+                    self.stdout.write('Test {test}: would be moved from '
+                                      '{source} to {target}'.format(
+                                          test=test_id, source=source,
+                                          target=target))
+                    continue
+
+                try:
+                    self.move(test_id, source, target, options['chunk_size'])
+                except IntegrityError as e:
+                    raise CommandError('Test {test} could not be moved to '
+                                       '{target}: {error}'.format(
+                                           test=test_id, target=target,
+                                           error=e))
+
+                self.stdout.write('Test {test}: moved from {source} to '
+                                  '{target}'.format(test=test_id,
+                                                    source=source,
+                                                    target=target))
+
+    def owned_on(self, using):
+        """
+        Returns the objects of a test kept on given shard; on the primary
+        database, tests are listed and must stay
+        """
+
+        if using == primary_database():
+            return self.owned[1:]
+
+        return self.owned
+
+    def objects(self, model, lookup, test_id, using):
+        return model.objects.using(using).filter(**{lookup: test_id})
+
+    def holds(self, test_id, using):
+        """Checks whether given shard holds any object of a test"""
+
+        return any(self.objects(model, lookup, test_id, using).exists()
+                   for model, lookup in self.owned_on(using))
+
+    def save_attempts(self, test_id, source):
+        """
+        Writes the attempts of a test in progress from the attempt store to
+        given shard, so they are copied as they are; returns their ids
+        """
+
+        cache = get_attempt_cache()
+        attempt_ids = list(Attempt.objects.using(source)
+                                          .filter(test=test_id,
+                                                  status=Attempt.ACTIVE)
+                                          .values_list('pk', flat=True))
+
+        with transaction.commit_on_success(using=source):
+            for attempt_id in attempt_ids:
+                state = cache.get(state_key(attempt_id))
+                # Ids of other shards may share the same state
+                if state is not None and state['test_id'] == test_id:
+                    save_attempt(load_attempt(attempt_id, source))
+
+        return attempt_ids
+
+    def move(self, test_id, source, target, chunk_size):
+        """
+        Copies a test from source to target shard, then deletes it from
+        source. The copy is committed first, so that an interrupted move
+        leaves the test on both shards rather than on none.
+
+        Shards allocate ids on their own, so copied objects get new ids on
+        target, and their references are remapped; takers of attempts in
+        progress start them over.
+        """
+
+        attempt_ids = self.save_attempts(test_id, source)
+
+        # New ids of referenced objects, by model and source id
+        ids = dict((model, {}) for model in self.referenced)
+
+        with transaction.commit_on_success(using=target):
+            # Drop what an interrupted move may have left; the test itself
+            # is kept, as it is copied to the shard whenever it is saved
+            for model, lookup in reversed(self.owned[1:]):
+                self.objects(model, lookup, test_id, target).delete()
+
+            for model, lookup in self.owned:
+                if model is Test and \
+                   self.objects(model, lookup, test_id, target).exists():
+                    continue
+
+                # Copy objects in chunks, ordered by id
+                last = 0
+                while True:
+                    chunk = list(self.objects(model, lookup, test_id, source)
+                                     .filter(pk__gt=last)
+                                     .order_by('pk')[:chunk_size])
+                    if not chunk:
+                        break
+                    last = chunk[-1].pk
+
+                    if model is Test:
+                        model.objects.using(target).bulk_create(chunk)
+                        continue
+
+                    for obj in chunk:
+                        for field, referred in self.references.get(model,
+                                                                   ()):
+                            attname = model._meta.get_field(field).attname
+                            if getattr(obj, attname) is not None:
+                                setattr(obj, attname,
+                                        ids[referred][getattr(obj, attname)])
+
+                        source_id, obj.pk = obj.pk, None
+                        if model in self.referenced:
+                            # Saved as is, without the bookkeeping of
+                            # the model's save()
+                            models.Model.save(obj, using=target,
+                                              force_insert=True)
+                            ids[model][source_id] = obj.pk
+
+                    if model not in self.referenced:
+                        model.objects.using(target).bulk_create(chunk)
+
+        with transaction.commit_on_success(using=source):
+            for model, lookup in reversed(self.owned_on(source)):
+                self.objects(model, lookup, test_id, source).delete()
+
+        # Drop the state of moved attempts, unless it is that of another
+        # shard's attempt with the same id
+        cache = get_attempt_cache()
+        for attempt_id in attempt_ids:
+            state = cache.get(state_key(attempt_id))
+            if state is not None and state['test_id'] == test_id:
+                cache.delete(state_key(attempt_id))
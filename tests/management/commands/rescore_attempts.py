@@ -0,0 +1,97 @@
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tests.models import Test, Attempt, AttemptAnswer
+from tests.blueprints import get_blueprint
+from tests.routers import database_for_test
+
+
+class Command(BaseCommand):
+    args = '[test_id test_id ...]'
+    help = ('Recomputes score and result of stored attempts, after answer '
+            'scores or result limits have changed.')
+
+    # Attempts of a chunk are looked up with a single IN, kept within the
+    # number of parameters SQLite accepts (999 before 3.32)
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=900,
+                    help='Number of attempts scored at once (900).'),
+    )
+
+    def handle(self, *test_ids, **options):
+        try:
+            from tests import scoring
+        except ImportError:
+            raise CommandError('NumPy is required to rescore attempts.')
+
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('Chunk size must be a positive number.')
+
+        if not test_ids:
+            test_ids = Test.objects.order_by('pk') \
+                                   .values_list('pk', flat=True)
+
+        for test_id in test_ids:
+            try:
+                blueprint = get_blueprint(test_id)
+            except (Test.DoesNotExist, ValueError):
+                raise CommandError('Test "%s" does not exist.' % test_id)
+
+            using = database_for_test(blueprint.test_id)
+            scored = changed = 0
+            last = 0
+
+            while True:
+                # Stream attempts in chunks, ordered by id
+                chunk = list(Attempt.objects.using(using)
+                                            .filter(test__pk=blueprint.test_id,
+                                                    status=Attempt.FINISHED,
+                                                    pk__gt=last)
+                                            .order_by('pk')
+                                            .values_list('pk', 'score',
+                                                         'result')
+                                            [:chunk_size])
+                if not chunk:
+                    break
+                last = chunk[-1][0]
+
+                answers = defaultdict(list)
+                for attempt, answer in AttemptAnswer.objects.using(using) \
+                        .filter(attempt__in=[row[0] for row in chunk]) \
+                        .values_list('attempt', 'answer'):
+                    answers[attempt].append(answer)
+
+                outcomes = scoring.outcomes(
+                    blueprint, [answers[row[0]] for row in chunk])
+
+                # Group changed attempts by their new outcome, so that each
+                # outcome is written with a single UPDATE
+                updates = defaultdict(list)
+                for row, outcome in zip(chunk, outcomes):
+                    if row[1:] != outcome:
+                        updates[outcome].append(row[0])
+
+                attempts = Attempt.objects.using(using)
+                version = blueprint.scoring_version
+                with transaction.commit_on_success(using=using):
+                    for (score, result), ids in updates.iteritems():
+                        attempts.filter(pk__in=ids).update(
+                            score=score, result=result,
+                            scoring_version=version)
+                    # Unchanged attempts are now scored on this scoring too
+                    attempts.filter(pk__in=[row[0] for row in chunk]) \
+                            .exclude(scoring_version=version) \
+                            .update(scoring_version=version)
+
+                scored += len(chunk)
+                changed += sum(len(ids) for ids in updates.itervalues())
+
+            self.stdout.write('Test {test}: {scored} attempts scored, '
+                              '{changed} changed'.format(
+                                  test=blueprint.test_id, scored=scored,
+                                  changed=changed))
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tests.models import Test
+from tests.warmup import warm_up, max_rss
+
+
+class Command(BaseCommand):
+    args = '[test_id test_id ...]'
+    help = ('Loads the blueprints of given tests, or of the most taken '
+            'tests, along with the markup of their pages, as servers do '
+            'before forking workers, and reports the time and memory they '
+            'take.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--no-markup', action='store_false', dest='markup',
+                    default=True,
+                    help='Do not render the markup of test pages.'),
+    )
+
+    def handle(self, *test_ids, **options):
+        rss = max_rss()
+
+        try:
+            rows = warm_up(test_ids or None, markup=options['markup'])
+        except (Test.DoesNotExist, ValueError):
+            raise CommandError('Tests {tests} do not all exist.'.format(
+                tests=', '.join(test_ids)))
+
+        for row in rows:
+            self.stdout.write('Test {test}: {pages} pages, {answers} '
+                              'answers, {kb:.1f} KB in {ms:.1f} ms'.format(
+                                  kb=row['bytes'] / 1024.0, **row))
+
+        self.stdout.write('{count} tests: {kb:.1f} KB in {ms:.1f} ms'.format(
+            count=len(rows),
+            kb=sum(row['bytes'] for row in rows) / 1024.0,
+            ms=sum(row['ms'] for row in rows)))
+        if rss is not None:
+            self.stdout.write('Peak resident memory: {before} KB before, '
+                              '{after} KB after'.format(before=rss,
+                                                        after=max_rss()))
@@ -1,4 +1,15 @@
-from django.db import models
+from django.db import models, router, connections, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from routers import primary_database, database_for_test
+
+
+def next_position(queryset):
+    """Returns the position following the last one within given queryset"""
+
+    last = queryset.aggregate(models.Max('position'))['position__max']
+    return (last or 0) + 1
 
 
 class Test(models.Model):
@@ -12,6 +23,27 @@ class Test(models.Model):
 class Page(models.Model):
     name = models.CharField(max_length=50)
     test = models.ForeignKey(Test, related_name='pages')
+    # Left blank, pages are added after the test's last page
+    position = models.PositiveIntegerField(blank=True)
+
+    class Meta:
+        ordering = ['position']
+        unique_together = [('test', 'position')]
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(Page, instance=self)
+        if self.position is None:
+            self.position = next_position(
+                Page.objects.using(using).filter(test=self.test))
+
+        super(Page, self).save(*args, **kwargs)
+
+        # Keep the test of questions and answers in sync, if the page has
+        # been moved to another test
+        Question.objects.using(using).filter(page=self) \
+                        .exclude(test=self.test).update(test=self.test)
+        Answer.objects.using(using).filter(question__page=self) \
+                      .exclude(test=self.test).update(test=self.test)
 
     def __unicode__(self):
         return '{name} (from Test: {test})'.format(name=self.name,
@@ -21,6 +53,29 @@ class Page(models.Model):
 class Question(models.Model):
     name = models.CharField(max_length=100)
     page = models.ForeignKey(Page, related_name='questions')
+    # Left blank, questions are added after the page's last question
+    position = models.PositiveIntegerField(blank=True)
+    # Denormalized from page, so test questions are fetched without joins
+    test = models.ForeignKey(Test, related_name='questions', editable=False)
+
+    class Meta:
+        ordering = ['position']
+        unique_together = [('page', 'position')]
+
+    def save(self, *args, **kwargs):
+        self.test_id = self.page.test_id
+        using = kwargs.get('using') or \
+            router.db_for_write(Question, instance=self)
+        if self.position is None:
+            self.position = next_position(
+                Question.objects.using(using).filter(page=self.page))
+
+        super(Question, self).save(*args, **kwargs)
+
+        # Keep the test of answers in sync, if the question has been moved
+        # to another page
+        Answer.objects.using(using).filter(question=self) \
+                      .exclude(test=self.test).update(test=self.test)
 
     def __unicode__(self):
         return self.name
@@ -30,15 +85,200 @@ class Answer(models.Model):
     name = models.CharField(max_length=100)
     score = models.IntegerField()
     question = models.ForeignKey(Question, related_name='answers')
+    # Denormalized from question, so test answers are fetched without joins
+    test = models.ForeignKey(Test, related_name='answers', editable=False)
+
+    def save(self, *args, **kwargs):
+        self.test_id = self.question.test_id
+
+        super(Answer, self).save(*args, **kwargs)
 
     def __unicode__(self):
         return self.name
 
 
+def set_answer_scores(test_id, scores, using=None):
+    """
+    Sets scores of answers of a test, given as scores keyed by answer id,
+    with UPDATEs of as many answers as the database accepts parameters for
+    (CASE on answer id); a single UPDATE on most databases, one per 332
+    answers on SQLite. Answers of other tests are left alone. Returns the
+    number of answers updated.
+
+    As no save signals are sent, the caller drops the test's blueprint.
+    """
+
+    using = using or database_for_test(test_id) or \
+        router.db_for_write(Answer)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    updated = 0
+    scores = sorted(scores.items())
+
+    # Keep within the number of parameters SQLite accepts (999 before
+    # 3.32), with three parameters per answer and one for the test
+    if connection.vendor == 'sqlite':
+        chunk_size = (999 - 1) // 3
+    else:
+        chunk_size = max(len(scores), 1)
+
+    with transaction.commit_on_success(using=using):
+        for start in range(0, len(scores), chunk_size):
+            chunk = scores[start:start + chunk_size]
+
+            params = []
+            for answer_id, score in chunk:
+                params.extend([int(answer_id), int(score)])
+            params.append(test_id)
+            params.extend(int(answer_id) for answer_id, score in chunk)
+
+            cursor = connection.cursor()
+            cursor.execute(
+                'UPDATE {table} SET {score} = CASE {id} {cases} END '
+                'WHERE {test} = %s AND {id} IN ({ids})'.format(
+                    table=qn(Answer._meta.db_table),
+                    score=qn(Answer._meta.get_field('score').column),
+                    id=qn(Answer._meta.pk.column),
+                    test=qn(Answer._meta.get_field('test').column),
+                    cases=' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                    ids=', '.join(['%s'] * len(chunk))),
+                params)
+            updated += cursor.rowcount
+
+    return updated
+
+
 class Result(models.Model):
     text = models.CharField(max_length=100)
     limit = models.IntegerField()
     test = models.ForeignKey(Test, related_name='results')
 
+    class Meta:
+        # Results are looked up by test and score
+        index_together = [('test', 'limit')]
+
     def __unicode__(self):
         return self.text
+
+
+class Attempt(models.Model):
+    ACTIVE = 'active'
+    FINISHED = 'finished'
+    GIVEN_UP = 'given_up'
+    STATUS_CHOICES = (
+        (ACTIVE, 'Active'),
+        (FINISHED, 'Finished'),
+        (GIVEN_UP, 'Given up'),
+    )
+
+    test = models.ForeignKey(Test, related_name='attempts')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=ACTIVE)
+    page_number = models.PositiveIntegerField(default=1)
+    # Checked answers, encoded for the test version they were checked on
+    # (answers are also stored one per row, in AttemptAnswer)
+    checked = models.TextField(blank=True)
+    checked_version = models.CharField(max_length=32, blank=True)
+    # Score and result are set once the attempt is finished, along with
+    # the scoring of the test (Blueprint.scoring_version) they are for
+    score = models.IntegerField(null=True, blank=True)
+    result = models.ForeignKey(Result, related_name='attempts',
+                               null=True, blank=True,
+                               on_delete=models.SET_NULL)
+    scoring_version = models.CharField(max_length=32, blank=True)
+
+    class Meta:
+        index_together = [('test', 'status')]
+
+    def __unicode__(self):
+        return '{status} attempt (from Test: {test})'.format(
+            status=self.get_status_display(), test=self.test.name)
+
+
+class AttemptAnswer(models.Model):
+    attempt = models.ForeignKey(Attempt, related_name='answers')
+    answer = models.ForeignKey(Answer, related_name='attempts')
+
+    def __unicode__(self):
+        return self.answer.name
+
+
+class ScoreCount(models.Model):
+    """Number of attempts of a test finished with a score"""
+
+    test = models.ForeignKey(Test, related_name='score_counts')
+    score = models.IntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('test', 'score')]
+
+
+class AnswerCount(models.Model):
+    """Number of finished attempts of a test in which an answer was picked"""
+
+    test = models.ForeignKey(Test, related_name='answer_counts')
+    answer = models.ForeignKey(Answer, related_name='counts')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('test', 'answer')]
+
+
+class ResultCount(models.Model):
+    """Number of attempts of a test finished with a result"""
+
+    test = models.ForeignKey(Test, related_name='result_counts')
+    result = models.ForeignKey(Result, related_name='counts')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('test', 'result')]
+
+
+class ScoreDistribution(models.Model):
+    """
+    Scores of the finished attempts of a test, for the scoring of the test
+    (Blueprint.scoring_version) they were computed on
+    """
+
+    test = models.OneToOneField(Test, related_name='score_distribution')
+    version = models.CharField(max_length=32)
+    # Distinct scores, ascending, and the number of attempts scoring each,
+    # as comma separated values
+    scores = models.TextField(blank=True)
+    counts = models.TextField(blank=True)
+
+
+def shard_copy(test):
+    """Returns an (unsaved) copy of a test, to be saved on its shard"""
+
+    return Test(**dict((field.attname, getattr(test, field.attname))
+                       for field in Test._meta.fields))
+
+
+@receiver(post_save, sender=Test)
+def copy_test(sender, instance, using, **kwargs):
+    """
+    Copies a test saved on the primary database to its shard, if any,
+    unless the caller copies it (copy_to_shard set to False)
+    """
+
+    shard = database_for_test(instance.pk)
+    if shard is None or using != primary_database() or shard == using:
+        return
+
+    if getattr(instance, 'copy_to_shard', True):
+        shard_copy(instance).save(using=shard)
+
+
+@receiver(post_delete, sender=Test)
+def delete_test(sender, instance, using, **kwargs):
+    """Deletes a test deleted from the primary database from its shard"""
+
+    shard = database_for_test(instance.pk)
+    if shard is None or using != primary_database() or shard == using:
+        return
+
+    Test.objects.using(shard).filter(pk=instance.pk).delete()
@@ -0,0 +1,205 @@
+"""
+Profiling of the tests app views.
+
+When ProfilingMiddleware is enabled, each request to a view of the app is
+broken down in named spans (session, blueprint, form, scoring,
+suggestions, render...) and the queries it ran on each database are
+counted. Durations and counts are kept in rolling histograms of the last
+TESTS_PROFILING_WINDOW samples (1000 by default), per view, within this
+process; they are shown to staff by the profile view, also as JSON.
+"""
+
+import math
+import threading
+import timeit
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+
+# Profile of the request being handled, if it is profiled
+state = threading.local()
+
+
+class Histogram(object):
+    """Rolling histogram of the last samples of a value"""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, values, percent):
+        """Returns the given percentile of sorted values (nearest rank)"""
+
+        rank = int(math.ceil(percent / 100.0 * len(values)))
+        return values[max(rank, 1) - 1]
+
+    def summary(self):
+        """Describes the samples of the histogram"""
+
+        values = sorted(self.samples)
+        if not values:
+            return {'count': self.count}
+
+        return {
+            'count': self.count,
+            'mean': sum(values) / float(len(values)),
+            'p50': self.percentile(values, 50),
+            'p90': self.percentile(values, 90),
+            'p99': self.percentile(values, 99),
+            'max': values[-1],
+        }
+
+
+class Stats(object):
+    """Histograms of span durations and query counts, per view"""
+
+    def __init__(self):
+        self.views = {}
+        self.lock = threading.Lock()
+
+    @property
+    def window(self):
+        return getattr(settings, 'TESTS_PROFILING_WINDOW', 1000)
+
+    def add(self, view, profile):
+        """Adds the durations and query counts of a request profile"""
+
+        with self.lock:
+            histograms = self.views.setdefault(view, {'spans': {},
+                                                      'queries': {}})
+            for kind in ('spans', 'queries'):
+                for name, value in getattr(profile, kind).iteritems():
+                    histogram = histograms[kind].get(name)
+                    if histogram is None:
+                        histogram = histograms[kind][name] = \
+                            Histogram(self.window)
+                    histogram.add(value)
+
+    def snapshot(self):
+        """
+        Describes the histograms of each view, spans in milliseconds
+        e.g.: {'result': {'spans': {'total': {'count': 10, 'p50': 4.2, ...},
+                                    'render': {...}},
+                          'queries': {'default': {'count': 10, ...}}}}
+        """
+
+        with self.lock:
+            return dict(
+                (view, dict((kind, dict((name, histogram.summary())
+                                        for name, histogram
+                                        in histograms[kind].iteritems()))
+                            for kind in histograms))
+                for view, histograms in self.views.iteritems())
+
+    def clear(self):
+        with self.lock:
+            self.views.clear()
+
+
+stats = Stats()
+
+
+class Profile(object):
+    """Span durations (in milliseconds) and query counts of a request"""
+
+    def __init__(self):
+        self.spans = {}
+        self.queries = {}
+        self.query_offsets = dict((connection.alias, len(connection.queries))
+                                  for connection in connections.all())
+
+    def add_span(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0) + duration * 1e3
+
+    def count_queries(self):
+        """Counts queries run on each database since the profile started"""
+
+        for connection in connections.all():
+            count = len(connection.queries) - \
+                self.query_offsets.get(connection.alias, 0)
+            if count > 0:
+                self.queries[connection.alias] = count
+
+
+@contextmanager
+def span(name):
+    """
+    Times the enclosed code as a span of the request being profiled, if
+    any; spans with the same name add up
+    """
+
+    profile = getattr(state, 'profile', None)
+    if profile is None:
+        yield
+        return
+
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        profile.add_span(name, timeit.default_timer() - start)
+
+
+def profiled(name):
+    """Decorator timing calls of a function as spans with given name"""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles requests to views of the tests app. Queries are counted with
+    debug cursors, which keep the SQL of each query for the duration of
+    the request.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state.profile = None
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None or match.namespace != 'tests' or \
+           match.url_name == 'profile':
+            return None
+
+        state.debug_cursors = dict(
+            (connection.alias, connection.use_debug_cursor)
+            for connection in connections.all())
+        for connection in connections.all():
+            connection.use_debug_cursor = True
+
+        state.view = match.url_name
+        state.profile = Profile()
+        state.start = timeit.default_timer()
+
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(state, 'profile', None)
+        if profile is None:
+            return response
+
+        profile.add_span('total', timeit.default_timer() - state.start)
+        profile.count_queries()
+        stats.add(state.view, profile)
+
+        for connection in connections.all():
+            connection.use_debug_cursor = state.debug_cursors.get(
+                connection.alias)
+        state.profile = None
+
+        return response
@@ -0,0 +1,166 @@
+"""
+Percentile ranking of scores among finished attempts.
+
+The scores of a test's finished attempts are kept as a cumulative
+distribution: distinct scores, ascending, along with the number of
+attempts scoring at most each of them. The share of attempts scoring below
+a score is then found by bisecting the scores, without counting attempts.
+
+Distributions are computed by the rank_tests command, for the current
+scoring of a test (its answers, their scores and result limits), rescoring
+attempts checked on previous versions, and stored in the database and the
+cache. A distribution is only used for the scoring it has been computed
+on, so that it never ranks a score against scores of answers that have
+changed since; other edits of the test, e.g. of names, keep it.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple, Counter, defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from models import Attempt, AttemptAnswer, ScoreDistribution
+from routers import database_for_test
+
+
+class Distribution(namedtuple('Distribution', [
+        'test_id', 'version',
+        # Distinct scores, ascending, and the number of attempts scoring at
+        # most each of them
+        'scores', 'cumulative'])):
+    """Cumulative distribution of the scores of a test's attempts"""
+
+    __slots__ = ()
+
+    @property
+    def total(self):
+        return self.cumulative[-1] if self.cumulative else 0
+
+    def better_than(self, score):
+        """
+        Returns the percentage of attempts with a lower score than given
+        one, or None if there are no attempts
+        """
+
+        if not self.total:
+            return None
+
+        index = bisect_left(self.scores, score)
+        below = self.cumulative[index - 1] if index else 0
+
+        return 100.0 * below / self.total
+
+
+def distribution_key(test_id, version):
+    return 'tests:ranking:{test}:{version}'.format(test=test_id,
+                                                   version=version)
+
+
+def make_distribution(blueprint, counts):
+    """Returns the distribution of given counts of attempts by score"""
+
+    scores = array('l', sorted(counts))
+    cumulative = array('l')
+    total = 0
+    for score in scores:
+        total += counts[score]
+        cumulative.append(total)
+
+    return Distribution(blueprint.test_id, blueprint.scoring_version, scores,
+                        cumulative)
+
+
+def compute_distribution(blueprint, chunk_size=900):
+    """
+    Computes the distribution of the scores of a test's finished attempts,
+    for the test's current scoring. Scores of attempts scored on the
+    current scoring are counted as stored, while other attempts are
+    rescored from their answers, in chunks (looked up with a single IN,
+    kept within the number of parameters SQLite accepts).
+    """
+
+    using = database_for_test(blueprint.test_id)
+    attempts = Attempt.objects.using(using).filter(
+        test=blueprint.test_id, status=Attempt.FINISHED)
+    current = Q(scoring_version=blueprint.scoring_version,
+                score__isnull=False)
+
+    counts = Counter(dict(
+        attempts.filter(current)
+                .order_by()
+                .values('score')
+                .annotate(count=Count('pk'))
+                .values_list('score', 'count')))
+
+    stale = attempts.exclude(current).order_by('pk')
+    last = 0
+    while True:
+        chunk = list(stale.filter(pk__gt=last)
+                          .values_list('pk', flat=True)[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1]
+
+        answers = defaultdict(list)
+        for attempt, answer in AttemptAnswer.objects.using(using) \
+                .filter(attempt__in=chunk) \
+                .values_list('attempt', 'answer'):
+            answers[attempt].append(answer)
+
+        counts.update(blueprint.score(blueprint.positions(answers[attempt]))
+                      for attempt in chunk)
+
+    return make_distribution(blueprint, counts)
+
+
+def save_distribution(distribution):
+    """Stores a distribution, replacing the previous one of its test"""
+
+    using = database_for_test(distribution.test_id)
+    counts = [count - previous for count, previous in zip(
+        distribution.cumulative, [0] + list(distribution.cumulative))]
+
+    ScoreDistribution.objects.using(using) \
+                             .filter(test=distribution.test_id).delete()
+    ScoreDistribution.objects.using(using).create(
+        test_id=distribution.test_id, version=distribution.version,
+        scores=','.join(str(score) for score in distribution.scores),
+        counts=','.join(str(count) for count in counts))
+
+    cache.set(distribution_key(distribution.test_id, distribution.version),
+              distribution)
+
+
+def parse_values(values):
+    """Returns the numbers in given comma separated values"""
+
+    return [int(value) for value in values.split(',') if value]
+
+
+def get_distribution(blueprint):
+    """
+    Returns the stored distribution of a test, if it has been computed for
+    the test's current scoring, or None
+    """
+
+    key = distribution_key(blueprint.test_id, blueprint.scoring_version)
+    distribution = cache.get(key)
+    if distribution is not None:
+        # Missing distributions are cached as empty tuples
+        return distribution or None
+
+    try:
+        stored = ScoreDistribution.objects \
+            .using(database_for_test(blueprint.test_id)) \
+            .get(test=blueprint.test_id, version=blueprint.scoring_version)
+    except ScoreDistribution.DoesNotExist:
+        cache.set(key, ())
+        return None
+
+    distribution = make_distribution(blueprint, dict(
+        zip(parse_values(stored.scores), parse_values(stored.counts))))
+    cache.set(key, distribution)
+
+    return distribution
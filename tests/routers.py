@@ -1,3 +1,13 @@
+import hashlib
+import random
+import threading
+import time
+from bisect import bisect
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
 class MasterSlaveRouter(object):
     def db_for_read(self, model, **hints):
         return 'slave'
@@ -14,3 +24,242 @@ class MasterSlaveRouter(object):
 
     def allow_syncdb(self, db, model):
         return True
+
+
+# Routing state of the request being handled, set by PinningMiddleware;
+# outside requests, reads are not pinned to the primary
+state = threading.local()
+
+
+def start_request(pinned=False):
+    """
+    Starts routing a request, whose reads go to the primary if pinned, or
+    once it writes
+    """
+
+    state.active = True
+    state.pinned = pinned
+    state.wrote = False
+
+
+def end_request():
+    """Ends routing a request; returns whether it wrote"""
+
+    wrote = getattr(state, 'active', False) and state.wrote
+    state.active = state.pinned = state.wrote = False
+
+    return wrote
+
+
+@contextmanager
+def request_scope(pinned=False):
+    """Routes the enclosed code as a request, e.g. a background job"""
+
+    start_request(pinned)
+    try:
+        yield
+    finally:
+        end_request()
+
+# Replicas marked as unhealthy, within this process
+unhealthy = set()
+
+
+def mark_unhealthy(alias):
+    """Stops reading from given replica"""
+
+    unhealthy.add(alias)
+
+
+def mark_healthy(alias):
+    """Resumes reading from given replica"""
+
+    unhealthy.discard(alias)
+
+
+def primary_database():
+    """Returns the database writes go to (TESTS_PRIMARY_DATABASE)"""
+
+    return getattr(settings, 'TESTS_PRIMARY_DATABASE', 'default')
+
+
+class ReplicaRouter(object):
+    """
+    Routes writes to the primary database (TESTS_PRIMARY_DATABASE) and
+    reads to a replica (TESTS_REPLICA_DATABASES, mapping aliases to
+    weights), picked at random by weight among healthy replicas. Reads go
+    to the primary when no replica is healthy, once the request has
+    written, or when the request is pinned to it by PinningMiddleware.
+    Writes outside requests (see request_scope) don't pin reads.
+    """
+
+    @property
+    def primary(self):
+        return primary_database()
+
+    @property
+    def replicas(self):
+        return getattr(settings, 'TESTS_REPLICA_DATABASES', {})
+
+    def db_for_read(self, model, **hints):
+        # Replicas may not have caught up with writes of this request yet
+        if getattr(state, 'active', False) and (state.pinned or state.wrote):
+            return self.primary
+
+        replicas = [(alias, weight)
+                    for alias, weight in sorted(self.replicas.items())
+                    if weight > 0 and alias not in unhealthy]
+        if not replicas:
+            return self.primary
+
+        pick = random.uniform(0, sum(weight for alias, weight in replicas))
+        for alias, weight in replicas:
+            pick -= weight
+            if pick <= 0:
+                return alias
+        return replicas[-1][0]
+
+    def db_for_write(self, model, **hints):
+        if getattr(state, 'active', False):
+            state.wrote = True
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        dbs = [self.primary] + list(self.replicas)
+        if obj1._state.db in dbs and \
+           obj2._state.db in dbs:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        return True
+
+
+class PinningMiddleware(object):
+    """
+    Pins reads of a client to the primary database for TESTS_PIN_SECONDS
+    after a request of the client wrote to the database, so that it reads
+    its own writes despite replication lag. The end of the pin is kept in
+    a cookie.
+    """
+
+    cookie_name = 'tests_pinned_until'
+
+    def process_request(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            pinned_until = 0
+
+        start_request(pinned=pinned_until > time.time())
+
+    def process_response(self, request, response):
+        if end_request():
+            seconds = getattr(settings, 'TESTS_PIN_SECONDS', 5)
+            response.set_cookie(self.cookie_name, str(time.time() + seconds),
+                                max_age=seconds, httponly=True)
+
+        return response
+
+
+def ring_hash(key):
+    """Returns the position of given key on a hash ring"""
+
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing ring, mapping keys to nodes. Each node is placed at
+    several points of the ring, and a key belongs to the node at the first
+    point following it; adding or removing a node only moves the keys of
+    that node.
+    """
+
+    def __init__(self, nodes, points=64):
+        self.points = sorted(
+            (ring_hash('{node}:{point}'.format(node=node, point=point)), node)
+            for node in nodes for point in range(points))
+        self.hashes = [position for position, node in self.points]
+
+    def node(self, key):
+        index = bisect(self.hashes, ring_hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+
+# Hash rings, keyed by the shards they map to
+rings = {}
+
+
+def database_for_test(test_id):
+    """
+    Returns the shard holding the content of given test, mapped from its id
+    on a hash ring of TESTS_SHARD_DATABASES, or None if tests aren't sharded
+    """
+
+    shards = tuple(getattr(settings, 'TESTS_SHARD_DATABASES', ()))
+    if not shards or test_id is None:
+        return None
+
+    ring = rings.get(shards)
+    if ring is None:
+        ring = rings[shards] = HashRing(shards)
+
+    return ring.node(int(test_id))
+
+
+class ShardRouter(object):
+    """
+    Routes objects of the tests app to the shard of the test they belong
+    to (see database_for_test). Tests themselves are kept on the primary
+    database, which lists them and allocates their ids, and are copied to
+    their shard so that relations hold there. Queries that don't go through
+    an object (e.g. Page.objects.filter(test=test)) must pick their shard
+    with database_for_test.
+    """
+
+    def is_test(self, model):
+        return model._meta.app_label == 'tests' and \
+            model._meta.object_name == 'Test'
+
+    def shard_of(self, obj):
+        """Returns the shard of given object, or None if it is unknown"""
+
+        if self.is_test(obj):
+            return database_for_test(obj.pk)
+        if obj._state.db is not None:
+            return obj._state.db
+
+        # Answers of attempts belong to the test of their attempt; it is
+        # only used if already loaded, as loading it is routed here
+        attempt = getattr(obj, '_attempt_cache', None)
+        if attempt is not None:
+            return self.shard_of(attempt)
+
+        return database_for_test(getattr(obj, 'test_id', None))
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'tests':
+            return None
+        if self.is_test(model):
+            return primary_database()
+
+        instance = hints.get('instance')
+        if instance is None or instance._meta.app_label != 'tests':
+            return None
+
+        return self.shard_of(instance)
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label != 'tests' or \
+           obj2._meta.app_label != 'tests':
+            return None
+
+        shard1 = self.shard_of(obj1)
+        shard2 = self.shard_of(obj2)
+        if shard1 is None or shard2 is None:
+            return None
+
+        return shard1 == shard2
@@ -0,0 +1,56 @@
+"""
+Batch scoring of stored attempts.
+
+Attempts are encoded as a boolean matrix, with one row per attempt and one
+column per answer of the test (in blueprint order), so that scores are
+computed as a single matrix-vector product and results are found with a
+vectorized search over sorted result limits. Requires NumPy.
+"""
+
+import numpy
+
+
+def encode(blueprint, attempts):
+    """
+    Returns the answer matrix of given attempts, each one being a list of
+    checked answer ids. Answers no longer in the test are ignored.
+    """
+
+    matrix = numpy.zeros((len(attempts), len(blueprint.answer_ids)),
+                         dtype=bool)
+
+    for row, answer_ids in enumerate(attempts):
+        columns = [blueprint.answer_positions[answer_id]
+                   for answer_id in answer_ids
+                   if answer_id in blueprint.answer_positions]
+        matrix[row, columns] = True
+
+    return matrix
+
+
+def scores(blueprint, matrix):
+    """Returns the score of each attempt in given answer matrix"""
+
+    return matrix.dot(numpy.asarray(blueprint.answer_scores,
+                                    dtype=numpy.int64))
+
+
+def results(blueprint, scores):
+    """
+    Returns the result id of each given score, or None for scores below
+    all result limits.
+    """
+
+    limits = numpy.asarray(blueprint.result_limits, dtype=numpy.int64)
+    indexes = numpy.searchsorted(limits, scores, side='right') - 1
+
+    return [blueprint.result_ids[index] if index >= 0 else None
+            for index in indexes.tolist()]
+
+
+def outcomes(blueprint, attempts):
+    """Returns (score, result id) of each given attempt"""
+
+    attempt_scores = scores(blueprint, encode(blueprint, attempts))
+
+    return zip(attempt_scores.tolist(), results(blueprint, attempt_scores))
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -13,7 +16,59 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         #'NAME': '/home/andrei/training.db',
-    }
+    },
+    # Stand-ins for read replicas, used by ReplicaRouter tests
+    'replica1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
+    'replica2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
+    # Shards of ShardRouter tests, kept in files
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'shard1.db'),
+        'TEST_NAME': os.path.join(tempfile.gettempdir(), 'test_shard1.db'),
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'shard2.db'),
+        'TEST_NAME': os.path.join(tempfile.gettempdir(), 'test_shard2.db'),
+    },
+}
+
+# Read replicas of ReplicaRouter, mapped to their weight (the router is not
+# enabled here; add it to DATABASE_ROUTERS to spread reads over replicas)
+TESTS_PRIMARY_DATABASE = 'default'
+TESTS_REPLICA_DATABASES = {
+    'replica1': 2,
+    'replica2': 1,
 }
 
+# Shards of ShardRouter, holding tests by id; not set here, as tests are
+# only sharded by ShardRouter tests
+#TESTS_SHARD_DATABASES = ['shard1', 'shard2']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'suggestions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'suggestions',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+TESTS_SUGGESTIONS_CACHE = 'suggestions'
+
+# Tests run in a single process, so attempts are kept in a local cache
+TESTS_ATTEMPT_CACHE_LOCAL = True
+
+# Result pages find suggestions inline, unless tests say otherwise
+TESTS_ASYNC_SUGGESTIONS = False
+
 ROOT_URLCONF = 'tests.urls'
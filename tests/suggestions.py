@@ -0,0 +1,470 @@
+"""
+Suggestion engine used by the result view.
+
+Given the unchecked answers of a test, finds the smallest set of them whose
+summed up score reaches a threshold, with the rule that all answers picked
+on the same page must belong to a single question. Among the smallest sets,
+the first one in combination order is returned, so results are the same as
+walking through all combinations of answers, without being exponential.
+
+Suggestions are cached by test version and checked answers, as many takers
+check the same answers.
+"""
+
+import hashlib
+import logging
+import time
+from collections import defaultdict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Marks an amount of answers that cannot be picked
+UNREACHABLE = float('-inf')
+
+
+def page_gains(questions, limit):
+    """
+    Returns the best gains for picking 0, 1, ..., limit answers from a page,
+    given the weights of each of the page's questions answers.
+    """
+
+    gains = [0]
+
+    for weights in questions:
+        total = 0
+        for count, weight in enumerate(sorted(weights, reverse=True)[:limit],
+                                       1):
+            total += weight
+            if count == len(gains):
+                gains.append(total)
+            elif total > gains[count]:
+                gains[count] = total
+
+    return gains
+
+
+def best_totals(pages, size, exhausted=None):
+    """
+    Returns the best total weights for picking exactly 0, 1, ..., size
+    answers, given the gains of each page (knapsack over pages). Returns
+    None if exhausted (a callable) returns True before all pages are done.
+    """
+
+    totals = [0] + [UNREACHABLE] * size
+
+    for gains in pages:
+        if exhausted is not None and exhausted():
+            return None
+        merged = list(totals)
+        for picked, total in enumerate(totals):
+            if total == UNREACHABLE:
+                continue
+            for count in range(1, min(len(gains), size - picked + 1)):
+                if total + gains[count] > merged[picked + count]:
+                    merged[picked + count] = total + gains[count]
+        totals = merged
+
+    return totals
+
+
+def group_weights(items, start=0, fixed=None):
+    """
+    Groups weights of items from position start onwards by page and
+    question, skipping items whose page is fixed to another question.
+    Returns a list with the questions weights of each page.
+    """
+
+    fixed = fixed or {}
+    data = defaultdict(lambda: defaultdict(list))
+
+    for page, question, weight in items[start:]:
+        if fixed.get(page, question) == question:
+            data[page][question].append(weight)
+
+    return [questions.values() for questions in data.values()]
+
+
+def reachable(items, chosen, size, threshold):
+    """
+    Checks whether chosen positions can be completed with exactly size
+    items following them, so that weights sum up to at least threshold.
+    Chosen positions must not break the one question per page rule.
+    """
+
+    fixed = {}
+    total = 0
+    for position in chosen:
+        page, question, weight = items[position]
+        fixed[page] = question
+        total += weight
+
+    start = chosen[-1] + 1 if chosen else 0
+    pages = [page_gains(questions, size)
+             for questions in group_weights(items, start, fixed)]
+
+    return best_totals(pages, size)[size] >= threshold - total
+
+
+def greedy_subset(items, threshold):
+    """
+    Returns the positions of a set of items whose weights sum up to at
+    least threshold, picking from at most one question per page, by taking
+    the heaviest items first; the set may not be the smallest one, and
+    None is returned if no set is found this way.
+    """
+
+    fixed = {}
+    chosen = []
+    total = 0
+
+    for position in sorted(range(len(items)), key=lambda p: -items[p][2]):
+        if total >= threshold:
+            break
+        page, question, weight = items[position]
+        if weight <= 0:
+            break
+        if fixed.setdefault(page, question) == question:
+            chosen.append(position)
+            total += weight
+
+    if total < threshold or not chosen:
+        return None
+
+    return sorted(chosen)
+
+
+def complete(items, chosen, size):
+    """
+    Returns chosen positions along with the exactly size items following
+    them that have the best total weight, without breaking the one
+    question per page rule, or None if there aren't that many items
+    """
+
+    fixed = {}
+    for position in chosen:
+        page, question, weight = items[position]
+        fixed[page] = question
+
+    start = chosen[-1] + 1 if chosen else 0
+    data = defaultdict(lambda: defaultdict(list))
+    for position in range(start, len(items)):
+        page, question, weight = items[position]
+        if fixed.get(page, question) == question:
+            data[page][question].append(position)
+
+    def weight(positions):
+        return sum(items[position][2] for position in positions)
+
+    # Best positions for picking 0, 1, ... items from each page, as in
+    # page_gains
+    pages = []
+    for questions in data.values():
+        picks = [[]]
+        for positions in questions.values():
+            ranked = sorted(positions, key=lambda p: -items[p][2])[:size]
+            for count in range(1, len(ranked) + 1):
+                if count == len(picks):
+                    picks.append(ranked[:count])
+                elif weight(ranked[:count]) > weight(picks[count]):
+                    picks[count] = ranked[:count]
+        pages.append(picks)
+
+    # Knapsack over pages, as in best_totals, keeping the amount of items
+    # picked from each page to walk back through them
+    totals = [0] + [UNREACHABLE] * size
+    counts = []
+    for picks in pages:
+        gains = [weight(positions) for positions in picks]
+        merged = list(totals)
+        picked_counts = [0] * (size + 1)
+        for picked, total in enumerate(totals):
+            if total == UNREACHABLE:
+                continue
+            for count in range(1, min(len(gains), size - picked + 1)):
+                if total + gains[count] > merged[picked + count]:
+                    merged[picked + count] = total + gains[count]
+                    picked_counts[picked + count] = count
+        totals = merged
+        counts.append(picked_counts)
+
+    if totals[size] == UNREACHABLE:
+        return None
+
+    subset = list(chosen)
+    for picks, picked_counts in reversed(zip(pages, counts)):
+        count = picked_counts[size]
+        subset.extend(picks[count])
+        size -= count
+
+    return sorted(subset)
+
+
+class Search(object):
+    """
+    Search for smallest subsets of items, within a budget of candidates
+    evaluated and a deadline (a time.time() value), both optional. Once
+    the budget is exhausted, the subset chosen so far is completed with the
+    heaviest items, or one is picked greedily if the least amount of items
+    isn't known yet, and the search is no longer proven minimal.
+    Counts the work done in counters.
+    """
+
+    def __init__(self, max_candidates=None, deadline=None):
+        self.max_candidates = max_candidates
+        self.deadline = deadline
+        self.proven = True
+        self.counters = {
+            # Candidate sets evaluated
+            'candidates': 0,
+            # Candidates dropped by the one question per page rule
+            'pruned': 0,
+            # Results looked up by score
+            'lookups': 0,
+        }
+
+    def exhausted(self):
+        """Checks whether the budget of the search has been used up"""
+
+        if self.max_candidates is not None and \
+           self.counters['candidates'] >= self.max_candidates:
+            return True
+
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def give_up(self, items, threshold, chosen=None, size=None):
+        """
+        Falls back on completing chosen positions up to size items, once
+        the budget is exhausted, or on a greedy pick if size is unknown
+        """
+
+        self.proven = False
+
+        if size is not None:
+            # Chosen positions can always be completed to reach threshold
+            return complete(items, chosen or [], size - len(chosen or []))
+
+        return greedy_subset(items, threshold)
+
+    def smallest_subset(self, items, threshold):
+        """
+        Returns the positions of the smallest set of items whose weights
+        sum up to at least threshold, picking from at most one question per
+        page, or None if there isn't any. Items are (page, question, weight)
+        tuples. Among the smallest sets, the first one in combination order
+        is returned.
+        """
+
+        if self.exhausted():
+            return self.give_up(items, threshold)
+
+        pages = [page_gains(questions, len(items))
+                 for questions in group_weights(items)]
+        totals = best_totals(pages, len(items), self.exhausted)
+        if totals is None:
+            return self.give_up(items, threshold)
+
+        # Find the least amount of items that can reach the threshold
+        for size in range(1, len(items) + 1):
+            self.counters['candidates'] += 1
+            if totals[size] >= threshold:
+                break
+        else:
+            return None
+
+        # Pick positions one by one, always taking the first position that
+        # can still be completed to a set reaching the threshold
+        chosen = []
+        fixed = {}
+        for slot in range(size):
+            start = chosen[-1] + 1 if chosen else 0
+            for position in range(start, len(items)):
+                page, question, weight = items[position]
+                if fixed.get(page, question) != question:
+                    self.counters['pruned'] += 1
+                    continue
+
+                if self.exhausted():
+                    return self.give_up(items, threshold, chosen, size)
+
+                self.counters['candidates'] += 1
+                if reachable(items, chosen + [position], size - slot - 1,
+                             threshold):
+                    chosen.append(position)
+                    fixed[page] = question
+                    break
+
+        return chosen
+
+
+def smallest_subset(items, threshold):
+    """
+    Returns the positions of the smallest set of items whose weights sum up
+    to at least threshold, picking from at most one question per page, or
+    None if there isn't any. Items are (page, question, weight) tuples.
+    """
+
+    return Search().smallest_subset(items, threshold)
+
+
+def similar_result(search, blueprint, positions, score, threshold, sign=1):
+    """
+    Returns the result obtained by also checking the least amount of
+    answers at given positions whose scores (multiplied by sign) sum up
+    to at least threshold, or None if there isn't such a result.
+    """
+
+    items = []
+    for position in positions:
+        question = blueprint.answer_questions[position]
+        items.append((blueprint.question_pages[question], question,
+                      sign * blueprint.answer_scores[position]))
+
+    subset = search.smallest_subset(items, threshold)
+    if subset is None:
+        return None
+
+    positions = [positions[i] for i in subset]
+
+    search.counters['lookups'] += 1
+    return {
+        'result': blueprint.result(blueprint.score(positions) + score).pk,
+        'answers': [blueprint.answer_ids[position] for position in positions],
+    }
+
+
+def new_search():
+    """
+    Returns a search within the budget set by
+    TESTS_SUGGESTIONS_MAX_CANDIDATES and TESTS_SUGGESTIONS_TIME_LIMIT (in
+    seconds); both are unlimited by default
+    """
+
+    time_limit = getattr(settings, 'TESTS_SUGGESTIONS_TIME_LIMIT', None)
+
+    return Search(
+        max_candidates=getattr(settings, 'TESTS_SUGGESTIONS_MAX_CANDIDATES',
+                               None),
+        deadline=time.time() + time_limit if time_limit is not None else None)
+
+
+def similar_results(blueprint, checked, search=None):
+    """
+    Attempts to find better/worse result on test, by finding the least
+    amount of unchecked answers that will change the overall result, given
+    positions of checked answers. Returns result ids and answer ids, along
+    with whether they are proven to be the least amount of answers and the
+    counters of the search
+    e.g.: {'better_result': {'result': 2, 'answers': [4, 7]},
+           'worse_result': None,
+           'proven': True,
+           'counters': {'candidates': 12, 'pruned': 3, 'lookups': 3}}
+    """
+
+    if search is None:
+        search = new_search()
+
+    score = blueprint.score(checked)
+    result = blueprint.result(score)
+    search.counters['lookups'] += 1
+
+    # Get unchecked answer positions
+    checked = set(checked)
+    unchecked = [position for position in range(len(blueprint.answer_ids))
+                 if position not in checked]
+
+    better_result = worse_result = None
+
+    # A better result is reached when the score gets to the limit of the
+    # next result
+    next_result = blueprint.next_result(result.limit)
+    search.counters['lookups'] += 1
+    if next_result is not None:
+        better_result = similar_result(search, blueprint, unchecked, score,
+                                       next_result.limit - score)
+
+    # A worse result is reached when the score drops below the limit of the
+    # current result; search with negated scores for that
+    if result.pk is not None:
+        worse_result = similar_result(search, blueprint, unchecked, score,
+                                      score - result.limit + 1, -1)
+
+    logger.debug('Suggestions for test %s: %s', blueprint.test_id,
+                 search.counters)
+
+    return {
+        'better_result': better_result,
+        'worse_result': worse_result,
+        'proven': search.proven,
+        'counters': search.counters,
+    }
+
+
+# Hits and misses of the suggestions cache, within this process
+stats = {'hits': 0, 'misses': 0}
+stats_lock = Lock()
+
+
+def get_suggestions_cache():
+    """
+    Returns the cache holding suggestions, set by TESTS_SUGGESTIONS_CACHE;
+    its size and timeout bound the number of suggestions kept
+    """
+
+    return get_cache(getattr(settings, 'TESTS_SUGGESTIONS_CACHE', 'default'))
+
+
+def cache_key(blueprint, checked):
+    """Returns the cache key of suggestions for given checked answers"""
+
+    answer_ids = ','.join(str(answer_id) for answer_id in sorted(
+        blueprint.answer_ids[position] for position in checked))
+
+    return 'tests:suggestions:{test}:{version}:{answers}'.format(
+        test=blueprint.test_id, version=blueprint.version,
+        answers=hashlib.md5(answer_ids).hexdigest())
+
+
+def get_cached_similar_results(blueprint, checked):
+    """Returns cached similar results of given checked answers, or None"""
+
+    suggestions = get_suggestions_cache().get(cache_key(blueprint, checked))
+
+    with stats_lock:
+        stats['misses' if suggestions is None else 'hits'] += 1
+
+    return suggestions
+
+
+def cache_similar_results(blueprint, checked, suggestions):
+    """
+    Caches similar results of given checked answers; results of searches
+    that ran out of budget are only kept for
+    TESTS_SUGGESTIONS_UNPROVEN_TIMEOUT (60) seconds, so that later takers
+    get a chance at a complete search
+    """
+
+    cache = get_suggestions_cache()
+    key = cache_key(blueprint, checked)
+
+    if suggestions['proven']:
+        cache.set(key, suggestions)
+    else:
+        cache.set(key, suggestions,
+                  getattr(settings, 'TESTS_SUGGESTIONS_UNPROVEN_TIMEOUT', 60))
+
+
+def cached_similar_results(blueprint, checked):
+    """Returns similar results of given checked answers, from cache if any"""
+
+    suggestions = get_cached_similar_results(blueprint, checked)
+
+    if suggestions is None:
+        suggestions = similar_results(blueprint, checked)
+        cache_similar_results(blueprint, checked, suggestions)
+
+    return suggestions
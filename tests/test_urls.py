@@ -0,0 +1,15 @@
+"""
+URLconf of the tests of the app, mounting the admin along with the app
+"""
+
+from django.conf.urls import patterns, include, url
+from django.contrib import admin
+
+from urls import urlpatterns
+
+
+admin.autodiscover()
+
+urlpatterns = patterns('',
+    url(r'^admin/', include(admin.site.urls)),
+) + urlpatterns
@@ -1,8 +1,108 @@
-from django.test import TestCase, Client
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+from itertools import chain, combinations
+from StringIO import StringIO
+
+from django import db
+from django.conf import global_settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, Client, \
+                        RequestFactory
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
-
-from models import Test, Page, Question, Answer, Result
-from forms import PageForm
+from django.utils import unittest
+
+from models import Test, Page, Question, Answer, Result, Attempt, \
+                   AttemptAnswer, ScoreCount, AnswerCount, ResultCount, \
+                   ScoreDistribution, set_answer_scores
+import forms
+from forms import PageForm, page_form_class
+import suggestions
+from suggestions import smallest_subset
+import blueprints
+import codec
+import jobs
+import benchmarks
+import routers
+import profiling
+import transfer
+import analytics
+import ranking
+import attempts
+import warmup
+from management.commands import rebalance_shards
+
+try:
+    import scoring
+except ImportError:
+    scoring = None
+
+
+def create_test(pages, questions, answers, results=()):
+    """
+    Creates a test with given number of pages, questions per page and
+    answers per question (scored 0, 1, 2, ...), and results with given
+    limits.
+    """
+
+    test = Test.objects.create(name='Synthetic test', description='')
+    using = routers.database_for_test(test.pk)
+
+    for i in range(pages):
+        page = Page.objects.using(using).create(name='Page', test=test)
+        for j in range(questions):
+            question = Question.objects.using(using) \
+                                       .create(name='Question', page=page)
+            Answer.objects.using(using).bulk_create([
+                Answer(name='Answer', score=score, question=question,
+                       test=test)
+                for score in range(answers)])
+
+    for limit in results:
+        Result.objects.using(using).create(text='Result', limit=limit,
+                                           test=test)
+
+    return test
+
+
+def finish_test(client, answers, test_id=1):
+    """
+    Starts the test with given id and marks it as finished, with given
+    answers (as submitted through page forms)
+    """
+
+    client.get(reverse('tests:view', args=(test_id,)))
+
+    attempt = Attempt.objects.get(pk=client.session['attempt_id'])
+    AttemptAnswer.objects.bulk_create([
+        AttemptAnswer(attempt=attempt, answer_id=answer_id)
+        for answer_ids in answers.values() for answer_id in answer_ids])
+
+    blueprint = blueprints.get_blueprint(test_id)
+    attempt.checked = codec.encode(blueprint, blueprint.positions(
+        answer_id for answer_ids in answers.values()
+        for answer_id in answer_ids))
+    attempt.checked_version = blueprint.version
+    attempt.status = Attempt.FINISHED
+    attempt.save()
+
+    return attempt
+
+
+def worker_connected():
+    """Checks whether a worker process holds a database connection"""
+
+    return db.connection.connection is not None
 
 
 class NoTestsCreatedTests(TestCase):
@@ -25,39 +125,34 @@ class SessionTests(TestCase):
     def setUp(self):
         self.client = Client()
 
+    def attempt(self):
+        return Attempt.objects.get(pk=self.client.session['attempt_id'])
+
+    def stored(self):
+        return attempts.load_attempt(self.client.session['attempt_id'])
+
     def testNoTestStarted(self):
-        self.assertNotIn('test_status', self.client.session)
-        self.assertNotIn('test_id', self.client.session)
-        self.assertNotIn('page_number', self.client.session)
-        self.assertNotIn('page_count', self.client.session)
-        self.assertNotIn('answers', self.client.session)
+        self.assertNotIn('attempt_id', self.client.session)
+        self.assertEqual(Attempt.objects.count(), 0)
 
     def testTestStarted(self):
         self.client.get(reverse('tests:view', args=(1,)))
-        self.assertIn('test_status', self.client.session)
-        self.assertEqual(self.client.session['test_status'], 'active')
-        self.assertIn('test_id', self.client.session)
-        self.assertEqual(self.client.session['test_id'], '1')
-        self.assertIn('page_number', self.client.session)
-        self.assertEqual(self.client.session['page_number'], 1)
-        self.assertIn('page_count', self.client.session)
-        self.assertEqual(self.client.session['page_count'], 3)
-        self.assertIn('answers', self.client.session)
-        self.assertEqual(self.client.session['answers'], {})
+        self.assertEqual(self.client.session.keys(), ['attempt_id'])
+        attempt = self.attempt()
+        self.assertEqual(attempt.status, Attempt.ACTIVE)
+        self.assertEqual(attempt.test_id, 1)
+        self.assertEqual(attempt.page_number, 1)
+        self.assertEqual(attempt.answers.count(), 0)
 
     def testTestStartedButGivenUp(self):
         self.client.get(reverse('tests:view', args=(1,)))
+        attempt = self.attempt()
         self.client.get(reverse('tests:give_up'))
-        self.assertNotIn('test_status', self.client.session)
-        self.assertNotIn('test_id', self.client.session)
-        self.assertNotIn('page_number', self.client.session)
-        self.assertNotIn('page_count', self.client.session)
-        self.assertNotIn('answers', self.client.session)
+        self.assertNotIn('attempt_id', self.client.session)
+        self.assertEqual(Attempt.objects.get(pk=attempt.pk).status,
+                         Attempt.GIVEN_UP)
 
     def testOngoingAndFinishedTest(self):
-        test = Test.objects.get(pk=1)
-        pages = test.pages.all()
-
         self.client.get(reverse('tests:view', args=(1,)))
         data = {
             'question_1': ['4'],
@@ -66,32 +161,25 @@ class SessionTests(TestCase):
         }
 
         self.client.post(reverse('tests:view', args=(1,)), data)
-        self.assertIn('test_status', self.client.session)
-        self.assertEqual(self.client.session['test_status'], 'active')
-        self.assertIn('test_id', self.client.session)
-        self.assertEqual(self.client.session['test_id'], '1')
-        self.assertIn('page_number', self.client.session)
-        self.assertEqual(self.client.session['page_number'], 2)
-        self.assertIn('page_count', self.client.session)
-        self.assertEqual(self.client.session['page_count'], 3)
-        self.assertIn('answers', self.client.session)
-        self.assertNotEqual(self.client.session['answers'], {})
+        attempt = self.stored()
+        self.assertEqual(attempt.status, Attempt.ACTIVE)
+        self.assertEqual(attempt.test_id, 1)
+        self.assertEqual(attempt.page_number, 2)
+        self.assertEqual(len(attempt.unsaved_answers), 5)
+        # Attempts in progress are not written to the database
+        self.assertEqual(self.attempt().page_number, 1)
+        self.assertEqual(self.attempt().answers.count(), 0)
         data = {
             'question_4': ['11'],
             'question_5': ['13', '14'],
         }
 
         self.client.post(reverse('tests:view', args=(1,)), data)
-        self.assertIn('test_status', self.client.session)
-        self.assertEqual(self.client.session['test_status'], 'active')
-        self.assertIn('test_id', self.client.session)
-        self.assertEqual(self.client.session['test_id'], '1')
-        self.assertIn('page_number', self.client.session)
-        self.assertEqual(self.client.session['page_number'], 3)
-        self.assertIn('page_count', self.client.session)
-        self.assertEqual(self.client.session['page_count'], 3)
-        self.assertIn('answers', self.client.session)
-        self.assertNotEqual(self.client.session['answers'], {})
+        attempt = self.stored()
+        self.assertEqual(attempt.status, Attempt.ACTIVE)
+        self.assertEqual(attempt.test_id, 1)
+        self.assertEqual(attempt.page_number, 3)
+        self.assertEqual(len(attempt.unsaved_answers), 8)
         data = {
             'question_6': ['15'],
             'question_7': ['22', '23'],
@@ -99,16 +187,34 @@ class SessionTests(TestCase):
         }
 
         self.client.post(reverse('tests:view', args=(1,)), data)
-        self.assertIn('test_status', self.client.session)
-        self.assertEqual(self.client.session['test_status'], 'finished')
-        self.assertIn('test_id', self.client.session)
-        self.assertEqual(self.client.session['test_id'], '1')
-        self.assertIn('page_number', self.client.session)
-        self.assertEqual(self.client.session['page_number'], 3)
-        self.assertIn('page_count', self.client.session)
-        self.assertEqual(self.client.session['page_count'], 3)
-        self.assertIn('answers', self.client.session)
-        self.assertNotEqual(self.client.session['answers'], {})
+        attempt = self.attempt()
+        self.assertEqual(attempt.status, Attempt.FINISHED)
+        self.assertEqual(attempt.test_id, 1)
+        self.assertEqual(attempt.answers.count(), 12)
+        self.assertEqual(attempt.score, 5)
+        self.assertEqual(self.client.session.keys(), ['attempt_id'])
+
+    def testSessionUpgraded(self):
+        self.client.get(reverse('tests:view', args=(1,)))
+        session = self.client.session
+        del session['attempt_id']
+        session['test_status'] = 'active'
+        session['test_id'] = '1'
+        session['page_number'] = 2
+        session['page_count'] = 3
+        session['answers'] = {
+            'question_1': ['4'],
+            'question_2': ['5', '7'],
+            'question_3': ['9', '10']
+        }
+        session.save()
+
+        response = self.client.get(reverse('tests:view', args=(1,)))
+
+        self.assertEqual(response.context['page_number'], 2)
+        self.assertEqual(self.client.session.keys(), ['attempt_id'])
+        self.assertEqual(self.attempt().answers.count(), 5)
+        self.assertEqual(self.attempt().page_number, 2)
 
 
 class TemplateTests(TestCase):
@@ -128,10 +234,7 @@ class TemplateTests(TestCase):
         self.assertTemplateUsed(response, 'tests/view.html')
 
     def testResultTemplateUsed(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['4'],
             'question_2': ['5', '7'],
             'question_3': ['9', '10'],
@@ -140,8 +243,7 @@ class TemplateTests(TestCase):
             'question_6': ['15'],
             'question_7': ['22', '23'],
             'question_8': ['25'],
-        }
-        session.save()
+        })
         response = self.client.get(reverse('tests:result', args=(1,)))
         self.assertTemplateUsed(response, 'tests/result.html')
 
@@ -163,6 +265,61 @@ class IndexViewTests(TestCase):
         self.assertIn('active_test', response.context)
         self.assertEqual(response.context['active_test'], None)
 
+    def testKeysetPagination(self):
+        for i in range(4):
+            Test.objects.create(name='Test %d' % i, description='')
+
+        def page(**params):
+            response = self.client.get(reverse('tests:index'), params)
+            tests = response.context['tests']
+            return ([test.name for test in tests], tests.previous_before,
+                    tests.next_after)
+
+        with self.settings(TESTS_CATALOG_PAGE_SIZE=2):
+            self.assertEqual(page(), (['Basic test', 'Test 0'], None, 2))
+            self.assertEqual(page(after=2), (['Test 1', 'Test 2'], 3, 4))
+            self.assertEqual(page(after=4), (['Test 3'], 5, None))
+            self.assertEqual(page(before=5), (['Test 1', 'Test 2'], 3, 4))
+            self.assertEqual(page(before=3), (['Basic test', 'Test 0'],
+                                              None, 2))
+            self.assertEqual(page(after='x'), (['Basic test', 'Test 0'],
+                                               None, 2))
+
+            response = self.client.get(reverse('tests:index'), {'after': 2})
+        self.assertContains(response, '?after=4')
+        self.assertContains(response, '?before=3')
+
+    def testCatalogCached(self):
+        cache.clear()
+        self.client.get(reverse('tests:index'))
+
+        # The catalog is rendered from cache, without fetching tests
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('tests:index'))
+        self.assertContains(response, 'Basic test')
+
+        test = Test.objects.get(pk=1)
+        test.name = 'Renamed test'
+        test.save()
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('tests:index'))
+        self.assertContains(response, 'Renamed test')
+
+    def testBannerNotCached(self):
+        cache.clear()
+        self.client.get(reverse('tests:index'))
+        self.client.get(reverse('tests:view', args=(1,)))
+
+        response = self.client.get(reverse('tests:index'))
+        self.assertContains(response, 'You have an active test.')
+        self.assertNotContains(response, 'Basic test')
+
+        self.client.get(reverse('tests:give_up'))
+        response = self.client.get(reverse('tests:index'))
+        self.assertNotContains(response, 'You have an active test.')
+        self.assertContains(response, 'Basic test')
+
 
 class ViewViewTests(TestCase):
     """Tests involving the view view of the tests app"""
@@ -182,6 +339,57 @@ class ViewViewTests(TestCase):
         self.assertIn('form', response.context)
         self.assertIsInstance(response.context['form'], PageForm)
 
+    def testQuestionsRenderedOnce(self):
+        blueprint = blueprints.get_blueprint(1)
+        markup = forms.page_markup(blueprint, 0)
+        self.assertIs(forms.page_markup(blueprint, 0), markup)
+        self.assertIn('Which are the fastest brands of cars?', markup)
+        self.assertNotIn('csrfmiddlewaretoken', markup)
+
+        response = self.client.get(reverse('tests:view', args=(1,)))
+        self.assertContains(response, markup)
+
+        answer = Answer.objects.get(pk=1)
+        answer.name = 'Renamed answer'
+        answer.save()
+
+        markup = forms.page_markup(blueprints.get_blueprint(1), 0)
+        self.assertIn('Renamed answer', markup)
+
+    def testConditionalGet(self):
+        url = reverse('tests:view', args=(1,))
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # Editing the test changes the page
+        question = Question.objects.get(pk=1)
+        question.name = 'Renamed question'
+        question.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Renamed question')
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        # So does moving on to the next page
+        self.client.post(url, {'question_1': ['1'], 'question_2': ['5'],
+                               'question_3': ['9']})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_number'], 2)
+
+    def testErrorsRendered(self):
+        response = self.client.post(reverse('tests:view', args=(1,)), {})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'This field is required.')
+        self.assertFalse(response.has_header('ETag'))
+
 
 class ResultViewTests(TestCase):
     """Tests involving the result view of the tests app"""
@@ -189,10 +397,7 @@ class ResultViewTests(TestCase):
     fixtures = ['sample_test.json']
 
     def testContext(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['4'],
             'question_2': ['5', '7'],
             'question_3': ['9', '10'],
@@ -201,8 +406,7 @@ class ResultViewTests(TestCase):
             'question_6': ['15'],
             'question_7': ['22', '23'],
             'question_8': ['25'],
-        }
-        session.save()
+        })
         response = self.client.get(reverse('tests:result', args=(1,)))
 
         self.assertEqual(response.status_code, 200)
@@ -231,11 +435,7 @@ class FlowTests(TestCase):
         self.client = Client()
 
     def testTestWithBothSimilarResults(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['1', '4'],
             'question_2': ['5'],
             'question_3': ['9'],
@@ -244,8 +444,7 @@ class FlowTests(TestCase):
             'question_6': ['15', '16'],
             'question_7': ['23'],
             'question_8': ['24'],
-        }
-        session.save()
+        })
 
         response = self.client.get(reverse('tests:result', args=(1,)))
 
@@ -265,11 +464,7 @@ class FlowTests(TestCase):
         })
 
     def testTestWithBetterSimilarResults(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['2'],
             'question_2': ['7'],
             'question_3': ['8', '10'],
@@ -278,8 +473,7 @@ class FlowTests(TestCase):
             'question_6': ['16'],
             'question_7': ['23'],
             'question_8': ['24'],
-        }
-        session.save()
+        })
 
         response = self.client.get(reverse('tests:result', args=(1,)))
 
@@ -297,11 +491,7 @@ class FlowTests(TestCase):
         })
 
     def testTestWithWorseSimilarResults(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['1', '3'],
             'question_2': ['5', '6'],
             'question_3': ['8', '9'],
@@ -310,8 +500,7 @@ class FlowTests(TestCase):
             'question_6': ['15', '16', '20'],
             'question_7': ['21', '23'],
             'question_8': ['24'],
-        }
-        session.save()
+        })
 
         response = self.client.get(reverse('tests:result', args=(1,)))
 
@@ -327,11 +516,7 @@ class FlowTests(TestCase):
         })
 
     def testSimilarResultsOtherAnswers(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['1', '4'],
             'question_2': ['5'],
             'question_3': ['9'],
@@ -340,8 +525,7 @@ class FlowTests(TestCase):
             'question_6': ['15', '16'],
             'question_7': ['23'],
             'question_8': ['24'],
-        }
-        session.save()
+        })
 
         response = self.client.get(reverse('tests:result', args=(1,)))
 
@@ -355,11 +539,7 @@ class FlowTests(TestCase):
             self.assertNotIn(answer.pk, answers)
 
     def testSimilarResultsDifferentPages(self):
-        self.client.get(reverse('tests:view', args=(1,)))
-
-        session = self.client.session
-        session['test_status'] = 'finished'
-        session['answers'] = {
+        finish_test(self.client, {
             'question_1': ['1', '4'],
             'question_2': ['5'],
             'question_3': ['9'],
@@ -368,8 +548,7 @@ class FlowTests(TestCase):
             'question_6': ['15', '16'],
             'question_7': ['23'],
             'question_8': ['24'],
-        }
-        session.save()
+        })
 
         response = self.client.get(reverse('tests:result', args=(1,)))
 
@@ -383,3 +562,1786 @@ class FlowTests(TestCase):
         for answer in similar_results['worse_result']['answers']:
             self.assertNotIn(answer.question.page, pages)
             pages.append(answer.question.page)
+
+
+class SuggestionEngineTests(TestCase):
+    """Tests involving the suggestion engine used by the result view"""
+
+    def bruteForce(self, items, threshold):
+        """Walks through all combinations of items, the way it was done"""
+
+        positions = range(len(items))
+        combs = chain.from_iterable(
+            combinations(positions, r) for r in range(1, len(items)+1))
+
+        for comb in combs:
+            questions = {}
+            for position in comb:
+                page, question, weight = items[position]
+                if questions.setdefault(page, question) != question:
+                    break
+            else:
+                if sum(items[p][2] for p in comb) >= threshold:
+                    return list(comb)
+
+        return None
+
+    def randomItems(self, count):
+        items = []
+        for i in range(count):
+            page = random.randint(1, 3)
+            question = page * 10 + random.randint(1, 2)
+            items.append((page, question, random.randint(-5, 5)))
+        return sorted(items, key=lambda item: item[1])
+
+    def testMatchesBruteForce(self):
+        random.seed(1)
+        for i in range(300):
+            items = self.randomItems(random.randint(0, 9))
+            threshold = random.randint(1, 15)
+            self.assertEqual(smallest_subset(items, threshold),
+                             self.bruteForce(items, threshold))
+
+    def testOnePagePerQuestion(self):
+        items = [(1, 1, 5), (1, 2, 5), (2, 3, 1)]
+        self.assertEqual(smallest_subset(items, 10), None)
+        self.assertEqual(smallest_subset(items, 6), [0, 2])
+
+    def testBudget(self):
+        items = [(1, 1, 1), (1, 1, 2), (2, 2, 3), (2, 3, 5), (3, 4, 4)]
+
+        search = suggestions.Search()
+        self.assertEqual(search.smallest_subset(items, 9), [3, 4])
+        self.assertTrue(search.proven)
+
+        search = suggestions.Search()
+        self.assertEqual(search.smallest_subset(items[1:4], 7), [0, 2])
+        self.assertEqual(search.counters['pruned'], 0)
+        self.assertEqual(search.smallest_subset(
+            [(1, 1, 5), (1, 2, 5), (2, 3, 5)], 10), [0, 2])
+        self.assertEqual(search.counters['pruned'], 1)
+
+        # Out of budget, heaviest answers are picked instead
+        search = suggestions.Search(max_candidates=3)
+        self.assertEqual(search.smallest_subset(items, 9), [3, 4])
+        self.assertFalse(search.proven)
+        self.assertEqual(search.counters['candidates'], 3)
+
+        search = suggestions.Search(deadline=time.time())
+        self.assertEqual(search.smallest_subset(items, 11), [1, 3, 4])
+        self.assertFalse(search.proven)
+        self.assertEqual(search.counters['candidates'], 0)
+
+    def testBudgetKeepsReachableSets(self):
+        # Once the least amount of items is known, a set is always found
+        items = [(1, 1, 5), (1, 2, 4), (1, 2, 4)]
+        search = suggestions.Search(max_candidates=1)
+        self.assertEqual(search.smallest_subset(items, 8), [1, 2])
+        self.assertFalse(search.proven)
+
+        random.seed(3)
+        for i in range(300):
+            items = self.randomItems(random.randint(0, 9))
+            threshold = random.randint(1, 15)
+            expected = self.bruteForce(items, threshold)
+            search = suggestions.Search(max_candidates=random.randint(1, 5))
+            subset = search.smallest_subset(items, threshold)
+            if expected is None:
+                self.assertEqual(subset, None)
+            else:
+                self.assertEqual(len(subset), len(expected))
+                self.assertGreaterEqual(sum(items[p][2] for p in subset),
+                                        threshold)
+
+    def testManyAnswers(self):
+        random.seed(2)
+        items = self.randomItems(400)
+        started = time.time()
+        positions = smallest_subset(items, 40)
+        self.assertLess(time.time() - started, 10)
+        self.assertGreaterEqual(sum(items[p][2] for p in positions), 40)
+
+
+class BlueprintTests(TestCase):
+    """Tests involving compiled test blueprints"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testContent(self):
+        blueprint = blueprints.get_blueprint(1)
+
+        self.assertEqual(blueprint.page_count, 3)
+        self.assertEqual(list(blueprint.question_ids), range(1, 9))
+        self.assertEqual(list(blueprint.answer_ids), range(1, 26))
+        self.assertEqual(list(blueprint.result_limits), [10, 20, 30])
+        self.assertEqual([question[0] for question in blueprint.questions(1)],
+                         [4, 5])
+        self.assertEqual(blueprint.questions(1)[0][2],
+                         [(11, 'Frog'), (12, 'Dog')])
+        self.assertEqual(blueprint.result(25), Result.objects.get(limit=20))
+        self.assertEqual(blueprint.result(9).pk, None)
+
+    def testCached(self):
+        blueprints.get_blueprint(1)
+        with self.assertNumQueries(0):
+            blueprints.get_blueprint('1')
+
+    def testMissingTest(self):
+        self.assertRaises(Test.DoesNotExist, blueprints.get_blueprint, 2)
+
+    def testInvalidatedOnChange(self):
+        self.assertEqual(blueprints.get_blueprint(1).answer_scores[0], 4)
+
+        answer = Answer.objects.get(pk=1)
+        answer.score = 7
+        answer.save()
+        self.assertEqual(blueprints.get_blueprint(1).answer_scores[0], 7)
+
+        Result.objects.get(limit=30).delete()
+        self.assertEqual(list(blueprints.get_blueprint(1).result_limits),
+                         [10, 20])
+
+    def testInvalidatedOnMove(self):
+        test = Test.objects.create(name='Other test', description='')
+        self.assertEqual(blueprints.get_blueprint(1).page_count, 3)
+        self.assertEqual(blueprints.get_blueprint(test.pk).page_count, 0)
+
+        page = Page.objects.get(pk=1)
+        page.test = test
+        page.save()
+        self.assertEqual(blueprints.get_blueprint(1).page_count, 2)
+        self.assertEqual(blueprints.get_blueprint(test.pk).page_count, 1)
+
+        question = Question.objects.get(pk=4)
+        question.page = page
+        question.position = None
+        question.save()
+        self.assertEqual(len(blueprints.get_blueprint(1).question_ids), 4)
+        self.assertEqual(len(blueprints.get_blueprint(test.pk).question_ids),
+                         4)
+
+    def testInvalidatedAcrossProcesses(self):
+        # Another process, sharing stamps through the cache
+        other = blueprints.BlueprintCache()
+        self.assertEqual(other.get(1).answer_scores[0], 4)
+
+        answer = Answer.objects.get(pk=1)
+        answer.score = 7
+        answer.save()
+        self.assertEqual(other.get(1).answer_scores[0], 7)
+
+    def testEviction(self):
+        test = Test.objects.create(name='Other test', description='')
+        with self.settings(TESTS_BLUEPRINT_CACHE_SIZE=1):
+            blueprints.get_blueprint(1)
+            blueprints.get_blueprint(test.pk)
+            self.assertEqual(blueprints.cache.blueprints.keys(), [test.pk])
+
+    def testViewServedFromBlueprint(self):
+        self.client.get(reverse('tests:view', args=(1,)))
+        # Only the session is loaded, the attempt is in the attempt store
+        with self.assertNumQueries(1):
+            self.client.get(reverse('tests:view', args=(1,)))
+
+
+@unittest.skipIf(scoring is None, 'NumPy is not installed')
+class RescoreTests(TestCase):
+    """Tests involving batch scoring of stored attempts"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def finishTest(self, answers):
+        pages = [
+            ['question_1', 'question_2', 'question_3'],
+            ['question_4', 'question_5'],
+            ['question_6', 'question_7', 'question_8'],
+        ]
+
+        client = Client()
+        client.get(reverse('tests:view', args=(1,)))
+        for questions in pages:
+            client.post(reverse('tests:view', args=(1,)),
+                        dict((question, answers[question])
+                             for question in questions))
+
+        return Attempt.objects.latest('pk')
+
+    def testOutcomes(self):
+        blueprint = blueprints.get_blueprint(1)
+
+        self.assertEqual(scoring.outcomes(blueprint, [[1, 4, 5, 9, 12, 13,
+                                                       15, 16, 23, 24],
+                                                      [2, 7], [], [20, 21]]),
+                         [(26, 2), (-4, None), (0, None), (12, 1)])
+
+    def testAttemptSaved(self):
+        attempt = self.finishTest({
+            'question_1': ['1', '4'],
+            'question_2': ['5'],
+            'question_3': ['9'],
+            'question_4': ['12'],
+            'question_5': ['13'],
+            'question_6': ['15', '16'],
+            'question_7': ['23'],
+            'question_8': ['24'],
+        })
+
+        self.assertEqual(attempt.score, 26)
+        self.assertEqual(attempt.result, Result.objects.get(limit=20))
+        self.assertEqual(attempt.answers.count(), 10)
+
+    def testRescore(self):
+        attempt = self.finishTest({
+            'question_1': ['1', '4'],
+            'question_2': ['5'],
+            'question_3': ['9'],
+            'question_4': ['12'],
+            'question_5': ['13'],
+            'question_6': ['15', '16'],
+            'question_7': ['23'],
+            'question_8': ['24'],
+        })
+
+        Answer.objects.filter(pk=1).update(score=10)
+        Result.objects.filter(limit=30).update(limit=32)
+        blueprints.cache.clear()
+
+        output = StringIO()
+        call_command('rescore_attempts', '1', chunk_size=1, stdout=output)
+
+        attempt = Attempt.objects.get(pk=attempt.pk)
+        self.assertEqual(attempt.score, 32)
+        self.assertEqual(attempt.result, Result.objects.get(limit=32))
+        self.assertEqual(output.getvalue().strip(),
+                         'Test 1: 1 attempts scored, 1 changed')
+        self.assertEqual(attempt.scoring_version,
+                         blueprints.get_blueprint(1).scoring_version)
+
+
+class PageFormTests(TestCase):
+    """Tests involving page forms"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testFields(self):
+        form = page_form_class(blueprints.get_blueprint(1), 1)()
+
+        self.assertIsInstance(form, PageForm)
+        self.assertEqual(form.fields.keys(), ['question_4', 'question_5'])
+        self.assertEqual(form.fields['question_4'].choices,
+                         [(11, 'Frog'), (12, 'Dog')])
+
+    def testSameQueriesForAnyPageSize(self):
+        for questions in (1, 50):
+            test = create_test(1, questions, 3)
+            with self.assertNumQueries(4):
+                form = page_form_class(blueprints.get_blueprint(test.pk), 0)
+            self.assertEqual(len(form.base_fields), questions)
+
+    def testClassMemoizedPerVersion(self):
+        form_class = page_form_class(blueprints.get_blueprint(1), 0)
+        self.assertIs(page_form_class(blueprints.get_blueprint(1), 0),
+                      form_class)
+
+        answer = Answer.objects.get(pk=1)
+        answer.name = 'Lamborghini'
+        answer.save()
+
+        form_class = page_form_class(blueprints.get_blueprint(1), 0)
+        self.assertIn((1, 'Lamborghini'),
+                      form_class.base_fields['question_1'].choices)
+
+
+class ResultQueriesTests(TestCase):
+    """Tests involving the number of queries run by the result view"""
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def finishTest(self, test):
+        """
+        Marks given test as finished, checking each question's first
+        answer, and returns the URL of its result
+        """
+
+        blueprint = blueprints.get_blueprint(test.pk)
+
+        finish_test(self.client, dict(
+            ('question_{id}'.format(id=question_id), [answers[0][0]])
+            for page in range(blueprint.page_count)
+            for question_id, name, answers in blueprint.questions(page)),
+            test.pk)
+
+        return reverse('tests:result', args=(test.pk,))
+
+    def testConstantQueries(self):
+        for pages, questions in ((1, 1), (10, 10)):
+            test = create_test(pages, questions, 4, results=(1, 5, 9))
+            url = self.finishTest(test)
+
+            # Session, attempt, blueprint (4 queries), score distribution,
+            # suggested answers
+            blueprints.cache.clear()
+            with self.assertNumQueries(8):
+                response = self.client.get(url)
+            self.assertNotEqual(response.context['similar_results'],
+                                {'better_result': None, 'worse_result': None})
+
+            # Session, attempt, suggested answers
+            with self.assertNumQueries(3):
+                response = self.client.get(url)
+
+            self.client.get(reverse('tests:give_up'))
+
+
+class SchemaTests(TestCase):
+    """Tests involving positions and denormalized tests"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testPositionsAssigned(self):
+        test = Test.objects.get(pk=1)
+        page = Page.objects.create(name='Last page', test=test)
+        question = Question.objects.create(name='Question', page=page)
+        other = Question.objects.create(name='Question', page=page)
+
+        self.assertEqual(page.position, 4)
+        self.assertEqual((question.position, other.position), (1, 2))
+
+    def testTestDenormalized(self):
+        test = Test.objects.create(name='Other test', description='')
+        page = Page.objects.get(pk=1)
+        page.test = test
+        page.save()
+
+        self.assertEqual(Question.objects.filter(test=test).count(), 3)
+        self.assertEqual(Answer.objects.filter(test=test).count(), 10)
+        self.assertEqual(
+            Answer.objects.create(name='Answer', score=1,
+                                  question_id=1).test, test)
+
+    def testBlueprintFollowsPositions(self):
+        Page.objects.filter(pk=1).update(position=4)
+        Question.objects.filter(pk=4).update(position=3)
+
+        blueprint = blueprints.get_blueprint(1)
+        self.assertEqual(list(blueprint.page_ids), [2, 3, 1])
+        self.assertEqual([question[0] for question in blueprint.questions(0)],
+                         [5, 4])
+
+    def testBackfill(self):
+        Page.objects.filter(pk=1).update(position=7)
+        Question.objects.filter(pk=2).update(position=0)
+        Answer.objects.update(test=Test.objects.create(name='Other test',
+                                                       description=''))
+
+        call_command('backfill_tests', stdout=StringIO())
+
+        self.assertEqual(list(Page.objects.order_by('pk')
+                                          .values_list('position', flat=True)),
+                         [3, 1, 2])
+        self.assertEqual(list(Question.objects.filter(page=1)
+                                              .order_by('pk')
+                                              .values_list('position',
+                                                           flat=True)),
+                         [2, 1, 3])
+        self.assertEqual(Answer.objects.filter(test=1).count(), 25)
+
+
+class CodecTests(TestCase):
+    """Tests involving the encoding of checked answers"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testRoundTrip(self):
+        blueprint = blueprints.get_blueprint(1)
+
+        for positions in ([], [0], [3, 4, 24], range(25)):
+            data = codec.encode(blueprint, positions)
+            self.assertEqual(len(data), 8)
+            self.assertEqual(codec.decode(blueprint, data), positions)
+
+    def testInvalidData(self):
+        blueprint = blueprints.get_blueprint(1)
+
+        self.assertRaises(ValueError, codec.decode, blueprint, 'AAAA')
+        self.assertRaises(ValueError, codec.decode, blueprint, '!')
+        self.assertRaises(ValueError, codec.decode, blueprint,
+                          codec.encode(blueprint, [31]))
+
+    def testFallbackOnTestChange(self):
+        finish_test(self.client, {
+            'question_1': ['1', '4'],
+            'question_2': ['5'],
+            'question_3': ['9'],
+            'question_4': ['12'],
+            'question_5': ['13'],
+            'question_6': ['15', '16'],
+            'question_7': ['23'],
+            'question_8': ['24'],
+        })
+
+        # A new answer shifts positions of the following ones
+        Answer.objects.create(name='Lamborghini', score=5, question_id=1)
+
+        response = self.client.get(reverse('tests:result', args=(1,)))
+        self.assertEqual(response.context['score'], 26)
+
+    def testBenchmark(self):
+        row, = benchmarks.codec_benchmark((1000,), number=1)
+        self.assertEqual(row['codec_bytes'], 668)
+        self.assertLess(row['codec_bytes'], row['json_bytes'])
+
+
+class SuggestionCacheTests(TestCase):
+    """Tests involving the cache of similar results"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+        self.hits = suggestions.stats['hits']
+        self.misses = suggestions.stats['misses']
+
+    def assertStats(self, hits, misses):
+        self.assertEqual(suggestions.stats['hits'] - self.hits, hits)
+        self.assertEqual(suggestions.stats['misses'] - self.misses, misses)
+
+    def testCached(self):
+        blueprint = blueprints.get_blueprint(1)
+        checked = blueprint.positions([1, 4, 5, 9, 12, 13, 15, 16, 23, 24])
+
+        similar_results = suggestions.cached_similar_results(blueprint,
+                                                             checked)
+        self.assertEqual(similar_results['better_result'],
+                         {'result': 3, 'answers': [14]})
+        self.assertEqual(similar_results['worse_result'],
+                         {'result': None, 'answers': [17]})
+        self.assertStats(0, 1)
+
+        self.assertEqual(suggestions.cached_similar_results(
+            blueprint, list(reversed(checked))), similar_results)
+        self.assertStats(1, 1)
+
+    def testKeyedByVersion(self):
+        blueprint = blueprints.get_blueprint(1)
+        checked = blueprint.positions([1, 4, 5, 9, 12, 13, 15, 16, 23, 24])
+        suggestions.cached_similar_results(blueprint, checked)
+
+        Answer.objects.filter(pk=14).update(score=1)
+        blueprints.cache.clear()
+        blueprint = blueprints.get_blueprint(1)
+
+        self.assertEqual(suggestions.cached_similar_results(
+            blueprint, checked)['better_result'],
+            {'result': 3, 'answers': [20]})
+        self.assertStats(0, 2)
+
+    def testUnprovenKeptShortly(self):
+        blueprint = blueprints.get_blueprint(1)
+        checked = blueprint.positions([1, 4, 5, 9, 12, 13, 15, 16, 23, 24])
+
+        with self.settings(TESTS_SUGGESTIONS_MAX_CANDIDATES=0,
+                           TESTS_SUGGESTIONS_UNPROVEN_TIMEOUT=-1):
+            similar_results = suggestions.cached_similar_results(blueprint,
+                                                                 checked)
+            self.assertFalse(similar_results['proven'])
+            suggestions.cached_similar_results(blueprint, checked)
+        self.assertStats(0, 2)
+
+        # Complete searches are kept for the timeout of the cache
+        suggestions.cached_similar_results(blueprint, checked)
+        suggestions.cached_similar_results(blueprint, checked)
+        self.assertStats(1, 3)
+
+    def testBudgetInContext(self):
+        finish_test(self.client, {
+            'question_1': ['1', '4'],
+            'question_2': ['5'],
+            'question_3': ['9'],
+            'question_4': ['12'],
+            'question_5': ['13'],
+            'question_6': ['15', '16'],
+            'question_7': ['23'],
+            'question_8': ['24'],
+        })
+
+        response = self.client.get(reverse('tests:result', args=(1,)))
+        self.assertTrue(response.context['suggestions_proven'])
+        self.assertEqual(response.context['suggestion_counters']['lookups'], 4)
+
+        suggestions.get_suggestions_cache().clear()
+        with self.settings(TESTS_SUGGESTIONS_MAX_CANDIDATES=0):
+            response = self.client.get(reverse('tests:result', args=(1,)))
+        self.assertFalse(response.context['suggestions_proven'])
+        self.assertEqual(response.context['score'], 26)
+
+    def testResultRefresh(self):
+        finish_test(self.client, {
+            'question_1': ['1', '4'],
+            'question_2': ['5'],
+            'question_3': ['9'],
+            'question_4': ['12'],
+            'question_5': ['13'],
+            'question_6': ['15', '16'],
+            'question_7': ['23'],
+            'question_8': ['24'],
+        })
+
+        first = self.client.get(reverse('tests:result', args=(1,)))
+        second = self.client.get(reverse('tests:result', args=(1,)))
+
+        self.assertEqual(first.context['similar_results'],
+                         second.context['similar_results'])
+        self.assertStats(1, 1)
+
+
+class AsyncSuggestionsTests(TestCase):
+    """Tests involving suggestions computed in the background"""
+
+    fixtures = ['sample_test.json']
+
+    answers = {
+        'question_1': ['1', '4'],
+        'question_2': ['5'],
+        'question_3': ['9'],
+        'question_4': ['12'],
+        'question_5': ['13'],
+        'question_6': ['15', '16'],
+        'question_7': ['23'],
+        'question_8': ['24'],
+    }
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+
+    def testComputedInBackground(self):
+        finish_test(self.client, self.answers)
+
+        with self.settings(TESTS_ASYNC_SUGGESTIONS=True,
+                           TESTS_SUGGESTIONS_TIMEOUT=10):
+            response = self.client.get(reverse('tests:result', args=(1,)))
+            self.assertEqual(response.context['score'], 26)
+            self.assertTrue(response.context['suggestions_pending'])
+            self.assertContains(response, reverse('tests:suggestions',
+                                                  args=(1,)))
+
+            response = self.client.get(reverse('tests:suggestions',
+                                               args=(1,)))
+
+        self.assertEqual(json.loads(response.content), {
+            'status': 'done',
+            'better_result': {
+                'text': 'Brilliant!',
+                'answers': [{'question': 'Which of these are insects?',
+                             'answer': 'Mosquito'}],
+            },
+            'worse_result': {
+                'text': 'Your result is too low!',
+                'answers': [{'question': 'What genres of music does '
+                                         'Tomorrowland consist of?',
+                             'answer': 'Manele'}],
+            },
+            'proven': True,
+        })
+
+    def testInlineWhenSaturated(self):
+        finish_test(self.client, self.answers)
+
+        with self.settings(TESTS_ASYNC_SUGGESTIONS=True,
+                           TESTS_SUGGESTIONS_PENDING=0):
+            response = self.client.get(reverse('tests:result', args=(1,)))
+
+        self.assertFalse(response.context['suggestions_pending'])
+        self.assertEqual(
+            response.context['similar_results']['better_result']['answers'],
+            [Answer.objects.get(pk=14)])
+
+    def testPendingAfterTimeout(self):
+        finish_test(self.client, self.answers)
+
+        # A computation of the same suggestions, still running
+        blueprint = blueprints.get_blueprint(1)
+        key = suggestions.cache_key(blueprint, blueprint.positions(
+            [1, 4, 5, 9, 12, 13, 15, 16, 23, 24]))
+        with jobs.lock:
+            jobs.pending[key] = (
+                jobs.get_pool().apply_async(time.sleep, (0.5,)), time.time())
+
+        with self.settings(TESTS_SUGGESTIONS_TIMEOUT=0):
+            response = self.client.get(reverse('tests:suggestions',
+                                               args=(1,)))
+
+        self.assertEqual(json.loads(response.content), {'status': 'pending'})
+        with jobs.lock:
+            del jobs.pending[key]
+
+    def testStalePendingExpired(self):
+        finish_test(self.client, self.answers)
+
+        # A computation whose result never comes, e.g. as its worker died
+        blueprint = blueprints.get_blueprint(1)
+        key = suggestions.cache_key(blueprint, blueprint.positions(
+            [1, 4, 5, 9, 12, 13, 15, 16, 23, 24]))
+        with jobs.lock:
+            jobs.pending[key] = (jobs.get_pool().apply_async(time.sleep,
+                                                             (0.5,)),
+                                 time.time() - 120)
+
+        with self.settings(TESTS_SUGGESTIONS_TIMEOUT=10):
+            response = self.client.get(reverse('tests:suggestions',
+                                               args=(1,)))
+
+        self.assertEqual(json.loads(response.content)['status'], 'done')
+        self.assertEqual(jobs.pending, {})
+
+    def testPoolStarted(self):
+        # Started once per process, with workers dropping the database
+        # connections they inherit
+        db.connection.cursor()
+        jobs.stop_pool()
+        pool = jobs.start_pool()
+        self.assertIs(jobs.start_pool(), pool)
+        self.assertIs(jobs.get_pool(), pool)
+        self.assertFalse(pool.apply(worker_connected))
+
+        jobs.stop_pool()
+        self.assertIsNone(jobs.pool)
+        self.assertIsNot(jobs.get_pool(), pool)
+
+    def testNotFinished(self):
+        self.client.get(reverse('tests:view', args=(1,)))
+        response = self.client.get(reverse('tests:suggestions', args=(1,)))
+        self.assertEqual(response.status_code, 404)
+
+    def testWaitedFor(self):
+        finish_test(self.client, self.answers)
+
+        with self.settings(TESTS_SUGGESTIONS_WAIT=10):
+            response = self.client.get(reverse('tests:result', args=(1,)))
+
+        self.assertFalse(response.context['suggestions_pending'])
+        self.assertEqual(
+            response.context['similar_results']['better_result']['answers'],
+            [Answer.objects.get(pk=14)])
+        self.assertEqual(jobs.pending, {})
+
+    def testPendingAfterWait(self):
+        finish_test(self.client, self.answers)
+
+        # Both worker processes busy with slower searches, so that the
+        # search is left pending rather than holding the request
+        for i in range(2):
+            jobs.get_pool().apply_async(time.sleep, (0.3,))
+
+        with self.settings(TESTS_SUGGESTIONS_WAIT=0):
+            response = self.client.get(reverse('tests:result', args=(1,)))
+        self.assertEqual(response.context['score'], 26)
+        self.assertTrue(response.context['suggestions_pending'])
+
+        with self.settings(TESTS_SUGGESTIONS_TIMEOUT=10):
+            response = self.client.get(reverse('tests:suggestions',
+                                               args=(1,)))
+        self.assertEqual(json.loads(response.content)['status'], 'done')
+
+
+class ReplicaRouterTests(TestCase):
+    """Tests involving reads spread over replica databases"""
+
+    multi_db = True
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        routers.unhealthy.clear()
+        routers.end_request()
+
+    def tearDown(self):
+        routers.unhealthy.clear()
+        routers.end_request()
+
+    def testWeightedReads(self):
+        random.seed(0)
+        reads = [self.router.db_for_read(Test) for i in range(3000)]
+
+        self.assertEqual(set(reads), set(['replica1', 'replica2']))
+        self.assertAlmostEqual(reads.count('replica1') / 3000.0, 2 / 3.0,
+                               delta=0.05)
+
+    def testWritesToPrimary(self):
+        self.assertEqual(self.router.db_for_write(Test), 'default')
+
+    def testUnhealthyReplicasSkipped(self):
+        routers.mark_unhealthy('replica1')
+        self.assertEqual(set(self.router.db_for_read(Test)
+                             for i in range(100)), set(['replica2']))
+
+        routers.mark_unhealthy('replica2')
+        self.assertEqual(self.router.db_for_read(Test), 'default')
+
+        routers.mark_healthy('replica1')
+        self.assertEqual(self.router.db_for_read(Test), 'replica1')
+
+    def testReadsFromReplica(self):
+        Test.objects.using('default').create(pk=1, name='Primary')
+        Test.objects.using('replica1').create(pk=1, name='Replica')
+
+        with self.settings(TESTS_REPLICA_DATABASES={'replica1': 1}):
+            db = self.router.db_for_read(Test)
+
+        self.assertEqual(Test.objects.using(db).get(pk=1).name, 'Replica')
+
+    def testReadsAfterWriteInRequest(self):
+        middleware = routers.PinningMiddleware()
+
+        request = RequestFactory().post('/')
+        middleware.process_request(request)
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+
+        # Reads following a write of the same request go to the primary
+        self.router.db_for_write(Test)
+        self.assertEqual(set(self.router.db_for_read(Test)
+                             for i in range(100)), set(['default']))
+
+        middleware.process_response(request, HttpResponse())
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+
+    def testReadsAfterWriteOutsideRequest(self):
+        # e.g. in management commands, where writes don't pin reads
+        self.router.db_for_write(Test)
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+
+        with routers.request_scope():
+            self.router.db_for_write(Test)
+            self.assertEqual(self.router.db_for_read(Test), 'default')
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+
+    def testPinnedAfterWrite(self):
+        middleware = routers.PinningMiddleware()
+        factory = RequestFactory()
+
+        request = factory.post('/')
+        middleware.process_request(request)
+        self.router.db_for_write(Test)
+        response = middleware.process_response(request, HttpResponse())
+        cookie = response.cookies[middleware.cookie_name]
+        self.assertEqual(cookie['max-age'], 5)
+
+        # Reads of the same client go to the primary within the pin...
+        request = factory.get('/')
+        request.COOKIES[middleware.cookie_name] = cookie.value
+        middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(Test), 'default')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertNotIn(middleware.cookie_name, response.cookies)
+
+        # ...while other clients read from replicas
+        request = factory.get('/')
+        middleware.process_request(request)
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+        middleware.process_response(request, HttpResponse())
+
+        # Pins end
+        request = factory.get('/')
+        request.COOKIES[middleware.cookie_name] = str(time.time() - 1)
+        middleware.process_request(request)
+        self.assertNotEqual(self.router.db_for_read(Test), 'default')
+
+
+class ShardRouterTests(TestCase):
+    """Tests involving tests kept on shard databases"""
+
+    multi_db = True
+
+    shards = ['shard1', 'shard2']
+
+    def setUp(self):
+        blueprints.cache.clear()
+        self.sharded = self.settings(TESTS_SHARD_DATABASES=self.shards)
+        self.sharded.enable()
+        self.routers = db.router.routers
+        db.router.routers = [routers.ShardRouter()]
+
+    def tearDown(self):
+        db.router.routers = self.routers
+        self.sharded.disable()
+        blueprints.cache.clear()
+
+    def create_tests(self, *shards):
+        """Creates a test on each of given shards"""
+
+        tests = []
+        for shard in shards:
+            test = create_test(1, 2, 2, results=(0, 2))
+            while routers.database_for_test(test.pk) != shard:
+                test = create_test(1, 2, 2, results=(0, 2))
+            tests.append(test)
+
+        return tests
+
+    def testConsistentHashing(self):
+        ring = routers.HashRing(['a', 'b', 'c'])
+        nodes = dict((key, ring.node(key)) for key in range(1000))
+        self.assertEqual(set(nodes.values()), set(['a', 'b', 'c']))
+
+        # Adding a node only moves keys to that node
+        ring = routers.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in nodes if ring.node(key) != nodes[key]]
+        self.assertTrue(0 < len(moved) < 500)
+        self.assertEqual(set(ring.node(key) for key in moved), set(['d']))
+
+    def testRoutedByTest(self):
+        test, other = self.create_tests('shard1', 'shard2')
+
+        for model in (Page, Question, Answer, Result):
+            self.assertEqual(model.objects.using('shard1')
+                                  .filter(test=test).count(),
+                             model.objects.using('shard1').count())
+            self.assertFalse(model.objects.using('default').exists())
+        self.assertEqual(Answer.objects.using('shard2')
+                               .filter(test=other).count(), 4)
+
+        # Tests are listed on the primary database and copied to their
+        # shard
+        self.assertEqual(Test.objects.get(pk=test.pk).name, test.name)
+        self.assertTrue(Test.objects.using('shard1')
+                            .filter(pk=test.pk).exists())
+        self.assertFalse(Test.objects.using('shard2')
+                             .filter(pk=test.pk).exists())
+
+        test.delete()
+        self.assertFalse(Test.objects.using('shard1')
+                             .filter(pk=test.pk).exists())
+
+    def testCrossShardRelationRefused(self):
+        test, other = self.create_tests('shard1', 'shard2')
+
+        question = Question.objects.using('shard1').filter(test=test)[0]
+        page = Page.objects.using('shard2').get(test=other)
+        with self.assertRaises(ValueError):
+            question.page = page
+
+        question.page = Page.objects.using('shard1').get(test=test)
+
+    def testFlow(self):
+        test, = self.create_tests('shard2')
+        answers = Answer.objects.using('shard2').filter(test=test) \
+                                                .order_by('pk')
+
+        self.assertContains(self.client.get(reverse('tests:index')),
+                            test.name)
+
+        url = reverse('tests:view', args=(test.pk,))
+        self.client.get(url)
+        response = self.client.post(url, {
+            'question_%d' % answers[0].question_id: [answers[1].pk],
+            'question_%d' % answers[2].question_id: [answers[3].pk],
+        })
+        self.assertRedirects(response, reverse('tests:result',
+                                               args=(test.pk,)))
+
+        attempt = Attempt.objects.using('shard2').get()
+        self.assertEqual(self.client.session['attempt_test_id'], test.pk)
+        self.assertEqual(attempt.score, 2)
+        self.assertEqual(attempt.answers.count(), 2)
+
+        response = self.client.get(reverse('tests:result', args=(test.pk,)))
+        self.assertEqual(response.context['score'], 2)
+
+    def testRebalance(self):
+        # The test is created before shard2 is added
+        ring = routers.HashRing(self.shards)
+        with self.settings(TESTS_SHARD_DATABASES=['shard1']):
+            test = create_test(1, 2, 2, results=(0, 2))
+            while ring.node(test.pk) != 'shard2':
+                test = create_test(1, 2, 2, results=(0, 2))
+            attempt = Attempt.objects.using('shard1').create(test=test)
+            answer = Answer.objects.using('shard1').filter(test=test)[0]
+            AttemptAnswer.objects.using('shard1').create(attempt=attempt,
+                                                         answer=answer)
+            ScoreCount.objects.using('shard1').create(test=test, score=1,
+                                                      count=1)
+            AnswerCount.objects.using('shard1').create(test=test,
+                                                       answer=answer, count=1)
+            ResultCount.objects.using('shard1').create(
+                test=test, count=1,
+                result=Result.objects.using('shard1').filter(test=test)[0])
+            ScoreDistribution.objects.using('shard1').create(test=test)
+
+        out = StringIO()
+        call_command('rebalance_shards', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Test {test}: would be moved from '
+                                         'shard1 to shard2\n'.format(
+                                             test=test.pk))
+        self.assertFalse(Answer.objects.using('shard2').exists())
+
+        out = StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertEqual(out.getvalue(), 'Test {test}: moved from shard1 to '
+                                         'shard2\n'.format(test=test.pk))
+
+        for model, lookup in rebalance_shards.Command.owned:
+            self.assertFalse(model.objects.using('shard1')
+                                  .filter(**{lookup: test.pk}).exists())
+            self.assertTrue(model.objects.using('shard2')
+                                 .filter(**{lookup: test.pk}).exists())
+        self.assertEqual(blueprints.get_blueprint(test.pk).answer_ids,
+                         array('l', Answer.objects.using('shard2')
+                                              .order_by('pk')
+                                              .values_list('pk', flat=True)))
+
+        # Shard2 is removed again
+        with self.settings(TESTS_SHARD_DATABASES=['shard1']):
+            call_command('rebalance_shards', drain=['shard2'],
+                         stdout=StringIO())
+        self.assertFalse(Answer.objects.using('shard2').exists())
+        self.assertEqual(Answer.objects.using('shard1')
+                               .filter(test=test).count(), 4)
+
+
+    def testRebalanceIntoPopulatedShard(self):
+        ring = routers.HashRing(self.shards)
+        with self.settings(TESTS_SHARD_DATABASES=['shard1']):
+            test = create_test(2, 2, 2, results=(0, 2))
+            while ring.node(test.pk) != 'shard2':
+                test = create_test(2, 2, 2, results=(0, 2))
+            answers = list(Answer.objects.using('shard1').filter(test=test)
+                                         .select_related('question')
+                                         .order_by('pk'))
+            result = Result.objects.using('shard1').filter(test=test) \
+                                                   .order_by('limit')[1]
+            finished = Attempt.objects.using('shard1').create(
+                test=test, status=Attempt.FINISHED, score=2, result=result)
+            AttemptAnswer.objects.using('shard1').create(attempt=finished,
+                                                         answer=answers[3])
+            active = Attempt.objects.using('shard1').create(test=test)
+
+        # Shard2 already holds a test, with ids of those of shard1
+        other, = self.create_tests('shard2')
+        for position, page in enumerate(Page.objects.using('shard1')
+                                                    .filter(test=test), 10):
+            Page.objects.using('shard2').create(pk=page.pk, test=other,
+                                                position=position)
+        Attempt.objects.using('shard2').create(pk=active.pk, test=other)
+
+        # Answers of the attempt in progress, only kept in the store
+        active = attempts.load_attempt(active.pk, 'shard1')
+        active.unsaved_answers = [answers[1].pk]
+        attempts.cache_attempt(active)
+
+        other_pages = list(Page.objects.using('shard2').filter(test=other)
+                                                       .values_list('pk'))
+
+        call_command('rebalance_shards', stdout=StringIO())
+
+        self.assertFalse(Page.objects.using('shard1').filter(test=test)
+                                                     .exists())
+        self.assertEqual(list(Page.objects.using('shard2').filter(test=other)
+                                                          .values_list('pk')),
+                         other_pages)
+        self.assertTrue(Attempt.objects.using('shard2')
+                               .filter(pk=active.pk, test=other).exists())
+
+        # References follow the new ids
+        for question in Question.objects.using('shard2').filter(test=test):
+            self.assertEqual(question.page.test_id, test.pk)
+        self.assertEqual(
+            sorted(Answer.objects.using('shard2').filter(test=test)
+                                 .values_list('name', 'question__name')),
+            sorted((answer.name, answer.question.name)
+                   for answer in answers))
+
+        finished = Attempt.objects.using('shard2').get(
+            test=test, status=Attempt.FINISHED)
+        self.assertEqual(finished.result.limit, result.limit)
+        self.assertEqual(finished.result.test_id, test.pk)
+        self.assertEqual([answer.answer.name
+                          for answer in finished.answers.all()],
+                         [answers[3].name])
+
+        active = Attempt.objects.using('shard2').get(test=test,
+                                                     status=Attempt.ACTIVE)
+        self.assertEqual([answer.answer.name
+                          for answer in active.answers.all()],
+                         [answers[1].name])
+
+
+class BenchmarkTests(TestCase):
+    """Tests involving synthetic tests and the flow benchmark"""
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testGenerateTests(self):
+        out = StringIO()
+        call_command('generate_tests', count=2, pages=2, questions=3,
+                     answers=4, results=3, seed=1, stdout=out)
+
+        test = Test.objects.order_by('pk')[0]
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         'Test {test}: 2 pages, 6 questions, 24 answers'
+                         .format(test=test.pk))
+
+        blueprint = blueprints.get_blueprint(test.pk)
+        self.assertEqual(blueprint.page_count, 2)
+        self.assertEqual(len(blueprint.questions(1)), 3)
+        self.assertEqual(len(blueprint.answer_ids), 24)
+        self.assertEqual(len(blueprint.result_ids), 3)
+        self.assertEqual(blueprint.result_limits[0], 0)
+        self.assertEqual(list(Question.objects.filter(test=test)
+                                              .order_by('page__position',
+                                                        'position')
+                                              .values_list('position',
+                                                           flat=True)),
+                         [1, 2, 3, 1, 2, 3])
+
+    def testFlowBenchmark(self):
+        rows = benchmarks.flow_benchmark(sizes=((2, 3),), takes=3,
+                                         isolated=False)
+
+        self.assertEqual([row['step'] for row in rows],
+                         ['index', 'view', 'submit', 'result'])
+        self.assertEqual([row['requests'] for row in rows], [3, 6, 6, 3])
+        for row in rows:
+            self.assertTrue(row['p50_ms'] <= row['p90_ms'] <= row['p99_ms'])
+            self.assertTrue(row['queries'] > 0)
+            if benchmarks.resource is not None:
+                self.assertTrue(0 <= row['rss_growth_kb'] <=
+                                row['process_peak_kb'])
+        self.assertEqual(Attempt.objects.filter(status=Attempt.FINISHED)
+                                        .count(), 3)
+
+    def testRegressions(self):
+        baseline = {'flow': [
+            {'questions': 6, 'step': 'view', 'p50_ms': 10.0, 'queries': 4},
+            {'questions': 6, 'step': 'result', 'p50_ms': 10.0, 'queries': 4},
+        ]}
+
+        self.assertEqual(benchmarks.regressions(baseline, {'flow': [
+            OrderedDict([('questions', 6), ('step', 'result'),
+                         ('p50_ms', 12.0), ('queries', 4)]),
+        ]}), [])
+        self.assertEqual(benchmarks.regressions(baseline, {'flow': [
+            OrderedDict([('questions', 6), ('step', 'view'),
+                         ('p50_ms', 13.0), ('queries', 5)]),
+        ]}), ['flow (questions=6, step=view): p50_ms is 13.0, baseline 10.0',
+              'flow (questions=6, step=view): queries is 5.0, baseline 4.0'])
+
+    def testBaseline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'baseline.json')
+        call_command('benchmark', 'codec', save_baseline=path,
+                     stdout=StringIO())
+
+        with open(path) as f:
+            baseline = json.load(f)
+        for row in baseline['codec']:
+            row['codec_bytes'] -= 1
+        with open(path, 'w') as f:
+            json.dump(baseline, f)
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'codec', baseline=path,
+                         stdout=StringIO())
+
+
+class ProfilingTests(TestCase):
+    """Tests involving the profiling of views"""
+
+    fixtures = ['sample_test.json']
+
+    middleware = global_settings.MIDDLEWARE_CLASSES + \
+        ('tests.profiling.ProfilingMiddleware',)
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+        profiling.stats.clear()
+
+    def tearDown(self):
+        profiling.stats.clear()
+
+    def testResultBreakdown(self):
+        with self.settings(MIDDLEWARE_CLASSES=self.middleware):
+            finish_test(self.client, {'question_1': ['1']})
+            self.client.get(reverse('tests:result', args=(1,)))
+
+        result = profiling.stats.snapshot()['result']
+        self.assertEqual(sorted(result['spans']), [
+            'answers', 'blueprint', 'ranking', 'render', 'scoring',
+            'session', 'suggestions', 'total'])
+        for summary in result['spans'].values():
+            self.assertEqual(summary['count'], 1)
+        self.assertTrue(result['spans']['total']['max'] >=
+                        result['spans']['render']['max'])
+        self.assertEqual(result['queries'].keys(), ['default'])
+        self.assertTrue(result['queries']['default']['p50'] > 0)
+
+    def testOnlyWithMiddleware(self):
+        self.client.get(reverse('tests:view', args=(1,)))
+        self.assertEqual(profiling.stats.snapshot(), {})
+
+        with self.settings(MIDDLEWARE_CLASSES=self.middleware):
+            client = Client()
+            client.get(reverse('tests:view', args=(1,)))
+            client.get(reverse('tests:view', args=(1,)))
+
+        view = profiling.stats.snapshot()['view']
+        self.assertEqual(view['spans']['form']['count'], 2)
+        self.assertEqual(view['spans']['blueprint']['count'], 2)
+
+    def testRollingHistogram(self):
+        histogram = profiling.Histogram(3)
+        for value in [100, 1, 2, 3]:
+            histogram.add(value)
+
+        self.assertEqual(histogram.summary(), {
+            'count': 4, 'mean': 2.0, 'p50': 2, 'p90': 3, 'p99': 3, 'max': 3,
+        })
+
+    def testStaffOnly(self):
+        url = reverse('tests:profile')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        user = User.objects.create_user('staff', password='staff')
+        user.is_staff = True
+        user.save()
+        self.client.login(username='staff', password='staff')
+
+        with self.settings(MIDDLEWARE_CLASSES=self.middleware):
+            Client().get(reverse('tests:index'))
+
+        response = self.client.get(url)
+        self.assertContains(response, '<h2>index</h2>')
+
+        response = self.client.get(url, {'format': 'json'})
+        self.assertEqual(json.loads(response.content)['index']['spans']
+                             ['total']['count'], 1)
+
+
+class ApiTests(TestCase):
+    """Tests involving the JSON API taking whole tests"""
+
+    fixtures = ['sample_test.json']
+
+    answers = {
+        '1': [1, 4],
+        '2': [5],
+        '3': [9],
+        '4': [12],
+        '5': [13],
+        '6': [15, 16],
+        '7': [23],
+        '8': [24],
+    }
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+
+    def post(self, data, content_type='application/json'):
+        return self.client.post(reverse('tests:api_test', args=(1,)),
+                                json.dumps(data), content_type=content_type)
+
+    def testStructure(self):
+        response = self.client.get(reverse('tests:api_test', args=(1,)))
+        test = json.loads(response.content)
+
+        self.assertEqual(test['name'], 'Basic test')
+        self.assertEqual([len(page['questions']) for page in test['pages']],
+                         [3, 2, 3])
+        self.assertEqual(test['pages'][0]['questions'][0], {
+            'id': 1,
+            'name': 'Which are the fastest brands of cars?',
+            'answers': [{'id': 1, 'name': 'Ferrari'},
+                        {'id': 2, 'name': 'Dacia'},
+                        {'id': 3, 'name': 'Porsche'},
+                        {'id': 4, 'name': 'Toyota'}],
+        })
+
+        response = self.client.get(reverse('tests:api_test', args=(1,)),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def testSubmit(self):
+        response = self.post({'answers': self.answers})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['score'], 26)
+        self.assertEqual(data['result'], {'id': 2, 'text': 'Good...'})
+        self.assertEqual(data['better_result'], {
+            'text': 'Brilliant!',
+            'answers': [{'question': 'Which of these are insects?',
+                         'answer': 'Mosquito'}],
+        })
+        self.assertTrue(data['proven'])
+
+        attempt = Attempt.objects.get(pk=data['attempt'])
+        self.assertEqual(attempt.status, Attempt.FINISHED)
+        self.assertEqual(attempt.score, 26)
+        self.assertEqual(sorted(attempt.answers.values_list('answer',
+                                                            flat=True)),
+                         [1, 4, 5, 9, 12, 13, 15, 16, 23, 24])
+        self.assertNotIn('attempt_id', self.client.session)
+
+    def testValidation(self):
+        answers = dict(self.answers)
+        del answers['2']
+        answers['3'] = [9, 1]
+        answers['99'] = [1]
+
+        response = self.post({'answers': answers})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {'errors': {
+            '2': 'This field is required.',
+            '3': 'Select a valid choice. 1 is not one of the available '
+                 'choices.',
+            '99': 'Unknown question.',
+        }})
+        self.assertFalse(Attempt.objects.exists())
+
+        response = self.post({'answers': [1, 2]})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(reverse('tests:api_test', args=(1,)),
+                                    'answers', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(reverse('tests:api_test', args=(1,)),
+                                    {'answers': '1'})
+        self.assertEqual(response.status_code, 415)
+
+    def testMissingTest(self):
+        response = self.client.get(reverse('tests:api_test', args=(2,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class AdminTests(TestCase):
+    """Tests involving the admin of large tests"""
+
+    fixtures = ['sample_test.json']
+    urls = 'tests.test_urls'
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        blueprints.cache.clear()
+
+    def testSetAnswerScores(self):
+        with self.assertNumQueries(1):
+            updated = set_answer_scores(1, {1: 10, 2: -10})
+
+        self.assertEqual(updated, 2)
+        self.assertEqual(Answer.objects.get(pk=1).score, 10)
+        self.assertEqual(Answer.objects.get(pk=2).score, -10)
+
+        # Answers of other tests are left alone
+        self.assertEqual(set_answer_scores(2, {3: 10}), 0)
+        self.assertEqual(Answer.objects.get(pk=3).score, 3)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(set_answer_scores(1, {}), 0)
+
+    def testScoresView(self):
+        url = reverse('admin:tests_test_scores', args=(1,))
+        response = self.client.get(url)
+        self.assertContains(response, 'Which are the fastest brands of cars?')
+        self.assertContains(response, 'Ferrari')
+
+        # Warm the blueprint, which must be dropped
+        blueprints.cache.get(1)
+
+        data = dict(('answer_{id}'.format(id=answer.pk), answer.score)
+                    for answer in Answer.objects.filter(test=1))
+        data['answer_1'] = 5
+        response = self.client.post(url, data)
+
+        self.assertRedirects(response, reverse('admin:tests_test_change',
+                                               args=(1,)))
+        self.assertEqual(Answer.objects.get(pk=1).score, 5)
+        blueprint = blueprints.cache.get(1)
+        position = list(blueprint.answer_ids).index(1)
+        self.assertEqual(blueprint.answer_scores[position], 5)
+
+        data['answer_1'] = 'five'
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Answer.objects.get(pk=1).score, 5)
+
+    def testPagesListed(self):
+        response = self.client.get(reverse('admin:tests_test_change',
+                                           args=(1,)))
+        self.assertNotContains(response, 'pages-0-name')
+        url = '{changelist}?test__id__exact=1'.format(
+            changelist=reverse('admin:tests_page_changelist'))
+        self.assertContains(response, '<a href="{url}">3 pages</a>'.format(
+            url=url), html=True)
+
+        response = self.client.get(url)
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def testEditScoresAction(self):
+        response = self.client.post(reverse('admin:tests_test_changelist'), {
+            'action': 'edit_scores',
+            '_selected_action': [1],
+        })
+        self.assertRedirects(response, reverse('admin:tests_test_scores',
+                                               args=(1,)))
+
+    def testEditScoresActionMultipleTests(self):
+        Test.objects.create(name='Other test')
+        url = reverse('admin:tests_test_changelist')
+        response = self.client.post(url, {
+            'action': 'edit_scores',
+            '_selected_action': [1, 2],
+        }, follow=True)
+        self.assertRedirects(response, url)
+        self.assertContains(response, 'select a single test')
+
+    def testSetManyAnswerScores(self):
+        Answer.objects.bulk_create([
+            Answer(test_id=1, question_id=1, name='Many', score=0)
+            for i in range(400)])
+        answer_ids = list(Answer.objects.filter(name='Many')
+                                        .values_list('pk', flat=True))
+
+        # Two UPDATEs on SQLite, within its limit of query parameters
+        with self.assertNumQueries(2):
+            updated = set_answer_scores(1, dict((answer_id, 5)
+                                                for answer_id in answer_ids))
+        self.assertEqual(updated, 400)
+        self.assertEqual(Answer.objects.filter(name='Many', score=5).count(),
+                         400)
+
+
+class TransferTests(TestCase):
+    """Tests involving export and import of tests as JSON lines"""
+
+    fixtures = ['sample_test.json']
+
+    def describe(self, test):
+        """Describes a test's content, regardless of ids"""
+
+        return (
+            test.name,
+            [(page.name, page.position,
+              [(question.name, question.position,
+                sorted((answer.name, answer.score)
+                       for answer in question.answers.all()))
+               for question in page.questions.all()])
+             for page in test.pages.all()],
+            sorted((result.text, result.limit)
+                   for result in test.results.all()),
+        )
+
+    def export(self, *test_ids):
+        out = StringIO()
+        call_command('export_tests', *test_ids, stdout=out)
+        return out.getvalue()
+
+    def testRoundTrip(self):
+        data = self.export('1')
+        lines = data.splitlines()
+        self.assertEqual(len(lines), 1 + 3 + 8 + 25 + 3)
+        self.assertEqual(json.loads(lines[1])['model'], 'tests.page')
+
+        path = os.path.join(tempfile.mkdtemp(), 'tests.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data + data)
+
+        out = StringIO()
+        # Small chunks, so pages and questions are remapped across chunks
+        call_command('import_tests', path, chunk_size=2, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'Test 2: 3 pages, 8 questions, 25 answers, 3 results',
+            'Test 3: 3 pages, 8 questions, 25 answers, 3 results',
+        ])
+
+        original = self.describe(Test.objects.get(pk=1))
+        self.assertEqual(self.describe(Test.objects.get(pk=2)), original)
+        self.assertEqual(self.describe(Test.objects.get(pk=3)), original)
+        self.assertEqual(Answer.objects.filter(test=2).count(), 25)
+        self.assertEqual(Answer.objects.filter(question__test=2).count(), 25)
+
+        # Imported tests are taken like any other
+        self.assertEqual(list(blueprints.get_blueprint(2).answer_scores),
+                         list(blueprints.get_blueprint(1).answer_scores))
+        response = self.client.get(reverse('tests:view', args=(2,)))
+        self.assertContains(response, 'Which are the fastest brands of cars?')
+
+    def testStreamed(self):
+        lines = iter(self.export('1').splitlines())
+        imported = transfer.import_tests(lines, chunk_size=10)
+
+        test, counts = next(imported)
+        self.assertEqual(counts[Answer], 25)
+        # Only the lines of the first test have been read
+        self.assertRaises(StopIteration, next, lines)
+
+    def testInvalid(self):
+        lines = self.export('1').splitlines()
+
+        for invalid in [lines[1:], ['nonsense'], lines[:20] + ['[]'],
+                        lines[:5] + ['{"model": "tests.answer", "pk": 1, '
+                                     '"fields": {"name": "Answer", '
+                                     '"score": 1, "question": 99}}']]:
+            with self.assertRaises(ValueError):
+                list(transfer.import_tests(invalid))
+
+        with self.assertRaises(CommandError):
+            call_command('export_tests', '1', '5', stdout=StringIO())
+
+
+class TransferTransactionTests(TransactionTestCase):
+    """Tests involving transactions of imports"""
+
+    fixtures = ['sample_test.json']
+
+    multi_db = True
+
+    def testRolledBack(self):
+        out = StringIO()
+        call_command('export_tests', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+
+        with self.assertRaises(ValueError):
+            list(transfer.import_tests(lines + lines[:20] + ['[]']))
+
+        # Only the test failing to import is rolled back
+        self.assertEqual(Test.objects.count(), 2)
+        self.assertEqual(Page.objects.count(), 6)
+        self.assertEqual(Answer.objects.count(), 50)
+
+    def testRolledBackOnShard(self):
+        out = StringIO()
+        call_command('export_tests', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+        shard_tests = Test.objects.using('shard1').count()
+
+        with self.settings(TESTS_SHARD_DATABASES=['shard1']):
+            with self.assertRaises(ValueError):
+                list(transfer.import_tests(lines[:20] + ['[]']))
+
+        # Neither the test nor its copy on the shard are left behind
+        self.assertEqual(Test.objects.count(), 1)
+        self.assertEqual(Test.objects.using('shard1').count(), shard_tests)
+
+
+class AnalyticsTests(TestCase):
+    """Tests involving analytics of finished attempts"""
+
+    fixtures = ['sample_test.json']
+
+    answers = ApiTests.answers
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+
+    def finish(self, answers):
+        response = self.client.post(reverse('tests:api_test', args=(1,)),
+                                    json.dumps({'answers': answers}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def testAddCounts(self):
+        analytics.add_counts(AnswerCount, 'answer', 1, [1, 2])
+        with self.assertNumQueries(2):
+            analytics.add_counts(AnswerCount, 'answer', 1, [1, 2])
+        analytics.add_counts(AnswerCount, 'answer', 1, [2, 3])
+
+        self.assertEqual(dict(AnswerCount.objects.values_list('answer',
+                                                              'count')),
+                         {1: 2, 2: 3, 3: 1})
+
+    def testCounted(self):
+        self.finish(self.answers)
+        answers = dict(self.answers, **{'1': [1, 2], '8': [25]})
+        self.finish(answers)
+
+        self.assertEqual(list(ScoreCount.objects.order_by('score')
+                                                .values_list('score',
+                                                             'count')),
+                         [(14, 1), (26, 1)])
+        self.assertEqual(dict(ResultCount.objects.values_list('result',
+                                                              'count')),
+                         {1: 1, 2: 1})
+        self.assertEqual(AnswerCount.objects.get(answer=1).count, 2)
+        self.assertEqual(AnswerCount.objects.get(answer=2).count, 1)
+        self.assertFalse(AnswerCount.objects.filter(answer=3).exists())
+
+    def testEndpoint(self):
+        url = reverse('tests:analytics', args=(1,))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.finish(self.answers)
+        self.finish(self.answers)
+
+        user = User.objects.create_user('staff', 'staff@example.com',
+                                        'staff')
+        user.is_staff = True
+        user.save()
+        self.client.login(username='staff', password='staff')
+
+        # Session, user and counters (the blueprint is cached)
+        with self.assertNumQueries(2 + 3):
+            data = json.loads(self.client.get(url).content)
+
+        self.assertEqual(data['attempts'], 2)
+        self.assertEqual(data['scores'], [{'score': 26, 'count': 2}])
+        self.assertEqual([(band['id'], band['count'], band['rate'])
+                          for band in data['results']],
+                         [(None, 0, 0.0), (1, 0, 0.0), (2, 2, 1.0),
+                          (3, 0, 0.0)])
+        self.assertEqual(data['questions'][0]['answers'][:2], [
+            {'id': 1, 'name': 'Ferrari', 'count': 2, 'rate': 1.0},
+            {'id': 2, 'name': 'Dacia', 'count': 0, 'rate': 0.0},
+        ])
+
+
+class RankingTests(TestCase):
+    """Tests involving percentile ranking of scores"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+        suggestions.get_suggestions_cache().clear()
+        cache.clear()
+
+    def finish(self, answers):
+        response = Client().post(reverse('tests:api_test', args=(1,)),
+                                 json.dumps({'answers': answers}),
+                                 content_type='application/json')
+        return json.loads(response.content)['score']
+
+    def testBetterThan(self):
+        distribution = ranking.Distribution(1, 'version',
+                                            array('l', [2, 5, 9]),
+                                            array('l', [1, 3, 4]))
+        self.assertEqual(distribution.total, 4)
+        self.assertEqual(distribution.better_than(1), 0)
+        self.assertEqual(distribution.better_than(2), 0)
+        self.assertEqual(distribution.better_than(5), 25)
+        self.assertEqual(distribution.better_than(6), 75)
+        self.assertEqual(distribution.better_than(10), 100)
+
+        empty = ranking.Distribution(1, 'version', array('l'), array('l'))
+        self.assertEqual(empty.better_than(1), None)
+
+    def testResultRanked(self):
+        answers = dict(ApiTests.answers)
+        self.assertEqual(self.finish(answers), 26)
+        self.assertEqual(self.finish(dict(answers, **{'1': [1, 2],
+                                                      '8': [25]})), 14)
+        finish_test(self.client, dict(
+            ('question_' + question, answer_ids)
+            for question, answer_ids in answers.items()))
+        url = reverse('tests:result', args=(1,))
+
+        # Scores are only ranked once distributions are computed
+        self.assertEqual(self.client.get(url).context['better_than'], None)
+
+        out = StringIO()
+        call_command('rank_tests', stdout=out)
+        self.assertEqual(out.getvalue(),
+                         'Test 1: 3 attempts, 2 distinct scores\n')
+
+        with self.assertNumQueries(0):
+            distribution = ranking.get_distribution(
+                blueprints.get_blueprint(1))
+        self.assertEqual(list(distribution.scores), [14, 26])
+        self.assertEqual(list(distribution.cumulative), [1, 3])
+
+        response = self.client.get(url)
+        self.assertAlmostEqual(response.context['better_than'], 100 / 3.0)
+        self.assertContains(response, 'better than 33% of takers')
+
+        # Distributions are kept when the test is edited without changing
+        # scoring...
+        answer = Answer.objects.get(pk=25)
+        answer.name = 'Renamed'
+        answer.save()
+        self.assertAlmostEqual(self.client.get(url).context['better_than'],
+                               100 / 3.0)
+
+        # ...and attempts scored on it are not rescored, only the one
+        # finished without a score is
+        blueprint = blueprints.get_blueprint(1)
+        with self.assertNumQueries(4):
+            distribution = ranking.compute_distribution(blueprint,
+                                                        chunk_size=1)
+        self.assertEqual(list(distribution.cumulative), [1, 3])
+
+        # ...but those of previous scorings are not used
+        answer = Answer.objects.get(pk=25)
+        answer.score = 20
+        answer.save()
+        self.assertEqual(self.client.get(url).context['better_than'], None)
+
+        call_command('rank_tests', '1', chunk_size=1, stdout=StringIO())
+        cache.clear()
+        distribution = ranking.get_distribution(blueprints.get_blueprint(1))
+        self.assertEqual(list(distribution.scores), [26, 39])
+        self.assertEqual(self.client.get(url).context['better_than'], 0)
+
+
+class AttemptStoreTests(TestCase):
+    """Tests involving the store of attempts in progress"""
+
+    fixtures = ['sample_test.json']
+
+    pages = [
+        {'question_1': ['4'], 'question_2': ['5', '7'],
+         'question_3': ['9', '10']},
+        {'question_4': ['11'], 'question_5': ['13', '14']},
+        {'question_6': ['15'], 'question_7': ['22', '23'],
+         'question_8': ['25']},
+    ]
+
+    def setUp(self):
+        blueprints.cache.clear()
+        self.url = reverse('tests:view', args=(1,))
+        self.client.get(self.url)
+        self.attempt_id = self.client.session['attempt_id']
+
+    def testNoWrites(self):
+        # Session only, as the blueprint and the attempt are cached
+        with self.assertNumQueries(1):
+            self.client.post(self.url, self.pages[0])
+
+        # The page is only submitted once
+        self.client.post(self.url, self.pages[0])
+        self.assertEqual(
+            sorted(attempts.load_attempt(self.attempt_id).unsaved_answers),
+            [4, 5, 7, 9, 10])
+
+    def testSharedCacheRequired(self):
+        with self.settings(TESTS_ATTEMPT_CACHE_LOCAL=False):
+            self.assertRaises(ImproperlyConfigured,
+                              attempts.get_attempt_cache)
+
+        with self.settings(TESTS_ATTEMPT_CACHE_LOCAL=False,
+                           TESTS_ATTEMPT_CACHE='file://' +
+                                               tempfile.gettempdir()):
+            attempts.get_attempt_cache()
+
+    def testWriteBehind(self):
+        with self.settings(TESTS_ATTEMPT_WRITE_BEHIND=2):
+            self.client.post(self.url, self.pages[0])
+            self.assertEqual(Attempt.objects.get().page_number, 1)
+
+            self.client.post(self.url, self.pages[1])
+            attempt = Attempt.objects.get()
+            self.assertEqual(attempt.page_number, 3)
+            self.assertEqual(attempt.answers.count(), 8)
+            self.assertEqual(
+                attempts.load_attempt(self.attempt_id).unsaved_answers, [])
+
+    def testRecovered(self):
+        with self.settings(TESTS_ATTEMPT_WRITE_BEHIND=1):
+            self.client.post(self.url, self.pages[0])
+        self.client.post(self.url, self.pages[1])
+
+        # Pages submitted since the attempt was last written are lost
+        attempts.get_attempt_cache().clear()
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['page_number'], 2)
+
+        self.client.post(self.url, self.pages[1])
+        self.client.post(self.url, self.pages[2])
+        attempt = Attempt.objects.get()
+        self.assertEqual(attempt.status, Attempt.FINISHED)
+        self.assertEqual(attempt.answers.count(), 12)
+        self.assertEqual(attempt.score, 5)
+
+    def testLastPageRemoved(self):
+        self.client.post(self.url, self.pages[0])
+        self.client.post(self.url, self.pages[1])
+        Page.objects.get(test=1, position=3).delete()
+
+        # The attempt is past the last page, so it is finished
+        response = self.client.get(self.url)
+        self.assertRedirects(response, reverse('tests:result', args=(1,)))
+        attempt = Attempt.objects.get()
+        self.assertEqual(attempt.status, Attempt.FINISHED)
+        self.assertEqual(attempt.answers.count(), 8)
+        self.assertEqual(ScoreCount.objects.get(test=1).score, attempt.score)
+
+    def testGivenUp(self):
+        self.client.post(self.url, self.pages[0])
+        self.client.get(reverse('tests:give_up'))
+
+        attempt = Attempt.objects.get()
+        self.assertEqual(attempt.status, Attempt.GIVEN_UP)
+        self.assertEqual(attempt.answers.count(), 5)
+        self.assertIsNone(attempts.get_attempt_cache().get(
+            attempts.state_key(self.attempt_id)))
+
+
+class WarmUpTests(TestCase):
+    """Tests involving the warm-up of blueprints before serving requests"""
+
+    fixtures = ['sample_test.json']
+
+    def setUp(self):
+        blueprints.cache.clear()
+
+    def testActiveTests(self):
+        other = create_test(1, 1, 2)
+        last = create_test(1, 1, 2)
+        ScoreCount.objects.create(test=last, score=1, count=1)
+        ScoreCount.objects.create(test=last, score=2, count=2)
+        ScoreCount.objects.create(test_id=1, score=1, count=2)
+
+        self.assertEqual(warmup.active_tests(2), [last.pk, 1])
+        self.assertEqual(warmup.active_tests(5), [last.pk, 1, other.pk])
+
+    def testWarmUp(self):
+        rows = warmup.warm_up()
+
+        self.assertEqual([(row['test'], row['pages'], row['answers'])
+                          for row in rows], [(1, 3, 25)])
+        self.assertTrue(rows[0]['bytes'] > 0)
+
+        # Pages are served without loading the test
+        with self.assertNumQueries(0):
+            blueprints.get_blueprint(1)
+            forms.page_markup(blueprints.get_blueprint(1), 0)
+
+    def testConnectionsClosed(self):
+        Test.objects.using('shard1').exists()
+        self.assertIsNotNone(db.connections['shard1'].connection)
+
+        warmup.warm_up()
+        self.assertIsNone(db.connections['shard1'].connection)
+
+    def testCommand(self):
+        out = StringIO()
+        call_command('warm_up', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+
+        self.assertTrue(lines[0].startswith('Test 1: 3 pages, 25 answers, '))
+        self.assertTrue(lines[1].startswith('1 tests: '))
+
+        with self.assertRaises(CommandError):
+            call_command('warm_up', '5', stdout=StringIO())
@@ -0,0 +1,249 @@
+"""
+Streaming export and import of tests, as JSON lines.
+
+Each line holds one object, in the format of Django fixtures, e.g.:
+{"model": "tests.page", "pk": 4, "fields": {"name": "...", "test": 2,
+"position": 1}}. A test is written first, followed by its pages,
+questions, answers and results, in this order; objects refer to each
+other by their exported ids.
+
+Export iterates over objects without caching them; import reads one line
+at a time and creates objects in chunks with bulk_create. Imported objects
+get new ids: pages and questions are looked up after being created, by
+their position, to remap references of the objects that follow them.
+Memory used is bounded by the chunk size and the number of pages and
+questions of a single test.
+"""
+
+import json
+from itertools import groupby
+
+from django.db import transaction
+
+from models import Test, Page, Question, Answer, Result, shard_copy
+from routers import primary_database, database_for_test
+
+
+# Exported models, along with their exported fields
+models = [
+    (Test, ('name', 'description')),
+    (Page, ('name', 'test', 'position')),
+    (Question, ('name', 'page', 'position')),
+    (Answer, ('name', 'score', 'question')),
+    (Result, ('text', 'limit', 'test')),
+]
+
+labels = dict((model, '{app}.{model}'.format(app=model._meta.app_label,
+                                             model=model._meta.module_name))
+              for model, fields in models)
+labelled = dict((label, model) for model, label in labels.items())
+
+
+def test_records(test_id):
+    """Yields the records of a test and its objects, as exported"""
+
+    using = database_for_test(test_id)
+
+    for model, fields in models:
+        objects = model.objects.using(using if model is not Test else None)
+        if model is Test:
+            objects = objects.filter(pk=test_id)
+        elif model is Question:
+            objects = objects.filter(test=test_id) \
+                             .order_by('page__position', 'position')
+        else:
+            objects = objects.filter(test=test_id).order_by('pk')
+
+        for values in objects.values('pk', *fields).iterator():
+            yield {
+                'model': labels[model],
+                'pk': values.pop('pk'),
+                'fields': values,
+            }
+
+
+def export_tests(test_ids, stream):
+    """
+    Writes given tests to stream, one object per line; returns the number
+    of objects written
+    """
+
+    count = 0
+    for test_id in test_ids:
+        for record in test_records(test_id):
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+            count += 1
+
+    return count
+
+
+class TestImport(object):
+    """
+    Imports the objects of a test, in chunks, remapping references to
+    their new ids
+    """
+
+    def __init__(self, test, using, chunk_size):
+        self.test = test
+        self.using = using
+        self.chunk_size = chunk_size
+
+        # New ids of pages and questions, by exported id
+        self.pages = {}
+        self.questions = {}
+
+        # Objects not created yet, all of a single model, along with the
+        # exported ids of pages and questions, by position
+        self.model = None
+        self.pending = []
+        self.pending_ids = {}
+
+        self.counts = dict((model, 0) for model, fields in models[1:])
+
+    def reference(self, ids, model, pk):
+        try:
+            return ids[pk]
+        except KeyError:
+            raise ValueError('Unknown {model} {pk}.'.format(
+                model=labels[model], pk=pk))
+
+    def add(self, record):
+        """Adds an object of the test, given its record"""
+
+        model = labelled.get(record['model'])
+        if model is None or model is Test:
+            raise ValueError('Unexpected {model} in test.'.format(
+                model=record['model']))
+
+        # Pages are created before the questions referring to them, and
+        # questions before their answers
+        if model is not self.model or len(self.pending) >= self.chunk_size:
+            self.flush()
+            self.model = model
+
+        fields = record['fields']
+
+        if model is Page:
+            obj = Page(name=fields['name'], test=self.test,
+                       position=fields['position'])
+            key = obj.position
+        elif model is Question:
+            obj = Question(name=fields['name'], test=self.test,
+                           page_id=self.reference(self.pages, Page,
+                                                  fields['page']),
+                           position=fields['position'])
+            key = (obj.page_id, obj.position)
+        elif model is Answer:
+            obj = Answer(name=fields['name'], score=fields['score'],
+                         test=self.test,
+                         question_id=self.reference(self.questions, Question,
+                                                    fields['question']))
+            key = None
+        else:
+            obj = Result(text=fields['text'], limit=fields['limit'],
+                         test=self.test)
+            key = None
+
+        self.pending.append(obj)
+        if key is not None:
+            self.pending_ids[key] = record['pk']
+
+    def flush(self):
+        """Creates pending objects, and remaps pages and questions"""
+
+        if not self.pending:
+            return
+
+        self.model.objects.using(self.using).bulk_create(self.pending)
+        self.counts[self.model] += len(self.pending)
+
+        if self.model is Page:
+            positions = list(self.pending_ids)
+            created = Page.objects.using(self.using) \
+                                  .filter(test=self.test,
+                                          position__in=positions) \
+                                  .values_list('position', 'pk')
+            for position, pk in created:
+                self.pages[self.pending_ids[position]] = pk
+        elif self.model is Question:
+            page_ids = set(page_id for page_id, position in self.pending_ids)
+            created = Question.objects.using(self.using) \
+                                      .filter(page__in=page_ids) \
+                                      .values_list('page', 'position', 'pk')
+            for page_id, position, pk in created:
+                if (page_id, position) in self.pending_ids:
+                    self.questions[self.pending_ids[page_id, position]] = pk
+
+        self.pending = []
+        self.pending_ids = {}
+
+
+def import_test(records, chunk_size):
+    """
+    Imports a test from its records, as exported, and returns the test
+    along with the number of objects of each model imported
+    """
+
+    record = next(records)
+    if record.get('model') != labels[Test]:
+        raise ValueError('Expected a test, got {model}.'.format(
+            model=record.get('model')))
+
+    fields = record['fields']
+
+    with transaction.commit_on_success(using=primary_database()):
+        test = Test(name=fields['name'], description=fields['description'])
+        # Copied to its shard along with its objects, so that a failed
+        # import leaves no test behind
+        test.copy_to_shard = False
+        test.save()
+        using = database_for_test(test.pk) or primary_database()
+
+        with transaction.commit_on_success(using=using):
+            if using != primary_database():
+                shard_copy(test).save(using=using)
+
+            test_import = TestImport(test, using, chunk_size)
+            for record in records:
+                test_import.add(record)
+            test_import.flush()
+
+    return test, test_import.counts
+
+
+def import_tests(lines, chunk_size=500):
+    """
+    Imports tests from given lines, as written by export_tests, one test
+    at a time; yields each test imported along with the number of objects
+    of each model imported. Raises ValueError if lines are malformed, in
+    which case the test being imported is rolled back.
+    """
+
+    def records():
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict) or \
+               not set(['model', 'pk', 'fields']) <= set(record):
+                raise ValueError('Line {number} is not an object '
+                                 'record.'.format(number=number))
+            yield record
+
+    # Each test starts a new group, along with the objects that follow it
+    tests = [0]
+
+    def test_number(record):
+        if record['model'] == labels[Test]:
+            tests[0] += 1
+        return tests[0]
+
+    for number, test_records in groupby(records(), test_number):
+        try:
+            yield import_test(test_records, chunk_size)
+        except (KeyError, TypeError) as e:
+            raise ValueError('Missing or invalid field: {error}.'.format(
+                error=e))
@@ -1,6 +1,7 @@
 from django.conf.urls import patterns, include, url
 
-from views import index, view, give_up, result
+from views import index, view, give_up, result, suggestions, profile, \
+                  analytics, api_test
 
 
 test_patterns = patterns('',
@@ -8,6 +9,10 @@ test_patterns = patterns('',
     url(r'^(\d+)/$', view, name='view'),
     url(r'^give-up/$', give_up, name='give_up'),
     url(r'^(\d+)/result/$', result, name='result'),
+    url(r'^(\d+)/result/suggestions/$', suggestions, name='suggestions'),
+    url(r'^profile/$', profile, name='profile'),
+    url(r'^(\d+)/analytics/$', analytics, name='analytics'),
+    url(r'^api/(\d+)/$', api_test, name='api_test'),
 )
 
 urlpatterns = patterns('',
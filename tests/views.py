@@ -1,91 +1,331 @@
-from itertools import chain, combinations
-from collections import defaultdict
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseNotAllowed, \
+                        HttpResponseNotModified, Http404
+from django.middleware.csrf import get_token
+from django.shortcuts import render, redirect
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+
+from models import Test, Answer, Attempt, AttemptAnswer
+from forms import page_form_class, page_markup, clean_answers
+from blueprints import get_blueprint
+from catalog import CatalogPage, catalog_version, catalog_timeout
+from routers import database_for_test
+from profiling import span, profiled, stats
+from suggestions import cached_similar_results
+from analytics import test_analytics
+from ranking import get_distribution
+from attempts import load_attempt, cache_attempt, save_attempt, \
+                     advance_attempt, finish_attempt, unsaved_answers
+import codec
+import jobs
+
+
+@profiled('blueprint')
+def get_blueprint_or_404(test_id):
+    """Returns the blueprint of a test, raising Http404 if it is missing"""
+
+    try:
+        return get_blueprint(test_id)
+    except Test.DoesNotExist:
+        raise Http404
+
+
+def checked_answers(attempt, blueprint):
+    """
+    Returns positions of the answers checked in an attempt, decoding them
+    if they have been encoded for the current version of the test, or
+    loading them from the database (and the attempt store) otherwise
+    """
+
+    if attempt.checked_version == blueprint.version:
+        try:
+            return codec.decode(blueprint, attempt.checked)
+        except ValueError:
+            pass
+
+    return blueprint.positions(
+        list(attempt.answers.values_list('answer', flat=True)) +
+        unsaved_answers(attempt))
+
+
+def save_answers(attempt, blueprint, positions):
+    """Stores checked answers of an attempt, given as answer positions"""
+
+    AttemptAnswer.objects.using(attempt._state.db).bulk_create([
+        AttemptAnswer(attempt=attempt,
+                      answer_id=blueprint.answer_ids[position])
+        for position in positions])
+
+
+def form_positions(blueprint, answers):
+    """
+    Returns positions of answers given as page form cleaned data
+    e.g.: {'question_1': ['1', '3'], ...}
+    """
+
+    positions = []
+    for answer_ids in answers.itervalues():
+        positions.extend(blueprint.positions(answer_ids))
+
+    return positions
+
+
+def upgrade_session(request):
+    """
+    Stores the test held in the session by previous versions of the app
+    (test_status, test_id, page_number, page_count and answers) as an
+    attempt, and returns it
+    """
+
+    test_id = request.session.pop('test_id')
+    status = request.session.pop('test_status', Attempt.ACTIVE)
+    page_number = request.session.pop('page_number', 1)
+    request.session.pop('page_count', None)
+    answers = request.session.pop('answers', {})
+
+    try:
+        blueprint = get_blueprint(test_id)
+    except Test.DoesNotExist:
+        return None
+
+    positions = form_positions(blueprint, answers)
+
+    using = database_for_test(blueprint.test_id)
+    with transaction.commit_on_success(using=using):
+        attempt = Attempt.objects.using(using).create(
+            test_id=blueprint.test_id,
+            page_number=page_number,
+            checked=codec.encode(blueprint, positions),
+            checked_version=blueprint.version)
+        save_answers(attempt, blueprint, positions)
+        if status == Attempt.FINISHED:
+            finish_attempt(attempt, blueprint, positions)
+
+    remember_attempt(request, attempt)
+
+    return attempt
+
+
+def page_etag(request, blueprint, page_number):
+    """
+    Returns the ETag of a test page, changing along with the test version,
+    the page and the CSRF token of the client (held by the page form)
+    """
+
+    return hashlib.md5('{test}:{version}:{page}:{token}'.format(
+        test=blueprint.test_id, version=blueprint.version, page=page_number,
+        token=get_token(request))).hexdigest()
+
+
+def describe_suggestion(blueprint, suggestion):
+    """Describes a suggested result and answers, from the blueprint"""
+
+    if suggestion is None:
+        return None
+
+    answers = []
+    for answer_id in suggestion['answers']:
+        position = blueprint.answer_positions[answer_id]
+        question = blueprint.answer_questions[position]
+        answers.append({
+            'question': blueprint.question_names[question],
+            'answer': blueprint.answer_names[position],
+        })
+
+    return {
+        'text': blueprint.result_by_id(suggestion['result']).text,
+        'answers': answers,
+    }
+
+
+def json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+                        content_type='application/json')
+
+
+def remember_attempt(request, attempt):
+    """
+    Stores an attempt in the session, along with its test when tests are
+    sharded, as the attempt is kept on the shard of its test
+    """
+
+    request.session['attempt_id'] = attempt.pk
+    if database_for_test(attempt.test_id) is not None:
+        request.session['attempt_test_id'] = attempt.test_id
+
+
+def forget_attempt(request):
+    """Removes the attempt stored in the session"""
+
+    del request.session['attempt_id']
+    request.session.pop('attempt_test_id', None)
+
 
-from django.http import HttpResponse
-from django.shortcuts import render, redirect, get_object_or_404
+@profiled('session')
+def current_attempt(request):
+    """Returns the attempt of the test started in the session, if any"""
 
-from models import Test, Question, Answer, Result
-from forms import PageForm
+    if 'attempt_id' not in request.session:
+        if 'test_id' in request.session:
+            return upgrade_session(request)
+        return None
+
+    test_id = request.session.get('attempt_test_id')
+    attempt = load_attempt(request.session['attempt_id'],
+                           database_for_test(test_id))
+
+    # Attempts get new ids when their test moves to another shard, where
+    # the id may belong to another test's attempt
+    if attempt is not None and test_id is not None and \
+       attempt.test_id != test_id:
+        attempt = None
+    if attempt is None:
+        forget_attempt(request)
+
+    return attempt
+
+
+def cursor(request, name):
+    """Returns the pagination cursor with given name, if valid"""
+
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
 
 
 def index(request):
-    """Base view, showing all tests"""
+    """Base view, showing a page of tests"""
+
+    attempt = current_attempt(request)
 
     context = {
-        'tests': Test.objects.all(),
-        'test_status': request.session.get('test_status', None),
-        'active_test': request.session.get('test_id', None),
+        # Tests are only fetched if the page isn't cached
+        'tests': CatalogPage(after=cursor(request, 'after'),
+                             before=cursor(request, 'before')),
+        'catalog_version': catalog_version(),
+        'catalog_timeout': catalog_timeout(),
+        'test_status': attempt.status if attempt else None,
+        'active_test': attempt.test_id if attempt else None,
     }
 
-    return render(request, 'tests/index.html', context)
+    with span('render'):
+        return render(request, 'tests/index.html', context)
 
 
 def view(request, test_id):
     """Test view, displays a test's pages"""
 
+    attempt = current_attempt(request)
+
     # If another test is started, go to that test
-    if 'test_id' in request.session and \
-       request.session['test_id'] != test_id:
-        return redirect('tests:view', request.session['test_id'])
+    if attempt is not None and attempt.test_id != int(test_id):
+        return redirect('tests:view', attempt.test_id)
 
-    # Attempt to load the test with test_id
-    test = get_object_or_404(Test, pk=test_id)
+    # Attempt to load the blueprint of the test with test_id
+    blueprint = get_blueprint_or_404(test_id)
 
-    # If test_id is not started, start it
-    if 'test_id' not in request.session:
-        request.session['test_status'] = 'active'
-        request.session['test_id'] = test_id
-        request.session['page_number'] = 1
-        request.session['page_count'] = test.pages.count()
-        request.session['answers'] = {}
+    # If test_id is not started, start it, with no answers checked
+    if attempt is None:
+        attempt = Attempt.objects \
+            .using(database_for_test(blueprint.test_id)) \
+            .create(test_id=blueprint.test_id,
+                    checked=codec.encode(blueprint, []),
+                    checked_version=blueprint.version)
+        cache_attempt(attempt)
+        remember_attempt(request, attempt)
 
-    page_number = request.session['page_number']
-    page_count = request.session['page_count']
+    page_number = attempt.page_number
+    page_count = blueprint.page_count
 
     # This means that a test is finished, so proceed to the results
-    if request.session['test_status'] == 'finished':
+    if attempt.status == Attempt.FINISHED:
+        return redirect('tests:result', test_id)
+
+    # Attempts past the last page (e.g. once pages are removed from the
+    # test) are finished, as if a page with no answers had been submitted
+    if page_number > page_count:
+        with span('save'):
+            advance_attempt(attempt, blueprint, page_number, [],
+                            codec.encode(blueprint, checked_answers(
+                                attempt, blueprint)))
         return redirect('tests:result', test_id)
 
-    page = test.pages.all()[page_number-1]
+    with span('form'):
+        form_class = page_form_class(blueprint, page_number - 1)
 
     # If page form has been submitted
     if request.method == 'POST':
-        form = PageForm(request.POST, page=page)
+        form = form_class(request.POST)
 
         if form.is_valid():
-            # Save answers in session
-            request.session['answers'].update(form.cleaned_data)
+            with span('scoring'):
+                page_positions = form_positions(blueprint, form.cleaned_data)
+                positions = checked_answers(attempt, blueprint) + \
+                    page_positions
+                checked = codec.encode(blueprint, positions)
+
+            with span('save'):
+                # Move on to the next page, unless the page has already
+                # been submitted (e.g. by a concurrent request); the
+                # attempt is kept in the attempt store, and written to the
+                # database once finished past the last page
+                advance_attempt(attempt, blueprint, page_number,
+                                page_positions, checked)
 
-            # Check if there is another page from the test; if not
-            # proceed to the results
             if page_number < page_count:
-                request.session['page_number'] += 1
                 return redirect('tests:view', test_id)
             else:
-                request.session['test_status'] = 'finished'
                 return redirect('tests:result', test_id)
     else:
-        form = PageForm(page=page)
+        # Answer repeat requests of an unchanged page without rendering it
+        etag = page_etag(request, blueprint, page_number)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            return response
+
+        form = form_class()
 
     # Assign context variables
     context = {
-        'test': test,
+        'test': blueprint.test,
         'page_number': page_number,
         'page_count': page_count,
         'form': form,
+        # Questions of the unbound form are rendered once per test version
+        'questions': page_markup(blueprint, page_number - 1)
+                     if not form.is_bound else None,
     }
 
-    return render(request, 'tests/view.html', context)
+    with span('render'):
+        response = render(request, 'tests/view.html', context)
+
+    if not form.is_bound:
+        response['ETag'] = quote_etag(etag)
+        # Clients must check the page is unchanged before reusing it
+        patch_cache_control(response, private=True, no_cache=True)
+
+    return response
 
 
 def give_up(request):
     """Give up current test, stored in the session"""
 
-    request.session.pop('test_status', None)
-    request.session.pop('test_id', None)
-    request.session.pop('page_number', None)
-    request.session.pop('page_count', None)
-    request.session.pop('answers', None)
+    attempt = current_attempt(request)
+
+    if attempt is not None:
+        if attempt.status == Attempt.ACTIVE:
+            attempt.status = Attempt.GIVEN_UP
+            save_attempt(attempt)
+        forget_attempt(request)
 
     return redirect('tests:index')
 
@@ -93,137 +333,265 @@ def give_up(request):
 def result(request, test_id):
     """Displays the result of a test"""
 
-    def score_by_answers(answers):
-        """Returns the summed up score of given answers"""
-
-        return sum([answer.score for answer in answers])
-
-    def result_by_score(score):
-        """Returns test result based on given score"""
-
-        try:
-            return Result.objects.filter(test__pk=test_id,
-                                         limit__lte=score) \
-                                 .order_by('-limit')[0]
-        except IndexError:
-            return Result(text='Your result is too low!',
-                          limit=-999)
-
-    def filter_out_answers(answers):
+    def similar_results(suggestions):
         """
-        Filters out all answers from given list which belong to different
-        questions which belong to the same page
+        Returns better/worse results on test, along with the answers
+        that lead to them, given suggested result and answer ids
         """
 
-        def custom_default_dict():
-            """
-            Custom defaultdict factory for building nested defaultdicts
-            with lists as default values.
-            e.g.: d['key']['key2'].append('elem')
-            """
-
-            return defaultdict(list)
-
-        # Holds answer data
-        # Looks like: data[page][question] = [answers]
-        data = defaultdict(custom_default_dict)
+        names = ['better_result', 'worse_result']
 
-        for answer in answers:
-            data[answer.question.page][answer.question].append(answer)
+        # Fetch suggested answers, along with their questions and pages
+        ids = [answer_id for name in names if suggestions[name]
+               for answer_id in suggestions[name]['answers']]
+        answers = Answer.objects.using(database_for_test(test_id)) \
+                                .select_related('question__page') \
+                                .in_bulk(ids) if ids else {}
 
-        # Iterate over data and pick unwanted answers (all answers whose
-        # questions are more than 1 on their page)
-        unwanted_answers = []
-        for page, questions in data.iteritems():
-            if len(questions) > 1:
-                for questions, answers in questions.iteritems():
-                    unwanted_answers.extend(answers)
+        similar_results = {}
+        for name in names:
+            suggestion = suggestions[name]
+            if suggestion is not None:
+                suggestion = {
+                    'result': blueprint.result_by_id(suggestion['result']),
+                    'answers': [answers[answer_id]
+                                for answer_id in suggestion['answers']],
+                }
+            similar_results[name] = suggestion
 
-        return [answer for answer in answers if answer not in unwanted_answers]
+        return similar_results
 
-    def similar_results(answers):
-        """
-        Attempts to find better/worse result on test, by finding the
-        least amount of unchecked answers that will change the overall result.
-        """
+    attempt = current_attempt(request)
 
-        # Get unchecked answers
-        unchecked = Answer.objects.filter(question__page__test__pk=test_id) \
-                                  .exclude(pk__in=[a.pk for a in answers]) \
-                                  .order_by('question')
-
-        # Generate all combinations of unchecked answers, starting with fewer
-        # elements/combination (in order to find the least amount of answers)
-        combs = chain.from_iterable(
-            combinations(unchecked, r) for r in range(len(unchecked)+1))
-
-        better_result = worse_result = None
-
-        for comb in combs:
-            # Filter out combinations that contain answers which belong to
-            # different questions that belong to the same page
-            answers = filter_out_answers(comb)
-
-            if not answers:
-                continue
-
-            # Get result with unchecked answers from combination added
-            similar_result = result_by_score(score_by_answers(answers) + score)
-
-            # If result changes, save the new result
-            if similar_result is not None:
-                if better_result is None and \
-                   similar_result.limit > result.limit:
-                    better_result = {
-                        'result': similar_result,
-                        'answers': answers,
-                    }
-                elif worse_result is None and \
-                     similar_result.limit < result.limit:
-                    worse_result = {
-                        'result': similar_result,
-                        'answers': answers,
-                    }
-
-            # Break loop if both better and worse results have been found
-            if better_result and worse_result:
-                break
-
-        return {'better_result': better_result, 'worse_result': worse_result}
+    # If no test is started, go to the tests
+    if attempt is None:
+        return redirect('tests:index')
 
     # If a test is not finished, go to that test
-    if 'test_status' in request.session and \
-       request.session['test_status'] != 'finished':
-        return redirect('tests:view', test_id)
+    if attempt.status != Attempt.FINISHED:
+        return redirect('tests:view', attempt.test_id)
 
     # If test is finished, but given test_id doesn't match
     # the current test, redirect to that test's result
-    if request.session['test_id'] != test_id:
-        return redirect('tests:result', request.session['test_id'])
+    if attempt.test_id != int(test_id):
+        return redirect('tests:result', attempt.test_id)
+
+    # Load the blueprint of the test
+    blueprint = get_blueprint_or_404(test_id)
+
+    with span('scoring'):
+        # Checked answers list, holding positions in blueprint answer arrays
+        checked = checked_answers(attempt, blueprint)
+
+        # Compute test score and result text
+        score = blueprint.score(checked)
+        result = blueprint.result(score)
+
+    # Rank the score among finished attempts, once they have been ranked
+    with span('ranking'):
+        distribution = get_distribution(blueprint)
+        better_than = distribution.better_than(score) \
+            if distribution is not None else None
+
+    # Similar results are searched by the pool of suggestion workers and
+    # fetched by the page once found, unless TESTS_SUGGESTIONS_WAIT is set
+    # (they are then waited for as long), or TESTS_ASYNC_SUGGESTIONS is
+    # not (they are then found inline)
+    with span('suggestions'):
+        wait = getattr(settings, 'TESTS_SUGGESTIONS_WAIT', None)
+        if wait is not None:
+            suggestions = jobs.fetch(blueprint, checked, wait)
+        elif getattr(settings, 'TESTS_ASYNC_SUGGESTIONS', True):
+            suggestions = jobs.start(blueprint, checked)
+        else:
+            suggestions = cached_similar_results(blueprint, checked)
 
-    # Fetch test questions
-    questions = Question.objects.filter(page__test__pk=test_id)
+    context = {
+        'score': score,
+        'result': result,
+        'better_than': better_than,
+        'test_id': blueprint.test_id,
+        'similar_results': None,
+        'suggestions_pending': suggestions is None,
+    }
 
-    # Checked answers list
-    checked = []
+    if suggestions is not None:
+        with span('answers'):
+            context['similar_results'] = similar_results(suggestions)
+        # Whether suggestions are proven to need the least amount of
+        # answers, or the search ran out of budget
+        context['suggestions_proven'] = suggestions['proven']
+        context['suggestion_counters'] = suggestions['counters']
 
-    # For each test question, get the answer ids from the session,
-    # fetch the Answer objects, and store them in a list
-    for question in questions:
-        answer_ids = request.session['answers'].pop(
-            'question_{id}'.format(id=question.pk))
+    with span('render'):
+        return render(request, 'tests/result.html', context)
 
-        for answer_id in answer_ids:
-            checked.append(Answer.objects.get(pk=answer_id))
 
-    # Compute test score and result text
-    score = score_by_answers(checked)
-    result = result_by_score(score)
+def suggestions(request, test_id):
+    """
+    Returns similar results of a finished test as JSON, waiting for them
+    to be computed in the background (status is 'pending' until found)
+    """
 
-    context = {
-        'score': score,
-        'result': result,
-        'similar_results': similar_results(checked),
+    attempt = current_attempt(request)
+
+    # Only finished tests have similar results
+    if attempt is None or attempt.status != Attempt.FINISHED or \
+       attempt.test_id != int(test_id):
+        raise Http404
+
+    blueprint = get_blueprint_or_404(test_id)
+    with span('suggestions'):
+        suggestions = jobs.fetch(blueprint,
+                                 checked_answers(attempt, blueprint))
+
+    if suggestions is None:
+        data = {'status': 'pending'}
+    else:
+        data = {
+            'status': 'done',
+            'better_result': describe_suggestion(
+                blueprint, suggestions['better_result']),
+            'worse_result': describe_suggestion(
+                blueprint, suggestions['worse_result']),
+            'proven': suggestions['proven'],
+        }
+
+    return json_response(data)
+
+
+def profile(request):
+    """
+    Shows the histograms of view spans and query counts kept by
+    ProfilingMiddleware in this process, to staff; as JSON if format=json
+    """
+
+    if not request.user.is_active or not request.user.is_staff:
+        raise PermissionDenied
+
+    snapshot = stats.snapshot()
+
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps(snapshot, indent=2, sort_keys=True),
+                            content_type='application/json')
+
+    views = []
+    for view, histograms in sorted(snapshot.items()):
+        rows = [('span', name, summary)
+                for name, summary in sorted(histograms['spans'].items())]
+        rows.extend(('queries', alias, summary) for alias, summary
+                    in sorted(histograms['queries'].items()))
+        views.append((view, rows))
+
+    return render(request, 'tests/profile.html', {'views': views})
+
+
+def analytics(request, test_id):
+    """
+    Returns the analytics of a test to staff, as JSON: score histogram,
+    and counts of results and picked answers
+    """
+
+    if not request.user.is_active or not request.user.is_staff:
+        raise PermissionDenied
+
+    blueprint = get_blueprint_or_404(test_id)
+
+    return HttpResponse(json.dumps(test_analytics(blueprint), indent=2,
+                                   sort_keys=True),
+                        content_type='application/json')
+
+
+def describe_test(blueprint):
+    """
+    Describes the pages of a test, with their questions and answers, as
+    page forms show them
+    """
+
+    return {
+        'id': blueprint.test_id,
+        'name': blueprint.name,
+        'description': blueprint.description,
+        'version': blueprint.version,
+        'pages': [{
+            'name': blueprint.page_names[page],
+            'questions': [{
+                'id': question_id,
+                'name': name,
+                'answers': [{'id': answer_id, 'name': answer_name}
+                            for answer_id, answer_name in answers],
+            } for question_id, name, answers in blueprint.questions(page)],
+        } for page in range(blueprint.page_count)],
     }
 
-    return render(request, 'tests/result.html', context)
+
+@csrf_exempt
+def api_test(request, test_id):
+    """
+    Takes a whole test in a single round trip, as JSON: GET returns all
+    pages of the test, and POST submits answers to all questions and
+    returns score, result and suggestions. Answers are posted as
+    {"answers": {"<question id>": [<answer id>, ...], ...}}. Attempts taken
+    this way are stored, but not kept in the session.
+    """
+
+    blueprint = get_blueprint_or_404(test_id)
+
+    if request.method == 'GET':
+        if blueprint.version in parse_etags(
+                request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = json_response(describe_test(blueprint))
+        response['ETag'] = quote_etag(blueprint.version)
+        return response
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['GET', 'POST'])
+
+    # Only JSON is accepted, which forms of other sites cannot post
+    if request.META.get('CONTENT_TYPE', '').split(';')[0] != \
+       'application/json':
+        return json_response({'errors': {
+            '__all__': 'Answers must be posted as application/json.'}},
+            status=415)
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return json_response({'errors': {
+            '__all__': 'Answers must be posted as a JSON object.'}},
+            status=400)
+
+    with span('scoring'):
+        positions, errors = clean_answers(blueprint, data.get('answers'))
+    if errors:
+        return json_response({'errors': errors}, status=400)
+
+    using = database_for_test(blueprint.test_id)
+    with span('save'), transaction.commit_on_success(using=using):
+        attempt = Attempt.objects.using(using).create(
+            test_id=blueprint.test_id,
+            page_number=blueprint.page_count + 1,
+            checked=codec.encode(blueprint, positions),
+            checked_version=blueprint.version)
+        save_answers(attempt, blueprint, positions)
+        finish_attempt(attempt, blueprint, positions)
+
+    with span('suggestions'):
+        suggestions = cached_similar_results(blueprint, positions)
+
+    result = blueprint.result_by_id(attempt.result_id)
+
+    return json_response({
+        'attempt': attempt.pk,
+        'score': attempt.score,
+        'result': {'id': result.pk, 'text': result.text},
+        'better_result': describe_suggestion(
+            blueprint, suggestions['better_result']),
+        'worse_result': describe_suggestion(
+            blueprint, suggestions['worse_result']),
+        'proven': suggestions['proven'],
+    })
@@ -0,0 +1,124 @@
+"""
+Warm-up of the tests app, before serving requests.
+
+Blueprints of the most taken tests are built ahead of time, along with the
+markup of their pages, so that the first takers of a test after a deploy
+or a worker recycle don't pay for loading it. Blueprints hold their
+content in flat arrays, whose buffers are not written to once built.
+
+Django 1.5 has no hook running once the app is loaded, so warm_up() is
+called from the WSGI module of servers loading the application before
+forking workers (e.g. gunicorn --preload); workers then share the warmed
+up blueprints copy-on-write. Database connections are closed once done,
+as workers may not share them. The warm_up command loads the same tests
+and reports the time and memory they take, to size workers.
+
+The most taken tests are found from the counters of finished attempts
+kept by the analytics, rather than by counting attempts.
+"""
+
+import sys
+import timeit
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Sum
+
+from models import Test, ScoreCount
+from blueprints import cache, get_blueprint
+from forms import page_markup
+from routers import primary_database
+
+
+def active_tests(limit):
+    """
+    Returns ids of the most taken tests, followed by other tests, up to
+    limit
+    """
+
+    databases = getattr(settings, 'TESTS_SHARD_DATABASES', None) or \
+        [primary_database()]
+
+    # Finished attempts of each test, from its score histogram
+    counts = Counter()
+    for using in databases:
+        counts.update(dict(ScoreCount.objects.using(using)
+                                             .order_by()
+                                             .values('test')
+                                             .annotate(count=Sum('count'))
+                                             .values_list('test', 'count')))
+
+    test_ids = [test_id for test_id, count in counts.most_common(limit)]
+    if len(test_ids) < limit:
+        test_ids.extend(Test.objects.exclude(pk__in=test_ids)
+                                    .order_by('pk')
+                                    .values_list('pk', flat=True)
+                                    [:limit - len(test_ids)])
+
+    return test_ids
+
+
+def footprint(blueprint):
+    """Returns the memory taken by a blueprint, in bytes"""
+
+    size = sys.getsizeof(blueprint)
+    for value in blueprint:
+        size += sys.getsizeof(value)
+        if isinstance(value, tuple):
+            size += sum(sys.getsizeof(item) for item in value)
+        elif isinstance(value, dict):
+            size += sum(sys.getsizeof(key) + sys.getsizeof(item)
+                        for key, item in value.iteritems())
+
+    return size
+
+
+def max_rss():
+    """Returns the peak resident memory of this process, in kilobytes"""
+
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def warm_up(test_ids=None, markup=True):
+    """
+    Builds the blueprints of given tests, or of the most taken tests (as
+    many as the blueprint cache holds), along with the markup of their
+    pages, then closes database connections. Returns a row per test
+    loaded, with its size and load time.
+    """
+
+    if test_ids is None:
+        test_ids = active_tests(cache.size)
+
+    rows = []
+    for test_id in test_ids:
+        start = timeit.default_timer()
+        blueprint = get_blueprint(test_id)
+        size = footprint(blueprint)
+        if markup:
+            for page in range(blueprint.page_count):
+                size += sys.getsizeof(page_markup(blueprint, page))
+
+        rows.append({
+            'test': blueprint.test_id,
+            'pages': blueprint.page_count,
+            'answers': len(blueprint.answer_ids),
+            'bytes': size,
+            'ms': (timeit.default_timer() - start) * 1e3,
+        })
+
+    # Connections would otherwise be inherited by forked workers, which
+    # would then talk to the database over the same sockets
+    for connection in connections.all():
+        connection.close()
+
+    return rows